@@ -0,0 +1,239 @@
+import asyncio
+import contextvars
+import math
+import time
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager, contextmanager
+from typing import Optional
+
+import metrics
+from rate_limit import TokenBucket
+
+# モデル呼び出しの受付制御（アドミッションコントロール）
+# 同時にモデルへ送る数を capacity に抑え、空きを待つリクエストは優先度の高いクラスから、
+# 同じクラスの中ではユーザーごとに順番に（1人が大量に送っても他のユーザーが待たされないように）通す
+# ユーザーごとにトークンバケットで流量を制限し、期限（クラスごとの待ち時間の上限）までに通せない見込みのリクエストは
+# 待たせずにすぐ断る（流量制限は429、混雑は503。どちらも Retry-After の秒数を付ける）
+# 呼び出し元（クラス・ユーザー）は caller() で設定する（contextvars なので、その中で作ったタスクにも引き継がれる）
+# イベントループ上で使う（LINEのハンドラーからは from_thread.run 経由で呼び出す）
+
+# 優先度のクラス（先に書いたものほど優先する）
+INTERACTIVE = "interactive"
+LINE = "line"
+BACKGROUND = "background"
+PRIORITIES = (INTERACTIVE, LINE, BACKGROUND)
+
+# 流量制限の状態を持っておくユーザーの数
+MAX_TRACKED_USERS = 10000
+
+
+class AdmissionRejected(Exception):
+    def __init__(self, status: int, retry_after: float, reason: str):
+        super().__init__(reason)
+        self.status = status
+        self.retry_after = retry_after
+        self.reason = reason
+
+    def retry_after_header(self) -> str:
+        return str(max(1, math.ceil(self.retry_after)))
+
+
+class Caller:
+    def __init__(self, priority: str, user: Optional[str] = None):
+        self.priority = priority
+        self.user = user
+        # 期限は届いた時刻から数える（前処理などにかかった時間も含める）
+        self.arrived = time.monotonic()
+
+
+_caller = contextvars.ContextVar("admission_caller", default=None)
+
+
+@contextmanager
+def caller(priority: str, user: Optional[str] = None):
+    """with の中のモデル呼び出しを priority のクラス・user のリクエストとして扱う"""
+    token = _caller.set(Caller(priority, user))
+    try:
+        yield
+    finally:
+        _caller.reset(token)
+
+
+def current_caller() -> Caller:
+    # 設定されていなければ、対話的なリクエストとして流量制限はしない
+    return _caller.get() or Caller(INTERACTIVE)
+
+
+class AdmissionController:
+    def __init__(
+        self,
+        capacity: int,
+        max_queue: int = 256,
+        user_rate: float = 1.0,
+        user_burst: float = 10.0,
+        timeouts: Optional[dict] = None,
+    ):
+        self.capacity = capacity
+        self.max_queue = max_queue
+        self.user_rate = user_rate
+        self.user_burst = user_burst
+        # クラスごとの待ち時間の上限（秒）
+        self.timeouts = {INTERACTIVE: 30.0, LINE: 120.0, BACKGROUND: 300.0, **(timeouts or {})}
+
+        self.active = 0
+        # クラス -> user -> 待っているリクエストの Future（ユーザーの順番は OrderedDict の順で回す）
+        self._queues = {priority: OrderedDict() for priority in PRIORITIES}
+        self._waiting = {priority: 0 for priority in PRIORITIES}
+        self._buckets = OrderedDict()
+        # 1件の処理時間の指数移動平均（待ち時間の見積もりに使う）
+        self.service_time = None
+
+        self.admitted = {priority: 0 for priority in PRIORITIES}
+        self.rejected = {priority: 0 for priority in PRIORITIES}
+
+        for priority in PRIORITIES:
+            metrics.QUEUE_DEPTH.labels(f"llm_{priority}").set_function(lambda p=priority: self._waiting[p])
+
+    @asynccontextmanager
+    async def slot(self, charge: bool = True):
+        """呼び出し元のクラス・ユーザーに応じて空きを待つ（通せなければ AdmissionRejected）
+
+        リトライのときは charge=False にして、ユーザーの流量制限のトークンを使わない
+        """
+        request = current_caller()
+        started = time.monotonic()
+        try:
+            await self._acquire(request, charge)
+        except AdmissionRejected as e:
+            self.rejected[request.priority] += 1
+            metrics.ADMISSION_REJECTIONS.labels(request.priority, e.reason).inc()
+            raise
+        self.admitted[request.priority] += 1
+        metrics.ADMISSION_WAIT.labels(request.priority).observe(time.monotonic() - started)
+
+        held = time.monotonic()
+        try:
+            yield
+        finally:
+            self._release(time.monotonic() - held)
+
+    def stats(self) -> dict:
+        return {
+            "capacity": self.capacity,
+            "active": self.active,
+            "waiting": dict(self._waiting),
+            "service_time": self.service_time,
+            "admitted": dict(self.admitted),
+            "rejected": dict(self.rejected),
+        }
+
+    def _deadline(self, request: Caller) -> float:
+        return request.arrived + self.timeouts.get(request.priority, self.timeouts[INTERACTIVE])
+
+    def _bucket(self, user: str) -> TokenBucket:
+        bucket = self._buckets.get(user)
+        if bucket is None:
+            bucket = self._buckets[user] = TokenBucket(self.user_rate, self.user_burst)
+            if len(self._buckets) > MAX_TRACKED_USERS:
+                self._buckets.popitem(last=False)
+        else:
+            self._buckets.move_to_end(user)
+        return bucket
+
+    def _estimated_wait(self, priority: str) -> float:
+        """priority のリクエストが今から並んだときの待ち時間の見積もり"""
+        if self.service_time is None:
+            return 0.0
+        rank = PRIORITIES.index(priority)
+        ahead = sum(self._waiting[p] for p in PRIORITIES[:rank + 1])
+        return (ahead + 1) / self.capacity * self.service_time
+
+    async def _acquire(self, request: Caller, charge: bool):
+        deadline = self._deadline(request)
+
+        # ユーザーごとの流量制限（期限までにトークンがたまらなければ429）
+        if charge and request.user is not None and self.user_rate > 0:
+            bucket = self._bucket(request.user)
+            while (wait := bucket.take()) > 0:
+                if time.monotonic() + wait > deadline:
+                    raise AdmissionRejected(429, wait, "rate_limited")
+                await asyncio.sleep(wait)
+
+        if self.active < self.capacity and not any(self._waiting.values()):
+            self.active += 1
+            return
+
+        # 期限までに順番が回ってこない見込みなら並ばせずに断る
+        remaining = deadline - time.monotonic()
+        estimate = self._estimated_wait(request.priority)
+        if remaining <= 0 or estimate > remaining:
+            raise AdmissionRejected(503, estimate, "deadline")
+
+        if sum(self._waiting.values()) >= self.max_queue and not self._shed_lower(request.priority):
+            raise AdmissionRejected(503, estimate, "queue_full")
+
+        future = asyncio.get_running_loop().create_future()
+        user_queues = self._queues[request.priority]
+        user_queues.setdefault(request.user, deque()).append(future)
+        self._waiting[request.priority] += 1
+        try:
+            await asyncio.wait_for(asyncio.shield(future), remaining)
+        except asyncio.TimeoutError:
+            self._withdraw(request, future)
+            raise AdmissionRejected(503, self._estimated_wait(request.priority), "deadline")
+        except BaseException:
+            self._withdraw(request, future)
+            raise
+
+    def _withdraw(self, request: Caller, future: asyncio.Future):
+        """待つのをやめたリクエストを列から外す（既に順番が回っていたら枠を返す）"""
+        if future.done():
+            if not future.cancelled() and future.exception() is None:
+                self._release(None)
+            return
+        future.cancel()
+        user_queues = self._queues[request.priority]
+        queue = user_queues.get(request.user)
+        if queue is not None and future in queue:
+            queue.remove(future)
+            self._waiting[request.priority] -= 1
+            if not queue:
+                del user_queues[request.user]
+
+    def _shed_lower(self, priority: str) -> bool:
+        """列がいっぱいのとき、priority より低いクラスで最後に並んだリクエストを断って場所を空ける"""
+        for lower in reversed(PRIORITIES[PRIORITIES.index(priority) + 1:]):
+            user_queues = self._queues[lower]
+            if not user_queues:
+                continue
+            user, queue = next(reversed(user_queues.items()))
+            future = queue.pop()
+            if not queue:
+                del user_queues[user]
+            self._waiting[lower] -= 1
+            future.set_exception(AdmissionRejected(503, self._estimated_wait(lower), "shed"))
+            return True
+        return False
+
+    def _release(self, held: Optional[float]):
+        self.active -= 1
+        if held is not None:
+            self.service_time = held if self.service_time is None else 0.9 * self.service_time + 0.1 * held
+        self._dispatch()
+
+    def _dispatch(self):
+        # 空いた枠を優先度の高いクラスから、クラスの中ではユーザーの順番に渡す
+        while self.active < self.capacity:
+            priority = next((p for p in PRIORITIES if self._waiting[p]), None)
+            if priority is None:
+                return
+            user_queues = self._queues[priority]
+            user, queue = next(iter(user_queues.items()))
+            future = queue.popleft()
+            if queue:
+                user_queues.move_to_end(user)
+            else:
+                del user_queues[user]
+            self._waiting[priority] -= 1
+            self.active += 1
+            future.set_result(True)
@@ -0,0 +1,430 @@
+import argparse
+import asyncio
+import base64
+import hashlib
+import hmac
+import json
+import math
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+
+import httpx
+
+from stub_line_server import sample_image
+
+# 負荷試験のベンチマーク
+# モデル（stub_llm_server.py）・R2（stub_s3_server.py）・LINE（stub_line_server.py）をローカルのスタブに置き換えてアプリを起動し、
+# /analyze・/suggest-menu・/upload-json・/get-json・/callback に指定した同時接続数でリクエストを送って
+# スループット（RPS）・p50/p95/p99 のレイテンシ・アプリのメモリ使用量を表示する
+# --output で結果をJSONに保存し、次回 --baseline に渡すと性能が落ちたシナリオを検出して終了コード1で終わる
+# 例: python bench_load.py --concurrency 1,8,32 --requests 200 --llm-latency 0.2 --output bench.json
+#     python bench_load.py --baseline bench.json
+
+BACKEND_DIR = os.path.dirname(os.path.abspath(__file__))
+
+SCENARIOS = ("analyze", "suggest-menu", "upload-json", "get-json", "callback")
+
+CHANNEL_TOKEN = "bench-token"
+CHANNEL_SECRET = "bench-secret"
+
+# /callback で画像を送るLINEユーザーの数（ユーザーごとにイベントが順番に処理されるので、ワーカー数より多くする）
+LINE_USERS = 32
+# /get-json で読み出すために事前にアップロードしておくJSONの数
+GET_JSON_DOCUMENTS = 50
+
+PRODUCT_NAMES = [
+    "牛乳", "卵", "豆腐", "鶏もも肉", "豚こま肉", "鮭", "キャベツ", "玉ねぎ", "にんじん", "じゃがいも",
+    "トマト", "きゅうり", "ほうれん草", "納豆", "ヨーグルト", "チーズ", "ベーコン", "ウインナー", "もやし", "しめじ",
+]
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def percentile(values: list, p: float) -> float:
+    """昇順に並んだ values の p パーセンタイル（nearest-rank）"""
+    if not values:
+        return 0.0
+    index = max(0, min(len(values) - 1, math.ceil(p / 100 * len(values)) - 1))
+    return values[index]
+
+
+def memory_mb(pid: int) -> tuple:
+    """プロセスの (現在のRSS, 最大のRSS) をMBで返す（/proc が読めない環境では (None, None)）"""
+    values = {}
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                name, _, value = line.partition(":")
+                if name in ("VmRSS", "VmHWM"):
+                    values[name] = int(value.split()[0]) / 1024
+    except OSError:
+        pass
+    return values.get("VmRSS"), values.get("VmHWM")
+
+
+def sign(body: bytes, secret: str = CHANNEL_SECRET) -> str:
+    """LINEプラットフォームと同じ X-Line-Signature を付ける"""
+    return base64.b64encode(hmac.new(secret.encode(), body, hashlib.sha256).digest()).decode()
+
+
+def line_event(user_id: str, message: dict) -> dict:
+    return {
+        "type": "message",
+        "mode": "active",
+        "timestamp": int(time.time() * 1000),
+        "webhookEventId": uuid.uuid4().hex,
+        "deliveryContext": {"isRedelivery": False},
+        "replyToken": uuid.uuid4().hex,
+        "source": {"type": "user", "userId": user_id},
+        "message": message,
+    }
+
+
+def line_body(events: list) -> bytes:
+    return json.dumps({"destination": "Ubench", "events": events}, ensure_ascii=False).encode()
+
+
+def sample_products(rng: random.Random, count: int = 3) -> list:
+    return [
+        {
+            "name": name,
+            "expiration_date": f"2025-05-{rng.randint(1, 28):02d}",
+            "expiration_type": "best_before",
+            "image_url": "",
+            "amount": rng.choice([1, 2, 100, 200, 500]),
+            "unit": rng.choice(["個", "g", "ml"]),
+            "category": "その他",
+        }
+        for name in rng.sample(PRODUCT_NAMES, count)
+    ]
+
+
+class Stack:
+    """スタブのサーバーとアプリを別プロセスで起動し、終了時に止める"""
+
+    def __init__(self, args):
+        self.args = args
+        self.processes = []
+        self.logs = []
+        self.workdir = tempfile.TemporaryDirectory(prefix="bench-")
+        self.app_port = free_port()
+        self.s3_port = free_port()
+        self.line_port = free_port()
+        self.llm_ports = [free_port() for _ in range(args.llm_stubs)]
+        self.app = None
+
+    def spawn(self, name: str, command: list, env: dict = None) -> subprocess.Popen:
+        log = open(os.path.join(self.workdir.name, f"{name}.log"), "wb")
+        self.logs.append(log)
+        process = subprocess.Popen(command, cwd=BACKEND_DIR, env=env, stdout=log, stderr=subprocess.STDOUT)
+        process.name = name
+        self.processes.append(process)
+        return process
+
+    def log_tail(self, process, lines: int = 20) -> str:
+        with open(os.path.join(self.workdir.name, f"{process.name}.log"), "rb") as f:
+            return b"\n".join(f.read().splitlines()[-lines:]).decode(errors="replace")
+
+    async def wait_ready(self, process, url: str, timeout: float = 60.0):
+        deadline = time.monotonic() + timeout
+        async with httpx.AsyncClient() as client:
+            while time.monotonic() < deadline:
+                if process.poll() is not None:
+                    raise RuntimeError(f"{process.name} が起動に失敗しました:\n{self.log_tail(process)}")
+                try:
+                    await client.get(url, timeout=1.0)
+                    return
+                except httpx.TransportError:
+                    await asyncio.sleep(0.1)
+        raise RuntimeError(f"{process.name} が {timeout} 秒以内に起動しませんでした:\n{self.log_tail(process)}")
+
+    async def start(self):
+        args = self.args
+        python = sys.executable
+        stubs = []
+        for i, port in enumerate(self.llm_ports):
+            command = [python, "stub_llm_server.py", "--port", str(port), "--latency", str(args.llm_latency), "--jitter", str(args.llm_jitter)]
+            stubs.append((self.spawn(f"llm{i}", command), f"http://127.0.0.1:{port}/v1/models"))
+        s3 = self.spawn("s3", [python, "stub_s3_server.py", "--port", str(self.s3_port), "--latency", str(args.s3_latency)])
+        stubs.append((s3, f"http://127.0.0.1:{self.s3_port}/ai-hackathon"))
+        line = self.spawn("line", [python, "stub_line_server.py", "--port", str(self.line_port), "--latency", str(args.line_latency)])
+        stubs.append((line, f"http://127.0.0.1:{self.line_port}/stub/stats"))
+        await asyncio.gather(*(self.wait_ready(process, url) for process, url in stubs))
+
+        env = {
+            **os.environ,
+            "CHANNEL_ID": CHANNEL_TOKEN,
+            "CHANNEL_SECRET": CHANNEL_SECRET,
+            "LLM_BACKENDS": json.dumps([{"url": f"http://127.0.0.1:{port}/v1"} for port in self.llm_ports]),
+            "R2_ENDPOINT": f"127.0.0.1:{self.s3_port}",
+            "R2_SECURE": "0",
+            "ACCESS_KEY": "bench",
+            "SECRET_KEY": "bench",
+            "LINE_API_ENDPOINT": f"http://127.0.0.1:{self.line_port}",
+            "INVENTORY_DIR": os.path.join(self.workdir.name, "inventory"),
+            # .env の設定で結果が変わらないようにする
+            "IMAGE_CACHE_DIR": "",
+            # 処理量を測るので、LINEのユーザーごとの流量制限はかけない
+            "LLM_USER_RATE": "0",
+            "LOG_LEVEL": os.getenv("LOG_LEVEL", "WARNING"),
+        }
+        command = [python, "-m", "uvicorn", "main:app", "--host", "127.0.0.1", "--port", str(self.app_port), "--log-level", "warning"]
+        started = time.perf_counter()
+        self.app = self.spawn("app", command, env)
+        await self.wait_ready(self.app, f"{self.base_url}/health")
+        self.startup_seconds = time.perf_counter() - started
+
+    def stop(self):
+        for process in self.processes:
+            process.terminate()
+        for process in self.processes:
+            try:
+                process.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                process.kill()
+        for log in self.logs:
+            log.close()
+        self.workdir.cleanup()
+
+    @property
+    def base_url(self) -> str:
+        return f"http://127.0.0.1:{self.app_port}"
+
+    @property
+    def line_url(self) -> str:
+        return f"http://127.0.0.1:{self.line_port}"
+
+
+class Workload:
+    """シナリオごとに i 番目のリクエストを送る"""
+
+    def __init__(self, stack: Stack, client: httpx.AsyncClient, seed: int):
+        self.stack = stack
+        self.client = client
+        self.rng = random.Random(seed)
+        self.run_id = uuid.uuid4().hex[:8]
+        self.images = []
+        self.image_count = 0
+        self.prepared = set()
+        self.sent = 0
+
+    async def prepare(self, scenario: str, requests: int):
+        """計測の前に必要なデータを用意する（計測には含めない）"""
+        if scenario == "analyze":
+            # 毎回異なる画像にして、画像解析のキャッシュに当たらないようにする
+            self.images = [sample_image(f"{self.run_id}-{self.image_count + i}") for i in range(requests)]
+            self.image_count += requests
+            return
+        if scenario in self.prepared:
+            return
+        self.prepared.add(scenario)
+        if scenario == "get-json":
+            for i in range(GET_JSON_DOCUMENTS):
+                await self.client.post("/upload-json", json={"id": f"bench-get-{i}", "data": {"products": sample_products(self.rng)}})
+        elif scenario == "callback":
+            events = [line_event(f"Ubench{i}", {"type": "text", "id": uuid.uuid4().hex, "text": "開始"}) for i in range(LINE_USERS)]
+            body = line_body(events)
+            pushes = await self.pushes()
+            await self.client.post("/callback", content=body, headers={"X-Line-Signature": sign(body)})
+            await self.wait_pushes(pushes + LINE_USERS)
+
+    async def send(self, scenario: str, i: int) -> httpx.Response:
+        # i は同時接続数のレベルごとに0から数え直すので、IDには通し番号を使う
+        self.sent += 1
+        if scenario == "analyze":
+            image = self.images[i % len(self.images)]
+            return await self.client.post("/analyze", files={"file": ("bench.jpg", image, "image/jpeg")})
+        if scenario == "suggest-menu":
+            # 食材の組み合わせが重なることがあるので、献立のキャッシュに当たるリクエストも混ざる
+            return await self.client.post("/suggest-menu", json={"products": sample_products(self.rng)})
+        if scenario == "upload-json":
+            return await self.client.post("/upload-json", json={"id": f"bench-{self.run_id}-{self.sent}", "data": {"products": sample_products(self.rng)}})
+        if scenario == "get-json":
+            return await self.client.get(f"/get-json/bench-get-{i % GET_JSON_DOCUMENTS}")
+        if scenario == "callback":
+            message = {"type": "image", "id": f"{self.run_id}-{self.sent}", "contentProvider": {"type": "line"}}
+            body = line_body([line_event(f"Ubench{i % LINE_USERS}", message)])
+            return await self.client.post("/callback", content=body, headers={"X-Line-Signature": sign(body)})
+        raise ValueError(f"unknown scenario: {scenario}")
+
+    async def pushes(self) -> int:
+        async with httpx.AsyncClient(base_url=self.stack.line_url) as client:
+            return (await client.get("/stub/stats")).json()["pushes"]
+
+    async def wait_pushes(self, expected: int, timeout: float = 300.0):
+        """LINEのイベントがすべて処理され、プッシュメッセージが送られるまで待つ"""
+        deadline = time.monotonic() + timeout
+        while await self.pushes() < expected:
+            if time.monotonic() > deadline:
+                raise RuntimeError(f"LINEのイベントが {timeout} 秒以内に処理されませんでした")
+            await asyncio.sleep(0.05)
+
+
+async def run_level(workload: Workload, scenario: str, concurrency: int, requests: int, warmup: int) -> dict:
+    if scenario == "callback":
+        pushes = await workload.pushes()
+    for i in range(warmup):
+        await workload.send(scenario, requests + i)
+    if scenario == "callback":
+        pushes += warmup
+        await workload.wait_pushes(pushes)
+
+    latencies = []
+    errors = 0
+    next_index = 0
+    rss_before, _ = memory_mb(workload.stack.app.pid)
+
+    async def worker():
+        nonlocal next_index, errors
+        while next_index < requests:
+            i = next_index
+            next_index += 1
+            started = time.perf_counter()
+            try:
+                response = await workload.send(scenario, i)
+                if response.status_code >= 400:
+                    errors += 1
+            except httpx.HTTPError:
+                errors += 1
+            latencies.append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - started
+
+    result = {
+        "scenario": scenario,
+        "concurrency": concurrency,
+        "requests": requests,
+        "errors": errors,
+        "rps": requests / elapsed,
+    }
+    if scenario == "callback":
+        # /callback はキューに入れたらすぐ返るので、画像の解析からプッシュまで終わるまでの処理量も出す
+        await workload.wait_pushes(pushes + requests)
+        result["processed_rps"] = requests / (time.perf_counter() - started)
+
+    latencies.sort()
+    rss_after, rss_peak = memory_mb(workload.stack.app.pid)
+    result.update({
+        "p50_ms": percentile(latencies, 50) * 1000,
+        "p95_ms": percentile(latencies, 95) * 1000,
+        "p99_ms": percentile(latencies, 99) * 1000,
+        "rss_mb": rss_after,
+        "rss_growth_mb": rss_after - rss_before if rss_after is not None and rss_before is not None else None,
+        "rss_peak_mb": rss_peak,
+    })
+    return result
+
+
+def print_result(result: dict):
+    def mb(value):
+        return f"{value:8.1f}" if value is not None else f"{'-':>8}"
+
+    processed = f"  (処理 {result['processed_rps']:.1f} rps)" if "processed_rps" in result else ""
+    print(
+        f"{result['scenario']:<14} {result['concurrency']:>4} {result['requests']:>6} {result['errors']:>5} "
+        f"{result['rps']:>9.1f} {result['p50_ms']:>9.1f} {result['p95_ms']:>9.1f} {result['p99_ms']:>9.1f} "
+        f"{mb(result['rss_mb'])} {mb(result['rss_peak_mb'])}{processed}",
+        flush=True,
+    )
+
+
+def find_regressions(results: list, baseline: dict, tolerance: float) -> list:
+    """baseline と比べて RPS（/callback は処理の RPS も）が下がった・p95/p99 が伸びた・エラーが出たシナリオを返す"""
+    previous = {(r["scenario"], r["concurrency"]): r for r in baseline["results"]}
+    regressions = []
+    for result in results:
+        base = previous.get((result["scenario"], result["concurrency"]))
+        if base is None:
+            continue
+        name = f"{result['scenario']} (同時接続 {result['concurrency']})"
+        for key in ("rps", "processed_rps"):
+            if key in base and result[key] < base[key] * (1 - tolerance):
+                regressions.append(f"{name}: {key} {base[key]:.1f} -> {result[key]:.1f}")
+        for key in ("p95_ms", "p99_ms"):
+            if result[key] > base[key] * (1 + tolerance):
+                regressions.append(f"{name}: {key} {base[key]:.1f} -> {result[key]:.1f}")
+        if result["errors"] > base["errors"]:
+            regressions.append(f"{name}: エラー {base['errors']} -> {result['errors']}")
+    return regressions
+
+
+async def bench(args) -> list:
+    stack = Stack(args)
+    try:
+        await stack.start()
+        print(f"アプリの起動: {stack.startup_seconds:.2f}秒 / RSS {memory_mb(stack.app.pid)[0] or 0:.1f}MB")
+        print(f"{'シナリオ':<12} {'同時':>4} {'件数':>5} {'エラー':>3} {'RPS':>9} {'p50(ms)':>9} {'p95(ms)':>9} {'p99(ms)':>9} {'RSS(MB)':>8} {'最大(MB)':>6}")
+
+        limits = httpx.Limits(max_connections=max(args.concurrency), max_keepalive_connections=max(args.concurrency))
+        async with httpx.AsyncClient(base_url=stack.base_url, limits=limits, timeout=args.timeout) as client:
+            workload = Workload(stack, client, args.seed)
+            results = []
+            for scenario in args.scenarios:
+                for concurrency in args.concurrency:
+                    await workload.prepare(scenario, args.requests)
+                    result = await run_level(workload, scenario, concurrency, args.requests, args.warmup)
+                    print_result(result)
+                    results.append(result)
+            return results
+    finally:
+        stack.stop()
+
+
+def parse_list(value: str) -> list:
+    return [item.strip() for item in value.split(",") if item.strip()]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="スタブを使った負荷試験のベンチマーク")
+    parser.add_argument("--scenarios", type=parse_list, default=list(SCENARIOS), help=f"カンマ区切り（{','.join(SCENARIOS)}）")
+    parser.add_argument("--concurrency", type=lambda v: [int(c) for c in parse_list(v)], default=[1, 8, 32], help="同時接続数（カンマ区切り）")
+    parser.add_argument("--requests", type=int, default=200, help="同時接続数ごとのリクエスト数")
+    parser.add_argument("--warmup", type=int, default=5, help="計測前に送るリクエスト数")
+    parser.add_argument("--timeout", type=float, default=60.0, help="1リクエストのタイムアウト（秒）")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--llm-stubs", type=int, default=1, help="モデルのスタブサーバーの台数")
+    parser.add_argument("--llm-latency", type=float, default=0.2, help="モデルのスタブの応答時間（秒）")
+    parser.add_argument("--llm-jitter", type=float, default=0.05, help="モデルのスタブの応答時間のばらつき（±秒）")
+    parser.add_argument("--s3-latency", type=float, default=0.005, help="R2のスタブの1操作の時間（秒）")
+    parser.add_argument("--line-latency", type=float, default=0.01, help="LINEのスタブの1回のAPI呼び出しの時間（秒）")
+    parser.add_argument("--output", help="結果を保存するJSONファイル")
+    parser.add_argument("--baseline", help="比較する前回の結果のJSONファイル")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="性能の低下とみなす割合（デフォルト: 0.2 = 20%%）")
+    args = parser.parse_args()
+
+    unknown = set(args.scenarios) - set(SCENARIOS)
+    if unknown:
+        parser.error(f"unknown scenario: {', '.join(sorted(unknown))}")
+
+    results = asyncio.run(bench(args))
+
+    if args.output:
+        settings = {key: value for key, value in vars(args).items() if key not in ("output", "baseline")}
+        with open(args.output, "w") as f:
+            json.dump({"settings": settings, "results": results}, f, ensure_ascii=False, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = find_regressions(results, json.load(f), args.tolerance)
+        if regressions:
+            print("\n性能が落ちたシナリオ:")
+            for regression in regressions:
+                print(f"  {regression}")
+            sys.exit(1)
+        print("\n前回の結果からの性能の低下はありません")
+
+
+if __name__ == "__main__":
+    main()
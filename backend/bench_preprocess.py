@@ -0,0 +1,111 @@
+import argparse
+import asyncio
+import base64
+import glob
+import os
+import statistics
+import time
+
+import llm
+import prompts
+from image_preprocess import preprocess_image
+from main import PRODUCT_INFO_SCHEMA
+
+# 画像の前処理の効果を測るベンチマーク
+# モデルに送るバイト数と、（--model 指定時は）モデル呼び出しまで含めたレイテンシを前処理の有無で比較する
+# モデルには /analyze と同じ指示とスキーマを送る。最初にウォームアップを1回送り、
+# 前処理の有無の順番を1回ごとに入れ替えて --repeat 回ずつ測る（先に送った方だけがモデルの読み込みやキャッシュの影響を受けないように）
+
+DEFAULT_IMAGES = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "demo", "*.jpg")
+
+
+def payload_size(content: bytes) -> int:
+    """モデルに送る data: URL のバイト数"""
+    return len("data:image/jpeg;base64,") + len(base64.b64encode(content))
+
+
+async def measure_model(content: bytes) -> float:
+    """画像1枚をモデルに送り、レスポンスが返るまでの秒数を返す"""
+    base64_image = base64.b64encode(content).decode('utf-8')
+    start = time.perf_counter()
+    await llm.create_json_completion(
+        messages=prompts.vision_messages(prompts.ANALYZE_PROMPT, f"data:image/jpeg;base64,{base64_image}"),
+        schema=PRODUCT_INFO_SCHEMA
+    )
+    return time.perf_counter() - start
+
+
+async def measure_pair(content: bytes, processed: bytes, repeat: int) -> tuple:
+    """前処理の前後の画像を、送る順番を入れ替えながら repeat 回ずつ送り、それぞれの中央値を返す"""
+    before = []
+    after = []
+    for i in range(repeat):
+        if i % 2 == 0:
+            before.append(await measure_model(content))
+            after.append(await measure_model(processed))
+        else:
+            after.append(await measure_model(processed))
+            before.append(await measure_model(content))
+    return statistics.median(before), statistics.median(after)
+
+
+async def bench(paths: list, use_model: bool, repeat: int):
+    total_before = 0
+    total_after = 0
+    latency_before = 0.0
+    latency_after = 0.0
+
+    print(f"{'画像':<40} {'前処理前':>12} {'前処理後':>12} {'前処理(ms)':>10}", end="")
+    print(f" {'前(s)':>8} {'後(s)':>8}" if use_model else "")
+
+    if use_model:
+        # モデルの読み込みを最初の計測に含めないよう、計測の前に1回送っておく
+        with open(paths[0], "rb") as f:
+            await measure_model(preprocess_image(f.read()))
+
+    for path in paths:
+        with open(path, "rb") as f:
+            content = f.read()
+
+        start = time.perf_counter()
+        processed = preprocess_image(content)
+        preprocess_ms = (time.perf_counter() - start) * 1000
+
+        before = payload_size(content)
+        after = payload_size(processed)
+        total_before += before
+        total_after += after
+
+        print(f"{os.path.basename(path):<40} {before:>12,} {after:>12,} {preprocess_ms:>10.1f}", end="")
+
+        if use_model:
+            elapsed_before, elapsed_after = await measure_pair(content, processed, repeat)
+            elapsed_after += preprocess_ms / 1000
+            latency_before += elapsed_before
+            latency_after += elapsed_after
+            print(f" {elapsed_before:>8.2f} {elapsed_after:>8.2f}")
+        else:
+            print()
+
+    print(f"\n送信バイト数の合計: {total_before:,} -> {total_after:,} ({total_after / max(total_before, 1):.1%})")
+    if use_model:
+        print(f"レイテンシ（中央値）の合計: {latency_before:.2f}s -> {latency_after:.2f}s")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="画像の前処理のベンチマーク")
+    parser.add_argument("images", nargs="*", help="画像ファイル（省略時は demo/*.jpg）")
+    parser.add_argument("--model", action="store_true", help="モデルを呼び出してレイテンシも計測する")
+    parser.add_argument("--repeat", type=int, default=3, help="--model のとき、画像ごとに前処理の前後をそれぞれ何回送るか（デフォルト: 3）")
+    args = parser.parse_args()
+
+    paths = args.images or sorted(glob.glob(DEFAULT_IMAGES))
+    if not paths:
+        print("エラー: 画像ファイルが見つかりません")
+        return
+
+    asyncio.run(bench(paths, args.model, max(1, args.repeat)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,148 @@
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+import httpx
+
+from bench_load import BACKEND_DIR, free_port
+
+# 起動時間のベンチマーク
+# main.py の import にかかる時間と、プロセスを起動してから /health が初めて200を返すまでの時間を計測し、
+# 予算（--import-budget / --health-budget 秒）を超えたら終了コード1で終わる
+# モデル・R2・LINEのSDKは最初に使うときに読み込むので、起動時に読み込まれていたら同じく失敗にする
+# 例: python bench_startup.py --runs 5
+#     python bench_startup.py --importtime 15
+
+# 起動時に読み込んではいけない（最初に使うときに読み込む）SDK
+LAZY_MODULES = ("openai", "minio", "linebot")
+
+IMPORT_SCRIPT = """
+import json, sys, time
+started = time.perf_counter()
+import main
+elapsed = time.perf_counter() - started
+print(json.dumps({"seconds": elapsed, "modules": [m for m in %r if m in sys.modules]}))
+""" % (LAZY_MODULES,)
+
+
+def startup_env(workdir: str) -> dict:
+    # 外部のサービスにはつながない（モデルのバックエンドは何も待ち受けていないポートを指す）
+    return {
+        **os.environ,
+        "CHANNEL_ID": "bench-token",
+        "CHANNEL_SECRET": "bench-secret",
+        "LLM_BACKENDS": json.dumps([{"url": f"http://127.0.0.1:{free_port()}/v1"}]),
+        "INVENTORY_DIR": os.path.join(workdir, "inventory"),
+        "IMAGE_CACHE_DIR": "",
+        "LOG_LEVEL": "ERROR",
+    }
+
+
+def measure_import(env: dict) -> dict:
+    """新しいプロセスで main を import する時間と、そのときに読み込まれたSDK"""
+    output = subprocess.run(
+        [sys.executable, "-c", IMPORT_SCRIPT],
+        cwd=BACKEND_DIR, env=env, capture_output=True, text=True, check=True,
+    ).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def measure_health(env: dict, timeout: float = 60.0) -> float:
+    """uvicorn のプロセスを起動してから /health が200を返すまでの秒数"""
+    port = free_port()
+    command = [sys.executable, "-m", "uvicorn", "main:app", "--host", "127.0.0.1", "--port", str(port), "--log-level", "warning"]
+    started = time.perf_counter()
+    process = subprocess.Popen(command, cwd=BACKEND_DIR, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    try:
+        with httpx.Client() as client:
+            while time.perf_counter() - started < timeout:
+                if process.poll() is not None:
+                    raise RuntimeError(f"アプリが起動に失敗しました:\n{process.stderr.read().decode(errors='replace')}")
+                try:
+                    if client.get(f"http://127.0.0.1:{port}/health", timeout=1.0).status_code == 200:
+                        return time.perf_counter() - started
+                except httpx.TransportError:
+                    pass
+                time.sleep(0.005)
+        raise RuntimeError(f"/health が {timeout} 秒以内に応答しませんでした")
+    finally:
+        process.terminate()
+        try:
+            process.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            process.kill()
+
+
+def slowest_imports(env: dict, top: int) -> list:
+    """main から直接 import しているモジュールを、読み込みにかかった時間の長い順に (秒, 名前) で返す"""
+    stderr = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", "import main"],
+        cwd=BACKEND_DIR, env=env, capture_output=True, text=True, check=True,
+    ).stderr
+    # 子のモジュールは親より先に出力されるので、main の行の直前までに出た1段下のモジュールを集める
+    children = []
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        depth = (len(name) - len(name.lstrip()) - 1) // 2
+        if depth == 0:
+            if name.strip() == "main":
+                return sorted(children, reverse=True)[:top]
+            children = []
+        elif depth == 1:
+            children.append((int(cumulative) / 1_000_000, name.strip()))
+    return []
+
+
+def summary(values: list) -> str:
+    return f"中央値 {statistics.median(values):.3f}秒（最小 {min(values):.3f} / 最大 {max(values):.3f}）"
+
+
+def main():
+    parser = argparse.ArgumentParser(description="起動時間のベンチマーク")
+    parser.add_argument("--runs", type=int, default=5, help="計測の回数（中央値で判定する）")
+    parser.add_argument("--import-budget", type=float, default=1.0, help="main の import にかけてよい秒数")
+    parser.add_argument("--health-budget", type=float, default=2.5, help="起動から /health の応答までにかけてよい秒数")
+    parser.add_argument("--importtime", type=int, default=0, metavar="N", help="読み込みに時間がかかっているモジュールを N 件表示する")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory(prefix="bench-startup-") as workdir:
+        env = startup_env(workdir)
+
+        imports = [measure_import(env) for _ in range(args.runs)]
+        import_seconds = [result["seconds"] for result in imports]
+        loaded = sorted({module for result in imports for module in result["modules"]})
+        health_seconds = [measure_health(env) for _ in range(args.runs)]
+
+        print(f"main の import: {summary(import_seconds)}  予算 {args.import_budget:.3f}秒")
+        print(f"/health の応答: {summary(health_seconds)}  予算 {args.health_budget:.3f}秒")
+
+        if args.importtime:
+            print("\n読み込みに時間がかかっているモジュール:")
+            for seconds, name in slowest_imports(env, args.importtime):
+                print(f"  {seconds:7.3f}秒  {name}")
+
+    failures = []
+    if statistics.median(import_seconds) > args.import_budget:
+        failures.append(f"main の import が予算を超えました（{statistics.median(import_seconds):.3f}秒 > {args.import_budget:.3f}秒）")
+    if statistics.median(health_seconds) > args.health_budget:
+        failures.append(f"/health の応答が予算を超えました（{statistics.median(health_seconds):.3f}秒 > {args.health_budget:.3f}秒）")
+    if loaded:
+        failures.append(f"起動時に読み込まないはずのSDKが読み込まれています: {', '.join(loaded)}")
+
+    if failures:
+        print()
+        for failure in failures:
+            print(failure)
+        sys.exit(1)
+    print("\n起動時間は予算内です")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,61 @@
+import copy
+import threading
+import time
+from collections import OrderedDict
+from typing import Optional
+
+# /get-json 用のパース済みJSONのキャッシュ
+# R2のETagと一緒に保存し、取得のたびに stat_object でETagが変わっていないか確認してから返す
+# （revalidate_after 秒以内に確認済みなら確認も省略する）
+# 呼び出し元が後で書き換えてもETagと中身がずれないように、put では複製を保存する
+
+
+def parse_etags(header: Optional[str]) -> set:
+    """If-None-Match / If-Match ヘッダーのETagの集合（引用符と W/ は外す）"""
+    if not header:
+        return set()
+    etags = set()
+    for value in header.split(","):
+        value = value.strip()
+        if value.startswith("W/"):
+            value = value[2:]
+        etags.add(value.strip('"'))
+    return etags
+
+
+class DocumentCache:
+    def __init__(self, max_entries: int = 1024, revalidate_after: float = 2.0):
+        self.max_entries = max_entries
+        self.revalidate_after = revalidate_after
+        # object_name -> (etag, data, 最後にETagを確認した時刻)
+        self._entries: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, object_name: str) -> Optional[tuple]:
+        """(etag, data, 確認が不要か) を返す（無ければNone）"""
+        with self._lock:
+            entry = self._entries.get(object_name)
+            if entry is None:
+                return None
+            self._entries.move_to_end(object_name)
+            etag, data, validated_at = entry
+            return etag, data, time.time() - validated_at <= self.revalidate_after
+
+    def put(self, object_name: str, etag: str, data):
+        data = copy.deepcopy(data)
+        with self._lock:
+            self._entries[object_name] = (etag, data, time.time())
+            self._entries.move_to_end(object_name)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def touch(self, object_name: str):
+        """ETagが変わっていないことを確認した時刻を更新する"""
+        with self._lock:
+            entry = self._entries.get(object_name)
+            if entry is not None:
+                self._entries[object_name] = (entry[0], entry[1], time.time())
+
+    def invalidate(self, object_name: str):
+        with self._lock:
+            self._entries.pop(object_name, None)
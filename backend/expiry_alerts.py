@@ -0,0 +1,271 @@
+import heapq
+import logging
+import math
+import os
+import threading
+import time
+from collections import defaultdict, deque
+from typing import Callable, Iterable, Optional
+
+from expiry_index import expiration_key, parse_expiration
+from rate_limit import TokenBucket
+
+# 期限が近い商品をLINEで知らせるスケジューラー
+# 全ユーザーの商品を「知らせる時刻（期限の lead 秒前）」ごとのバケット（幅 interval 秒）に入れておき、
+# interval 秒ごとに時刻が来たバケットだけを取り出す（毎回すべてのユーザーの在庫を調べない）
+# 同じ文面になるユーザーはまとめて multicast で送り、送信の回数は rate 回/秒に抑える
+# dry_run では送らずに、送るはずだった内容をログと stats()["recent"] に残す（recent には宛先のIDは残さず人数だけ）
+# preview() は時刻が来た通知を取り出さずに返す（動作確認で呼んでも、実際の通知は消えない）
+# 通知を処理し終えた時刻（watermark）を state_path に保存しておき、再起動後はそれより後に知らせる時刻の商品を入れる
+# （再起動の間に知らせる時刻を過ぎた商品も、期限切れでなければ知らせる。すでに知らせた商品は二度知らせない）
+
+logger = logging.getLogger(__name__)
+
+# LINEの multicast で1回に送れる宛先の数
+MULTICAST_LIMIT = 500
+
+
+def alert_message(products: list) -> str:
+    lines = [
+        f"・{product.get('name')}（{product.get('expiration_date')}）"
+        for product in sorted(products, key=lambda p: (expiration_key(p.get("expiration_date")), str(p.get("name"))))
+    ]
+    return "期限が近い商品があります：\n" + "\n".join(lines)
+
+
+def batch_summary(batch: dict) -> dict:
+    """送った内容から宛先のIDを除く（stats や動作確認のAPIで返す）"""
+    return {"recipients": len(batch["to"]), "text": batch["text"], "dry_run": batch["dry_run"]}
+
+
+class ExpiryAlertScheduler:
+    def __init__(
+        self,
+        send: Callable[[list, str], None],
+        load_users: Optional[Callable[[], Iterable[tuple]]] = None,
+        lead: float = 24 * 60 * 60,
+        interval: float = 60.0,
+        rate: float = 10.0,
+        dry_run: bool = False,
+        clock: Callable[[], float] = time.time,
+        state_path: Optional[str] = None,
+    ):
+        # send(user_ids, text) で multicast する。load_users は起動時に (user_id, 商品のリスト) を返す
+        self.send = send
+        self.load_users = load_users
+        self.lead = lead
+        self.interval = interval
+        self.dry_run = dry_run
+        self.clock = clock
+        self.limiter = TokenBucket(rate)
+        self.state_path = state_path
+        self.watermark = self._read_watermark()
+
+        # バケットの番号（知らせる時刻 / interval を切り上げたもの） -> [(user_id, 世代, 商品)]
+        self._buckets = {}
+        self._heap = []
+        # user_id -> 世代（在庫をリセットしたら上げ、古い世代の商品は知らせない）
+        self._generations = defaultdict(int)
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stopped = threading.Event()
+        self._thread = None
+
+        self.alerts = 0
+        self.multicasts = 0
+        self.recipients = 0
+        self.failures = 0
+        self.recent = deque(maxlen=50)
+
+    def schedule(self, user_id: str, product: dict, now: Optional[float] = None) -> bool:
+        """商品を知らせる時刻のバケットに入れる（期限が読めない・期限切れなら入れない）"""
+        now = self.clock() if now is None else now
+        expiry = parse_expiration(product.get("expiration_date"))
+        if expiry is None or expiry <= now:
+            return False
+        bucket = math.ceil((expiry - self.lead) / self.interval)
+        with self._lock:
+            entries = self._buckets.get(bucket)
+            if entries is None:
+                entries = self._buckets[bucket] = []
+                heapq.heappush(self._heap, bucket)
+            entries.append((user_id, self._generations[user_id], product))
+        return True
+
+    def forget(self, user_id: str):
+        """ユーザーの商品を知らせないようにする（バケットからは取り出すときに捨てる）"""
+        with self._lock:
+            self._generations[user_id] += 1
+
+    def on_inventory_change(self, user_id: str, delta: dict):
+        # InventoryStore.subscribe に渡す
+        if delta["op"] == "reset":
+            self.forget(user_id)
+        elif delta["op"] == "add":
+            self.schedule(user_id, delta["product"])
+
+    def load(self, users: Iterable[tuple], now: Optional[float] = None):
+        """起動時に既存の在庫を入れる
+        前回処理し終えた時刻（watermark）までに知らせる時刻が来た商品は知らせたものとして入れず、
+        それより後の商品は知らせる時刻を過ぎていても入れて次の run_once で知らせる（watermark が無ければ今の時刻まで）"""
+        now = self.clock() if now is None else now
+        processed = math.floor((now if self.watermark is None else self.watermark) / self.interval)
+        count = 0
+        for user_id, products in users:
+            for product in products:
+                expiry = parse_expiration(product.get("expiration_date"))
+                if expiry is None or math.ceil((expiry - self.lead) / self.interval) <= processed:
+                    continue
+                if self.schedule(user_id, product, now):
+                    count += 1
+        return count
+
+    def due(self, now: Optional[float] = None, remove: bool = True) -> dict:
+        """知らせる時刻が来た商品を user_id ごとに取り出す（remove=False ならバケットに残したまま返す）"""
+        now = self.clock() if now is None else now
+        current = math.floor(now / self.interval)
+        by_user = defaultdict(dict)
+        with self._lock:
+            if remove:
+                buckets = []
+                while self._heap and self._heap[0] <= current:
+                    buckets.append(self._buckets.pop(heapq.heappop(self._heap)))
+            else:
+                buckets = [entries for bucket, entries in self._buckets.items() if bucket <= current]
+            for entries in buckets:
+                for user_id, generation, product in entries:
+                    if generation != self._generations[user_id]:
+                        continue
+                    expiry = parse_expiration(product.get("expiration_date"))
+                    if expiry is None or expiry <= now:
+                        continue
+                    # 同じ商品を2回登録していても1回だけ知らせる
+                    by_user[user_id][(product.get("name"), product.get("expiration_date"))] = product
+        return {user_id: list(products.values()) for user_id, products in by_user.items()}
+
+    def batches(self, due: dict) -> list:
+        """同じ文面のユーザーをまとめ、MULTICAST_LIMIT 人ずつの (文面, 宛先) に分ける"""
+        groups = defaultdict(list)
+        for user_id, products in due.items():
+            groups[alert_message(products)].append(user_id)
+        return [
+            (text, sorted(user_ids)[start:start + MULTICAST_LIMIT])
+            for text, user_ids in groups.items()
+            for start in range(0, len(user_ids), MULTICAST_LIMIT)
+        ]
+
+    def preview(self, now: Optional[float] = None) -> list:
+        """時刻が来た通知を取り出さずに、送るはずの内容（宛先は人数だけ）を返す"""
+        return [
+            {"recipients": len(user_ids), "text": text, "dry_run": True}
+            for text, user_ids in self.batches(self.due(now, remove=False))
+        ]
+
+    def run_once(self, now: Optional[float] = None, dry_run: Optional[bool] = None) -> list:
+        """時刻が来た通知を送り、送った（dry_run なら送るはずだった）内容を返す"""
+        dry_run = self.dry_run if dry_run is None else dry_run
+        now = self.clock() if now is None else now
+        due = self.due(now)
+        sent = []
+        for text, user_ids in self.batches(due):
+            # LINE APIの流量制限を超えないように待つ
+            wait = self.limiter.take()
+            while wait > 0:
+                if self._stopped.wait(wait):
+                    # 止めるときは残りを捨てる（watermark は進めないので、次の起動時にまた入れて知らせる）
+                    return sent
+                wait = self.limiter.take()
+
+            batch = {"to": user_ids, "text": text, "dry_run": dry_run}
+            if dry_run:
+                logger.info("Expiry alert (dry run) to %s users: %r", len(user_ids), text)
+            else:
+                try:
+                    self.send(user_ids, text)
+                except Exception as e:
+                    self.failures += 1
+                    logger.error("Expiry alert multicast error (%s users): %s", len(user_ids), e)
+                    continue
+            self.multicasts += 1
+            self.recipients += len(user_ids)
+            self.alerts += sum(len(due[user_id]) for user_id in user_ids)
+            self.recent.append(batch_summary(batch))
+            sent.append(batch)
+        self._save_watermark(now)
+        return sent
+
+    def start(self):
+        """既存の在庫を読み込み、interval 秒ごとに通知を送るスレッドを起動する"""
+        if self._thread is not None:
+            return
+        self._stopped.clear()
+        self._thread = threading.Thread(target=self._run, name="expiry-alerts", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        self._wakeup.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def stats(self) -> dict:
+        with self._lock:
+            scheduled = sum(len(entries) for entries in self._buckets.values())
+            buckets = len(self._buckets)
+            next_alert = self._heap[0] * self.interval if self._heap else None
+        return {
+            "scheduled": scheduled,
+            "buckets": buckets,
+            "next_alert": next_alert,
+            "alerts": self.alerts,
+            "multicasts": self.multicasts,
+            "recipients": self.recipients,
+            "failures": self.failures,
+            "dry_run": self.dry_run,
+            "recent": list(self.recent)[-10:],
+        }
+
+    def _read_watermark(self) -> Optional[float]:
+        if self.state_path is None:
+            return None
+        try:
+            with open(self.state_path, encoding="utf-8") as f:
+                return float(f.read())
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError) as e:
+            logger.error("Expiry alert watermark read error: %s", e)
+            return None
+
+    def _save_watermark(self, now: float):
+        if self.watermark is not None and now <= self.watermark:
+            return
+        self.watermark = now
+        if self.state_path is None:
+            return
+        # 書きかけのファイルを読まないように、別のファイルに書いてから置き換える
+        try:
+            tmp_path = f"{self.state_path}.tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                f.write(repr(now))
+            os.replace(tmp_path, self.state_path)
+        except OSError as e:
+            logger.error("Expiry alert watermark write error: %s", e)
+
+    def _run(self):
+        if self.load_users is not None:
+            try:
+                count = self.load(self.load_users())
+                logger.info("Expiry alerts: scheduled %s products", count)
+            except Exception as e:
+                logger.error("Expiry alert load error: %s", e)
+
+        while not self._stopped.is_set():
+            try:
+                self.run_once()
+            except Exception as e:
+                logger.error("Expiry alert error: %s", e)
+            # 次のバケットの境目まで待つ
+            self._wakeup.wait(self.interval - self.clock() % self.interval)
+            self._wakeup.clear()
@@ -0,0 +1,90 @@
+import bisect
+import itertools
+import math
+import os
+import re
+from datetime import datetime, time, timedelta, timezone
+from typing import Callable, Optional
+
+# 期限（expiration_date）をタイムスタンプに変換し、期限順に並べた索引
+# モデルやフロントエンドが返す期限の表記はまちまちなので、文字列のままでは正しく並ばない
+# 日付だけの期限はその日の終わり（翌日0時、EXPIRY_TZ_OFFSET 時間のタイムゾーン）とみなす
+# モデルは時刻が書かれていない期限を 00:00:00（Z 付きのこともある）で返すので、0時ちょうどの日時も日付だけの期限として扱う
+# 「25.4.28」のような2桁の年は2000年代とみなす
+
+EXPIRY_TZ = timezone(timedelta(hours=float(os.getenv("EXPIRY_TZ_OFFSET", "9"))))
+
+_DATE_PATTERN = re.compile(r"^\s*(\d{4}|\d{2})\s*[-/.年]\s*(\d{1,2})\s*[-/.月]\s*(\d{1,2})\s*日?\s*$")
+_COMPACT_DATE_PATTERN = re.compile(r"^\s*(\d{4})(\d{2})(\d{2})\s*$")
+
+
+def parse_expiration(value: Optional[str]) -> Optional[float]:
+    """期限の文字列をUNIX時刻に変換する（読み取れなければNone）"""
+    if not value:
+        return None
+
+    match = _DATE_PATTERN.match(value) or _COMPACT_DATE_PATTERN.match(value)
+    if match:
+        year, month, day = map(int, match.groups())
+        return _end_of_day(year + 2000 if year < 100 else year, month, day)
+
+    try:
+        moment = datetime.fromisoformat(value.strip().replace("Z", "+00:00"))
+    except ValueError:
+        return None
+    if moment.time() == time(0):
+        # 書かれている日付の終わり（タイムゾーンが付いていても EXPIRY_TZ の日付として読む）
+        return _end_of_day(moment.year, moment.month, moment.day)
+    if moment.tzinfo is None:
+        moment = moment.replace(tzinfo=EXPIRY_TZ)
+    return moment.timestamp()
+
+
+def _end_of_day(year: int, month: int, day: int) -> Optional[float]:
+    try:
+        start = datetime(year, month, day, tzinfo=EXPIRY_TZ)
+    except ValueError:
+        return None
+    return (start + timedelta(days=1)).timestamp()
+
+
+def expiration_key(value: Optional[str]) -> float:
+    """期限順に並べるためのキー（読み取れない期限は最後に回す）"""
+    timestamp = parse_expiration(value)
+    return timestamp if timestamp is not None else math.inf
+
+
+class ExpiryIndex:
+    def __init__(self, products: Optional[list] = None):
+        # (期限のタイムスタンプ, 追加順) の昇順に並べたキーと、キー -> 商品
+        self._keys = []
+        self._products = {}
+        self._counter = itertools.count()
+        for product in products or []:
+            self.add(product)
+
+    def __len__(self) -> int:
+        return len(self._keys)
+
+    def add(self, product: dict):
+        key = (expiration_key(product.get("expiration_date")), next(self._counter))
+        bisect.insort(self._keys, key)
+        self._products[key] = product
+
+    def top(self, k: int, accept: Optional[Callable[[dict], bool]] = None) -> list:
+        """期限が近い順に k 件（accept を渡すと、accept(商品) が真のものだけを数える）"""
+        if accept is None:
+            return [self._products[key] for key in self._keys[:max(k, 0)]]
+        products = []
+        for key in self._keys:
+            if len(products) >= k:
+                break
+            if accept(self._products[key]):
+                products.append(self._products[key])
+        return products
+
+    def within(self, seconds: float, now: Optional[float] = None) -> list:
+        """now から seconds 秒以内に期限が来る商品（期限切れのものも含む）を期限順に"""
+        now = datetime.now(EXPIRY_TZ).timestamp() if now is None else now
+        end = bisect.bisect_right(self._keys, (now + seconds, math.inf))
+        return [self._products[key] for key in self._keys[:end]]
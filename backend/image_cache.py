@@ -0,0 +1,154 @@
+import hashlib
+import io
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Optional
+
+try:
+    from PIL import Image
+except ImportError:  # Pillowが無い環境では知覚ハッシュを使わない
+    Image = None
+
+# 画像解析結果のキャッシュ
+# アップロードされた画像のバイト列のハッシュをキーに、解析済みの ProductInfo（image_url を含む）を保存する
+# /analyze と LINEの handle_image から共有して使う
+
+
+def content_hash(content: bytes) -> str:
+    """画像バイト列のSHA-256"""
+    return hashlib.sha256(content).hexdigest()
+
+
+def perceptual_hash(content: bytes) -> Optional[int]:
+    """再エンコードされた画像でも近い値になる64bitのdHash（Pillowが無い・デコードできない場合はNone）"""
+    if Image is None:
+        return None
+    try:
+        with Image.open(io.BytesIO(content)) as image:
+            image.draft("L", (64, 64))  # JPEGは縮小デコードで高速化
+            pixels = list(image.convert("L").resize((9, 8)).getdata())
+    except Exception:
+        return None
+
+    value = 0
+    for row in range(8):
+        for col in range(8):
+            left = pixels[row * 9 + col]
+            right = pixels[row * 9 + col + 1]
+            value = (value << 1) | (1 if left > right else 0)
+    return value
+
+
+class ImageResultCache:
+    def __init__(
+        self,
+        max_entries: int = 1024,
+        ttl: float = 7 * 24 * 60 * 60,
+        disk_dir: Optional[str] = None,
+        use_phash: bool = False,
+        phash_distance: int = 4,
+    ):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.disk_dir = disk_dir
+        self.use_phash = use_phash and Image is not None
+        self.phash_distance = phash_distance
+        # key -> (保存時刻, 結果, 知覚ハッシュ)
+        self._entries: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+
+        if self.disk_dir:
+            os.makedirs(self.disk_dir, exist_ok=True)
+
+    def get(self, content: bytes) -> Optional[dict]:
+        """キャッシュ済みの解析結果を返す（無ければNone）"""
+        key = content_hash(content)
+
+        result = self._get_memory(key)
+        if result is None:
+            result = self._get_disk(key)
+        if result is None and self.use_phash:
+            result = self._get_similar(perceptual_hash(content))
+        return dict(result) if result is not None else None
+
+    def put(self, content: bytes, result: dict):
+        """解析結果を保存する"""
+        key = content_hash(content)
+        phash = perceptual_hash(content) if self.use_phash else None
+        created_at = time.time()
+
+        self._set_memory(key, created_at, dict(result), phash)
+
+        if self.disk_dir:
+            path = os.path.join(self.disk_dir, f"{key}.json")
+            temp_path = f"{path}.tmp"
+            with open(temp_path, "w", encoding="utf-8") as f:
+                json.dump({"created_at": created_at, "result": result, "phash": phash}, f, ensure_ascii=False)
+            os.replace(temp_path, path)
+
+    def _expired(self, created_at: float) -> bool:
+        return time.time() - created_at > self.ttl
+
+    def _get_memory(self, key: str) -> Optional[dict]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            created_at, result, _ = entry
+            if self._expired(created_at):
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return result
+
+    def _set_memory(self, key: str, created_at: float, result: dict, phash: Optional[int]):
+        with self._lock:
+            self._entries[key] = (created_at, result, phash)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def _get_disk(self, key: str) -> Optional[dict]:
+        if not self.disk_dir:
+            return None
+
+        path = os.path.join(self.disk_dir, f"{key}.json")
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            return None
+
+        if self._expired(entry["created_at"]):
+            try:
+                os.unlink(path)
+            except OSError:
+                pass
+            return None
+
+        # メモリ側に昇格させる
+        self._set_memory(key, entry["created_at"], entry["result"], entry.get("phash"))
+        return entry["result"]
+
+    def _get_similar(self, phash: Optional[int]) -> Optional[dict]:
+        if phash is None:
+            return None
+
+        with self._lock:
+            best_key = None
+            best_distance = self.phash_distance + 1
+            for key, (created_at, _, other) in self._entries.items():
+                if other is None or self._expired(created_at):
+                    continue
+                distance = (phash ^ other).bit_count()
+                if distance < best_distance:
+                    best_key = key
+                    best_distance = distance
+
+            if best_key is None:
+                return None
+            self._entries.move_to_end(best_key)
+            return self._entries[best_key][1]
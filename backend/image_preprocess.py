@@ -0,0 +1,83 @@
+import io
+import logging
+import os
+from typing import Optional
+
+from PIL import Image, ImageOps
+
+# モデルに送る前の画像の前処理
+# スマホの写真はそのままだと数MBになるため、向きを補正して縮小・再エンコードしてから送る
+# （R2には元の画像をそのまま保存する）
+
+logger = logging.getLogger(__name__)
+
+IMAGE_PREPROCESS = os.getenv("IMAGE_PREPROCESS", "1") == "1"
+IMAGE_MAX_EDGE = int(os.getenv("IMAGE_MAX_EDGE", "1024"))
+IMAGE_JPEG_QUALITY = int(os.getenv("IMAGE_JPEG_QUALITY", "85"))
+
+
+def preprocess_image(
+    content: bytes,
+    max_edge: int = IMAGE_MAX_EDGE,
+    quality: int = IMAGE_JPEG_QUALITY,
+) -> bytes:
+    """EXIFの向きを反映し、長辺をmax_edgeに縮小してJPEGで再エンコードした画像を返す"""
+    if not IMAGE_PREPROCESS:
+        return content
+
+    try:
+        with Image.open(io.BytesIO(content)) as image:
+            # JPEGは縮小デコードしてから処理する
+            image.draft("RGB", (max_edge, max_edge))
+            orientation = image.getexif().get(0x0112, 1)
+            needs_resize = max(image.size) > max_edge
+
+            image = ImageOps.exif_transpose(image)
+            if image.mode != "RGB":
+                image = image.convert("RGB")
+            image.thumbnail((max_edge, max_edge), Image.Resampling.LANCZOS)
+
+            buffer = io.BytesIO()
+            image.save(buffer, format="JPEG", quality=quality, optimize=True)
+    except Exception as e:
+        # 読み込めない画像はそのままモデルに渡す
+        logger.warning("Image preprocess error: %s", e)
+        return content
+
+    processed = buffer.getvalue()
+
+    # 縮小も回転も不要で再エンコードの方が大きくなる場合は元の画像を使う
+    if not needs_resize and orientation == 1 and len(processed) >= len(content):
+        return content
+    return processed
+
+
+def crop_image(content: bytes, bbox: Optional[list], margin: float = 0.05) -> Optional[bytes]:
+    """bbox（0〜1の割合で表した左上x, 左上y, 右下x, 右下y）の範囲を少し広めに切り出してJPEGで返す"""
+    if not bbox or len(bbox) != 4:
+        return None
+
+    x0, y0, x1, y1 = (min(max(float(v), 0.0), 1.0) for v in bbox)
+    if x1 <= x0 or y1 <= y0:
+        return None
+
+    try:
+        with Image.open(io.BytesIO(content)) as image:
+            # モデルはEXIFの向きを反映した画像を見ているので、同じ向きで切り出す
+            image = ImageOps.exif_transpose(image)
+            if image.mode != "RGB":
+                image = image.convert("RGB")
+            width, height = image.size
+            box = (
+                int(max(x0 - margin, 0.0) * width),
+                int(max(y0 - margin, 0.0) * height),
+                int(min(x1 + margin, 1.0) * width),
+                int(min(y1 + margin, 1.0) * height),
+            )
+            buffer = io.BytesIO()
+            image.crop(box).save(buffer, format="JPEG", quality=IMAGE_JPEG_QUALITY)
+    except Exception as e:
+        logger.warning("Image crop error: %s", e)
+        return None
+
+    return buffer.getvalue()
@@ -0,0 +1,247 @@
+import json
+import logging
+import os
+import re
+import threading
+from collections import OrderedDict
+from typing import Callable, Optional
+
+from expiry_index import ExpiryIndex
+
+# LINEユーザーごとの在庫（登録した商品）の永続化
+# 変更はローカルの追記専用ログ（{user_id}.log）に1行ずつ書き、R2の {user_id}.json へのスナップショットは
+# バックグラウンドでまとめて書き出す（コンパクション）。1件の追加にかかるコストは在庫の件数によらない。
+# 初めてアクセスしたユーザーは、R2のスナップショットとローカルのログから復元する。
+# 在庫は期限順の索引（ExpiryIndex）も持ち、期限が近い商品を全件ソートせずに取り出せる。
+# subscribe した関数には変更（reset / add）が届く（期限の通知のスケジューラーが使う）。
+# 未登録のユーザーの状態は持たない（存在しないIDの問い合わせでメモリが増えないように、直近に未登録だったIDだけを件数を限って覚える）。
+
+logger = logging.getLogger(__name__)
+
+# ユーザーごとのロックは、IDのハッシュで決まるこの数のロックを共有する
+LOCK_STRIPES = 256
+# 未登録だと分かったIDを覚えておく数（R2を毎回読みに行かないように）
+MAX_UNREGISTERED = 10000
+
+
+class InventoryStore:
+    def __init__(
+        self,
+        log_dir: str,
+        load_snapshot: Callable[[str], Optional[dict]],
+        save_snapshot: Callable[[str, dict], None],
+        compact_every: int = 100,
+        compact_interval: float = 60.0,
+    ):
+        self.log_dir = log_dir
+        self.load_snapshot = load_snapshot
+        self.save_snapshot = save_snapshot
+        self.compact_every = compact_every
+        self.compact_interval = compact_interval
+
+        # user_id -> {"products": [...]}（登録済みのユーザーだけ）
+        self._users = {}
+        # 直近に未登録だったIDの LRU
+        self._unregistered = OrderedDict()
+        # user_id -> 期限順の索引
+        self._indexes = {}
+        # user_id -> 最後に書いた変更の番号
+        self._seq = {}
+        # user_id -> スナップショットに反映していない変更の数
+        self._pending = {}
+        # 変更を受け取る関数（ユーザーのロックを持ったまま呼ぶので、すぐに返すこと）
+        self._listeners = []
+
+        self._locks = [threading.Lock() for _ in range(LOCK_STRIPES)]
+        self._unregistered_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stopped = threading.Event()
+        self._thread = None
+
+        os.makedirs(self.log_dir, exist_ok=True)
+
+    def subscribe(self, listener: Callable[[str, dict], None]):
+        """変更のたびに listener(user_id, 変更) を呼ぶ"""
+        self._listeners.append(listener)
+
+    def user_ids(self) -> list:
+        """このサーバーで登録したことのあるユーザー（LINEのユーザーIDは英数字だけなので、ログのファイル名がそのままIDになる）"""
+        return [name[:-len(".log")] for name in os.listdir(self.log_dir) if name.endswith(".log")]
+
+    def is_registered(self, user_id: str) -> bool:
+        with self._user_lock(user_id):
+            return self._hydrate(user_id)
+
+    def get(self, user_id: str) -> Optional[dict]:
+        """ユーザーの在庫を返す（未登録ならNone）"""
+        with self._user_lock(user_id):
+            if not self._hydrate(user_id):
+                return None
+            return {"products": list(self._users[user_id]["products"])}
+
+    def expiring(self, user_id: str, k: int, accept: Optional[Callable[[dict], bool]] = None) -> Optional[list]:
+        """期限が近い順に k 件の商品を返す（未登録ならNone。accept を渡すと accept(商品) が真のものだけ）"""
+        with self._user_lock(user_id):
+            if not self._hydrate(user_id):
+                return None
+            return self._indexes[user_id].top(k, accept)
+
+    def expiring_within(self, user_id: str, seconds: float, now: Optional[float] = None) -> Optional[list]:
+        """seconds 秒以内に期限が来る商品を期限順に返す（未登録ならNone）"""
+        with self._user_lock(user_id):
+            if not self._hydrate(user_id):
+                return None
+            return self._indexes[user_id].within(seconds, now)
+
+    def reset(self, user_id: str):
+        """ユーザーを登録し、在庫を空にする"""
+        with self._user_lock(user_id):
+            self._hydrate(user_id, register=True)
+            self._append(user_id, {"op": "reset"})
+
+    def add_product(self, user_id: str, product: dict):
+        """在庫に商品を1件追加する"""
+        with self._user_lock(user_id):
+            if not self._hydrate(user_id):
+                raise KeyError(f"未登録のユーザーです: {user_id}")
+            self._append(user_id, {"op": "add", "product": product})
+
+    def compact(self, user_id: str):
+        """変更をR2のスナップショットに反映し、ログを空にする"""
+        with self._user_lock(user_id):
+            if not self._pending.get(user_id):
+                return
+
+            # 商品のリストはコピーして渡す（書き出した後の追加がスナップショットやR2のキャッシュに混ざらないように）
+            state = self._users[user_id] or {"products": []}
+            snapshot = {**state, "products": list(state["products"]), "seq": self._seq[user_id]}
+            self.save_snapshot(user_id, snapshot)
+
+            # スナップショットに seq を含めているので、ここで止まっても復元時に二重に適用されない
+            with open(self._log_path(user_id), "w", encoding="utf-8"):
+                pass
+            self._pending[user_id] = 0
+
+    def compact_all(self):
+        for user_id in [u for u, pending in list(self._pending.items()) if pending]:
+            try:
+                self.compact(user_id)
+            except Exception as e:
+                logger.error("Inventory compaction error (%s): %s", user_id, e)
+
+    def start(self):
+        """定期的にコンパクションを行うスレッドを起動する"""
+        if self._thread is not None:
+            return
+        self._stopped.clear()
+        self._thread = threading.Thread(target=self._run, name="inventory-compaction", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """スレッドを止め、残っている変更を書き出す"""
+        self._stopped.set()
+        self._wakeup.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self.compact_all()
+
+    def _run(self):
+        while not self._stopped.is_set():
+            self._wakeup.wait(self.compact_interval)
+            self._wakeup.clear()
+            self.compact_all()
+
+    def _user_lock(self, user_id: str) -> threading.Lock:
+        return self._locks[hash(user_id) % LOCK_STRIPES]
+
+    def _log_path(self, user_id: str) -> str:
+        safe_id = re.sub(r"[^A-Za-z0-9_-]", "_", user_id)
+        return os.path.join(self.log_dir, f"{safe_id}.log")
+
+    def _hydrate(self, user_id: str, register: bool = False) -> bool:
+        """ユーザーの在庫をメモリに読み込み、登録済みかを返す
+
+        未登録のユーザーは register=True（これから登録する）のときだけ状態を持つ
+        """
+        if user_id in self._users:
+            return self._users[user_id] is not None
+        if not register:
+            with self._unregistered_lock:
+                if user_id in self._unregistered:
+                    self._unregistered.move_to_end(user_id)
+                    return False
+
+        snapshot = self.load_snapshot(user_id)
+        state = None
+        seq = 0
+        if snapshot is not None:
+            seq = snapshot.get("seq", 0)
+            state = {"products": list(snapshot.get("products", []))}
+
+        # スナップショットより新しい変更をログから再適用する
+        pending = 0
+        try:
+            with open(self._log_path(user_id), "rb+") as f:
+                data = f.read()
+                complete = data.rfind(b"\n") + 1
+                if complete < len(data):
+                    # 書き込み途中で止まった最後の行は捨てる
+                    f.truncate(complete)
+        except FileNotFoundError:
+            data = b""
+            complete = 0
+
+        for line in data[:complete].splitlines():
+            delta = json.loads(line)
+            if delta["seq"] <= seq:
+                continue
+            state = self._apply(state, delta)
+            seq = delta["seq"]
+            pending += 1
+
+        if state is None and not register:
+            with self._unregistered_lock:
+                self._unregistered[user_id] = True
+                if len(self._unregistered) > MAX_UNREGISTERED:
+                    self._unregistered.popitem(last=False)
+            return False
+
+        with self._unregistered_lock:
+            self._unregistered.pop(user_id, None)
+        self._users[user_id] = state
+        self._indexes[user_id] = ExpiryIndex(state["products"] if state is not None else None)
+        self._seq[user_id] = seq
+        self._pending[user_id] = pending
+        return state is not None
+
+    def _append(self, user_id: str, delta: dict):
+        delta["seq"] = self._seq[user_id] + 1
+        with open(self._log_path(user_id), "a", encoding="utf-8") as f:
+            f.write(json.dumps(delta, ensure_ascii=False) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+
+        self._users[user_id] = self._apply(self._users[user_id], delta)
+        if delta["op"] == "reset":
+            self._indexes[user_id] = ExpiryIndex()
+        elif delta["op"] == "add":
+            self._indexes[user_id].add(delta["product"])
+        self._seq[user_id] = delta["seq"]
+        self._pending[user_id] += 1
+        if self._pending[user_id] >= self.compact_every:
+            self._wakeup.set()
+
+        for listener in self._listeners:
+            try:
+                listener(user_id, delta)
+            except Exception as e:
+                logger.error("Inventory listener error (%s): %s", user_id, e)
+
+    @staticmethod
+    def _apply(state: Optional[dict], delta: dict) -> Optional[dict]:
+        if delta["op"] == "reset":
+            return {"products": []}
+        if delta["op"] == "add" and state is not None:
+            state["products"].append(delta["product"])
+        return state
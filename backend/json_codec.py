@@ -0,0 +1,46 @@
+import gzip
+
+import orjson
+
+try:
+    import zstandard
+except ImportError:  # zstdで保存する場合のみ必要
+    zstandard = None
+
+# R2に保存するJSONのエンコード・デコード
+# シリアライズには orjson を使い、JSON_COMPRESSION に応じて gzip / zstd で圧縮して保存する
+
+GZIP_MAGIC = b"\x1f\x8b"
+ZSTD_MAGIC = b"\x28\xb5\x2f\xfd"
+
+
+def dumps(data) -> bytes:
+    return orjson.dumps(data)
+
+
+def loads(body: bytes):
+    return orjson.loads(body)
+
+
+def encode(data, compression: str = "none") -> tuple:
+    """(保存するバイト列, Content-Encoding) を返す（圧縮しない場合は Content-Encoding はNone）"""
+    body = dumps(data)
+    if compression == "gzip":
+        return gzip.compress(body, compresslevel=6), "gzip"
+    if compression == "zstd":
+        if zstandard is None:
+            raise RuntimeError("zstdで保存するには zstandard パッケージが必要です")
+        return zstandard.ZstdCompressor().compress(body), "zstd"
+    return body, None
+
+
+def decode(body: bytes):
+    """保存されたバイト列をJSONとして読み込む（圧縮されていれば先頭のマジックナンバーで判別して展開する）"""
+    # HTTPクライアントが Content-Encoding を見て展開済みの場合もあるので、ヘッダーではなく中身で判別する
+    if body.startswith(GZIP_MAGIC):
+        body = gzip.decompress(body)
+    elif body.startswith(ZSTD_MAGIC):
+        if zstandard is None:
+            raise RuntimeError("zstdで保存されたJSONを読むには zstandard パッケージが必要です")
+        body = zstandard.ZstdDecompressor().decompress(body, max_output_size=64 * 1024 * 1024)
+    return loads(body)
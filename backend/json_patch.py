@@ -0,0 +1,146 @@
+import copy
+
+# /patch-json 用のパッチの適用
+# JSON Merge Patch（RFC 7396）と JSON Patch（RFC 6902）に対応する
+
+
+class JsonPatchError(ValueError):
+    pass
+
+
+class JsonPatchTestFailed(JsonPatchError):
+    pass
+
+
+def apply_merge_patch(target, patch):
+    """JSON Merge Patch を適用した新しいドキュメントを返す"""
+    if not isinstance(patch, dict):
+        return copy.deepcopy(patch)
+
+    result = dict(target) if isinstance(target, dict) else {}
+    for key, value in patch.items():
+        if value is None:
+            result.pop(key, None)
+        else:
+            result[key] = apply_merge_patch(result.get(key), value)
+    return result
+
+
+def _parse_pointer(pointer: str) -> list:
+    if pointer == "":
+        return []
+    if not pointer.startswith("/"):
+        raise JsonPatchError(f"不正なJSON Pointerです: {pointer}")
+    return [token.replace("~1", "/").replace("~0", "~") for token in pointer[1:].split("/")]
+
+
+def _array_index(container: list, token: str, allow_end: bool) -> int:
+    if token == "-" and allow_end:
+        return len(container)
+    if not token.isdigit() or (len(token) > 1 and token.startswith("0")):
+        raise JsonPatchError(f"不正な配列のインデックスです: {token}")
+    index = int(token)
+    if index > len(container) or (index == len(container) and not allow_end):
+        raise JsonPatchError(f"配列の範囲外です: {token}")
+    return index
+
+
+def _resolve_parent(document, tokens: list):
+    parent = document
+    for token in tokens[:-1]:
+        if isinstance(parent, dict):
+            if token not in parent:
+                raise JsonPatchError(f"パスが存在しません: {token}")
+            parent = parent[token]
+        elif isinstance(parent, list):
+            parent = parent[_array_index(parent, token, allow_end=False)]
+        else:
+            raise JsonPatchError(f"パスが存在しません: {token}")
+    return parent
+
+
+def _get(document, pointer: str):
+    tokens = _parse_pointer(pointer)
+    if not tokens:
+        return document
+    parent = _resolve_parent(document, tokens)
+    token = tokens[-1]
+    if isinstance(parent, dict):
+        if token not in parent:
+            raise JsonPatchError(f"パスが存在しません: {pointer}")
+        return parent[token]
+    if isinstance(parent, list):
+        return parent[_array_index(parent, token, allow_end=False)]
+    raise JsonPatchError(f"パスが存在しません: {pointer}")
+
+
+def _add(document, pointer: str, value):
+    tokens = _parse_pointer(pointer)
+    if not tokens:
+        return value
+    parent = _resolve_parent(document, tokens)
+    token = tokens[-1]
+    if isinstance(parent, dict):
+        parent[token] = value
+    elif isinstance(parent, list):
+        parent.insert(_array_index(parent, token, allow_end=True), value)
+    else:
+        raise JsonPatchError(f"パスが存在しません: {pointer}")
+    return document
+
+
+def _remove(document, pointer: str):
+    tokens = _parse_pointer(pointer)
+    if not tokens:
+        raise JsonPatchError("ドキュメント全体は削除できません")
+    parent = _resolve_parent(document, tokens)
+    token = tokens[-1]
+    if isinstance(parent, dict):
+        if token not in parent:
+            raise JsonPatchError(f"パスが存在しません: {pointer}")
+        return parent.pop(token)
+    if isinstance(parent, list):
+        return parent.pop(_array_index(parent, token, allow_end=False))
+    raise JsonPatchError(f"パスが存在しません: {pointer}")
+
+
+def apply_json_patch(document, operations: list):
+    """JSON Patch を適用した新しいドキュメントを返す（途中で失敗した場合は元のドキュメントは変更しない）"""
+    if not isinstance(operations, list):
+        raise JsonPatchError("JSON Patch は操作の配列で指定してください")
+
+    document = copy.deepcopy(document)
+    for operation in operations:
+        if not isinstance(operation, dict) or "op" not in operation or "path" not in operation:
+            raise JsonPatchError(f"不正な操作です: {operation}")
+
+        op = operation["op"]
+        path = operation["path"]
+        if op in ("add", "replace", "test") and "value" not in operation:
+            raise JsonPatchError(f"value が指定されていません: {operation}")
+        if op in ("move", "copy") and "from" not in operation:
+            raise JsonPatchError(f"from が指定されていません: {operation}")
+
+        if op == "add":
+            document = _add(document, path, copy.deepcopy(operation["value"]))
+        elif op == "remove":
+            _remove(document, path)
+        elif op == "replace":
+            _get(document, path)
+            if _parse_pointer(path):
+                _remove(document, path)
+            document = _add(document, path, copy.deepcopy(operation["value"]))
+        elif op == "move":
+            if path.startswith(operation["from"] + "/"):
+                raise JsonPatchError("自分自身の子には移動できません")
+            value = _remove(document, operation["from"])
+            document = _add(document, path, value)
+        elif op == "copy":
+            document = _add(document, path, copy.deepcopy(_get(document, operation["from"])))
+        elif op == "test":
+            if _get(document, path) != operation["value"]:
+                raise JsonPatchTestFailed(f"test に失敗しました: {path}")
+        else:
+            raise JsonPatchError(f"未対応の操作です: {op}")
+
+    return document
@@ -0,0 +1,29 @@
+import threading
+from typing import Callable
+
+# SDKのクライアントを最初に使うときに作る（SDKの import と初期化の時間を起動時に払わない）
+# 属性へのアクセスは作ったクライアントにそのまま渡すので、クライアントと同じように使える
+# スレッドプールから同時に使われても1回だけ作る
+
+
+class LazyClient:
+    def __init__(self, factory: Callable[[], object]):
+        self._factory = factory
+        self._client = None
+        self._lock = threading.Lock()
+
+    def get(self):
+        client = self._client
+        if client is None:
+            with self._lock:
+                if self._client is None:
+                    self._client = self._factory()
+                client = self._client
+        return client
+
+    @property
+    def created(self) -> bool:
+        return self._client is not None
+
+    def __getattr__(self, name: str):
+        return getattr(self.get(), name)
@@ -0,0 +1,154 @@
+import asyncio
+import json
+import logging
+import os
+import random
+
+import metrics
+import prompts
+from admission import BACKGROUND, INTERACTIVE, LINE, AdmissionController, AdmissionRejected
+from llm_router import Backend, BackendRouter
+
+# LLM呼び出しの共通レイヤー
+# /analyze・/suggest-menu・LINEの画像ハンドラーから共有して使う
+
+logger = logging.getLogger(__name__)
+
+LLM_MODEL = "gemma3:27b"
+
+# 同時にモデルへ投げるリクエスト数の上限
+LLM_CONCURRENCY = int(os.getenv("LLM_CONCURRENCY", "32"))
+
+
+def load_backends() -> list:
+    """LLM_BACKENDS（JSONの配列）からバックエンドを作る。無ければ OLLAMA_BASE_URL の1台だけ
+
+    例: [{"url": "http://gpu1:11434/v1", "models": ["gemma3:27b"]}, {"url": "http://gpu2:11434/v1"}]
+    """
+    config = os.getenv("LLM_BACKENDS")
+    if not config:
+        return [Backend(os.getenv("OLLAMA_BASE_URL", "https://ollama.yashikota.com/v1"))]
+    entries = json.loads(config)
+    return [
+        Backend(
+            entry["url"],
+            models=entry.get("models"),
+            api_key=entry.get("api_key", "ollama"), # required, but unused
+            name=entry.get("name"),
+            # 複数台のときは同じバックエンドでやり直さず、ルーターが別のバックエンドに送り直す
+            max_retries=0 if len(entries) > 1 else 2,
+        )
+        for entry in entries
+    ]
+
+
+router = BackendRouter(
+    load_backends(),
+    failure_threshold=int(os.getenv("LLM_FAILURE_THRESHOLD", "5")),
+    cooldown=float(os.getenv("LLM_CIRCUIT_COOLDOWN", "30")),
+    health_interval=float(os.getenv("LLM_HEALTH_INTERVAL", "10")),
+    hedge=os.getenv("LLM_HEDGE", "0") == "1",
+    # 起動時のウォームアップと、アイドル中にモデルがメモリから外されないようにする定期的なリクエスト
+    # （Ollamaはデフォルトで5分使われないモデルを外す）
+    warmup_request=(
+        {"model": LLM_MODEL, "messages": prompts.WARMUP_MESSAGES, "max_tokens": 1}
+        if os.getenv("LLM_WARMUP", "1") != "0" else None
+    ),
+    keepalive_interval=float(os.getenv("LLM_KEEPALIVE_INTERVAL", "240")),
+    cold_after=float(os.getenv("LLM_COLD_AFTER", "300")),
+)
+
+# 同時に送る数の上限・優先度のクラス・ユーザーごとの流量制限（呼び出し元は admission.caller() で設定する）
+admission_controller = AdmissionController(
+    capacity=LLM_CONCURRENCY,
+    max_queue=int(os.getenv("LLM_QUEUE_SIZE", "256")),
+    user_rate=float(os.getenv("LLM_USER_RATE", "1")),
+    user_burst=float(os.getenv("LLM_USER_BURST", "10")),
+    timeouts={
+        INTERACTIVE: float(os.getenv("LLM_TIMEOUT_INTERACTIVE", "30")),
+        LINE: float(os.getenv("LLM_TIMEOUT_LINE", "120")),
+        BACKGROUND: float(os.getenv("LLM_TIMEOUT_BACKGROUND", "300")),
+    },
+)
+
+
+def backoff_delay(attempt: int, base_delay: float = 1.0, max_delay: float = 8.0) -> float:
+    """attempt回目の失敗後に待つ秒数（指数バックオフ + ジッター）"""
+    delay = min(max_delay, base_delay * (2 ** attempt))
+    return delay / 2 + random.uniform(0, delay / 2)
+
+
+async def create_json_completion(
+    messages: list,
+    schema: dict,
+    max_retries: int = 1,
+    base_delay: float = 1.0,
+    max_delay: float = 8.0,
+) -> dict:
+    """JSON形式のレスポンスをモデルに要求し、パース済みの辞書を返す"""
+    last_error = None
+
+    for attempt in range(max_retries):
+        try:
+            async with admission_controller.slot(charge=attempt == 0):
+                response = await router.create(
+                    model=LLM_MODEL,
+                    messages=messages,
+                    response_format={
+                        "type": "json_object",
+                        "schema": schema
+                    }
+                )
+            with metrics.stage("llm_parse"):
+                return json.loads(response.choices[0].message.content)
+
+        except AdmissionRejected:
+            # 断られたらリトライせずに呼び出し元に返す（429/503）
+            raise
+        except Exception as e:
+            last_error = e
+            logger.warning("OpenAI API error (attempt %s/%s): %s", attempt + 1, max_retries, e)
+            if attempt + 1 < max_retries:
+                metrics.LLM_RETRIES.labels("completion").inc()
+                # 枠を返した状態で待つので、他のリクエストは進められる
+                await asyncio.sleep(backoff_delay(attempt, base_delay, max_delay))
+
+    raise last_error
+
+
+async def stream_json_completion(
+    messages: list,
+    schema: dict,
+    max_retries: int = 1,
+    base_delay: float = 1.0,
+    max_delay: float = 8.0,
+):
+    """JSON形式のレスポンスをストリーミングで要求し、届いたテキストを順に返す"""
+    for attempt in range(max_retries):
+        received = False
+        try:
+            # ストリーミングは途中で別のバックエンドに切り替えられないので hedge しない
+            async with admission_controller.slot(charge=attempt == 0), router.lease(LLM_MODEL) as backend:
+                stream = await backend.client.chat.completions.create(
+                    model=LLM_MODEL,
+                    messages=messages,
+                    response_format={
+                        "type": "json_object",
+                        "schema": schema
+                    },
+                    stream=True
+                )
+                async for chunk in stream:
+                    if not chunk.choices or not chunk.choices[0].delta.content:
+                        continue
+                    received = True
+                    yield chunk.choices[0].delta.content
+            return
+
+        except Exception as e:
+            # 途中まで返した後はやり直せないので、最初のトークンより前の失敗だけリトライする
+            if received or attempt + 1 >= max_retries or isinstance(e, AdmissionRejected):
+                raise
+            logger.warning("OpenAI API error (attempt %s/%s): %s", attempt + 1, max_retries, e)
+            metrics.LLM_RETRIES.labels("stream").inc()
+            await asyncio.sleep(backoff_delay(attempt, base_delay, max_delay))
@@ -0,0 +1,374 @@
+import asyncio
+import logging
+import random
+import time
+from collections import deque
+from contextlib import asynccontextmanager
+from typing import Iterable, Optional
+
+import metrics
+
+# 複数のOpenAI互換エンドポイント（Ollamaなど）への振り分け
+# - モデルごとに、そのモデルを提供しているバックエンドだけを候補にする
+# - 候補のうち処理中のリクエストが一番少ないバックエンドに送る
+# - 定期的に /models を呼んで死活を確認し、失敗が続いたバックエンドには一定時間送らない（サーキットブレーカー）
+# - バックエンドにつながらない・5xx の場合は、別のバックエンドに1回だけ送り直す
+# - hedge を有効にすると、p95 の時間を過ぎても返ってこないリクエストを別のバックエンドにも送り、早い方を使う
+# - 起動時に各バックエンドへ warmup_request を送ってモデルを読み込ませ、アイドルが続くと同じリクエストで起こし続ける
+#   （Ollamaは一定時間使われないモデルをメモリから外すので、次のリクエストが読み込み時間を払う）
+# - cold_after 秒以上使われていなかったバックエンドへのリクエストを cold、それ以外を warm としてレイテンシを分けて記録する
+# - openai パッケージは読み込みに時間がかかるので、起動時には読み込まず、クライアントは最初に使うときに作る
+#   （死活確認・ウォームアップのループは最初にスレッドで読み込んでおき、イベントループを止めない）
+
+logger = logging.getLogger(__name__)
+
+
+def load_sdk():
+    """openai パッケージを読み込む（イベントループの外から呼ぶ）"""
+    import openai  # noqa: F401
+
+
+def is_backend_failure(error: Exception) -> bool:
+    """バックエンドの不調とみなす失敗か（リクエストの内容が悪い 4xx は数えない）"""
+    import openai
+
+    if isinstance(error, openai.APIStatusError):
+        return error.status_code >= 500 or error.status_code == 429
+    return True
+
+
+class Backend:
+    def __init__(
+        self,
+        url: str,
+        models: Optional[Iterable[str]] = None,
+        api_key: str = "ollama",
+        name: Optional[str] = None,
+        max_retries: int = 2,
+    ):
+        self.url = url
+        self.name = name or url
+        # 設定で指定したモデル（無ければ死活確認で /models から取得したモデル、それも無ければ何でも送る）
+        self.models = set(models) if models else None
+        self.discovered = None
+        # max_retries はSDK内で同じバックエンドにやり直す回数（複数台のときは0にして別のバックエンドに回す）
+        self.api_key = api_key
+        self.max_retries = max_retries
+        self._client = None
+
+        self.outstanding = 0
+        self.latencies = deque(maxlen=200)
+        self.cold_latencies = deque(maxlen=200)
+        self.last_used = None
+        self.requests = 0
+        self.errors = 0
+
+        # サーキットブレーカー（open_until が 0 なら閉じている。過ぎていれば1件だけ試しに送る）
+        self.consecutive_failures = 0
+        self.open_until = 0.0
+        self.trial = False
+        # 死活確認の失敗で遮断したか（死活確認が成功して閉じてよいのはこのときだけ。
+        # リクエストの失敗で遮断した場合は、/models が応答していても試しに送った1件が成功するまで閉じない）
+        self.opened_by_health_check = False
+
+    @property
+    def client(self):
+        """このバックエンドの AsyncOpenAI クライアント（最初に使うときに作る）"""
+        if self._client is None:
+            from openai import AsyncOpenAI
+
+            self._client = AsyncOpenAI(base_url=self.url, api_key=self.api_key, max_retries=self.max_retries)
+        return self._client
+
+    async def close(self):
+        if self._client is not None:
+            await self._client.close()
+            self._client = None
+
+    def serves(self, model: str) -> bool:
+        models = self.models or self.discovered
+        return models is None or model in models
+
+    def available(self, now: float) -> bool:
+        if self.open_until == 0.0:
+            return True
+        return now >= self.open_until and not self.trial
+
+    def percentile(self, q: float, min_samples: int = 20, cold: bool = False) -> Optional[float]:
+        """warm（cold=True なら cold）のリクエストのレイテンシの q 分位点"""
+        latencies = self.cold_latencies if cold else self.latencies
+        if len(latencies) < min_samples:
+            return None
+        ordered = sorted(latencies)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * q))]
+
+    def state(self) -> str:
+        if self.open_until == 0.0:
+            return "closed"
+        return "open" if time.monotonic() < self.open_until else "half_open"
+
+
+class BackendRouter:
+    def __init__(
+        self,
+        backends: list,
+        failure_threshold: int = 5,
+        cooldown: float = 30.0,
+        health_interval: float = 10.0,
+        health_timeout: float = 5.0,
+        hedge: bool = False,
+        hedge_min_samples: int = 20,
+        warmup_request: Optional[dict] = None,
+        keepalive_interval: float = 0.0,
+        cold_after: float = 300.0,
+    ):
+        self.backends = backends
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self.health_interval = health_interval
+        self.health_timeout = health_timeout
+        self.hedge = hedge
+        self.hedge_min_samples = hedge_min_samples
+        # chat.completions.create に渡す引数（model を含む）
+        self.warmup_request = warmup_request
+        self.keepalive_interval = keepalive_interval
+        self.cold_after = cold_after
+        self.warmups = 0
+        self.hedged = 0
+        self.hedge_wins = 0
+        self.failovers = 0
+        self._health_task = None
+        self._keepalive_task = None
+
+    def pick(self, model: str, exclude: Iterable[Backend] = (), reserve: bool = True) -> Optional[Backend]:
+        """model を送るバックエンドを選ぶ（処理中のリクエストが一番少ないもの）"""
+        now = time.monotonic()
+        exclude = set(exclude)
+        candidates = [b for b in self.backends if b not in exclude and b.serves(model)]
+        ready = [b for b in candidates if b.available(now)]
+        if not ready:
+            if exclude or not candidates:
+                return None
+            # すべて遮断中でも、1つも送らないよりは一番早く復帰する予定のものに送る
+            return min(candidates, key=lambda b: b.open_until)
+
+        fewest = min(b.outstanding for b in ready)
+        backend = random.choice([b for b in ready if b.outstanding == fewest])
+        if reserve and backend.open_until != 0.0:
+            backend.trial = True
+        return backend
+
+    @asynccontextmanager
+    async def lease(self, model: str, exclude: Iterable[Backend] = ()):
+        """バックエンドを1つ選び、処理中の数・所要時間・成否を記録する"""
+        backend = self.pick(model, exclude)
+        if backend is None:
+            raise RuntimeError(f"モデル {model} を提供しているバックエンドがありません")
+        async with self.use(backend):
+            yield backend
+
+    @asynccontextmanager
+    async def use(self, backend: Backend):
+        """指定したバックエンドを使う間の処理中の数・所要時間・成否を記録する"""
+        backend.outstanding += 1
+        backend.requests += 1
+        started = time.monotonic()
+        cold = backend.last_used is None or started - backend.last_used >= self.cold_after
+        try:
+            yield backend
+        except asyncio.CancelledError:
+            # hedge で負けた側など、取り消しはバックエンドの失敗に数えない
+            metrics.LLM_REQUESTS.labels(backend.name, "cancelled").inc()
+            backend.trial = False
+            raise
+        except Exception as e:
+            if is_backend_failure(e):
+                metrics.LLM_REQUESTS.labels(backend.name, "failure").inc()
+                self._record_failure(backend)
+            else:
+                metrics.LLM_REQUESTS.labels(backend.name, "client_error").inc()
+                backend.trial = False
+            raise
+        else:
+            latency = time.monotonic() - started
+            metrics.LLM_REQUESTS.labels(backend.name, "success").inc()
+            metrics.LLM_REQUEST_LATENCY.labels(backend.name, "true" if cold else "false").observe(latency)
+            self._record_success(backend, latency, cold)
+        finally:
+            backend.outstanding -= 1
+            backend.last_used = time.monotonic()
+
+    async def create(self, **kwargs):
+        """chat.completions.create を呼ぶ（hedge が有効なら遅いときに別のバックエンドにも送る）"""
+        model = kwargs["model"]
+        tasks = []
+        # 最初のリクエストを送ったバックエンド（hedge では別のバックエンドを選ぶ）
+        leased = []
+        try:
+            first = asyncio.ensure_future(self._create_on(model, kwargs, leased))
+            tasks.append(first)
+            delay = self._hedge_delay(model) if self.hedge else None
+            if delay is None:
+                return await self._failover(model, kwargs, first, leased, tasks)
+
+            done, _ = await asyncio.wait({first}, timeout=delay)
+            if first in done or self.pick(model, exclude=leased, reserve=False) is None:
+                return await self._failover(model, kwargs, first, leased, tasks)
+
+            self.hedged += 1
+            second = asyncio.ensure_future(self._create_on(model, kwargs, [], exclude=leased))
+            tasks.append(second)
+            pending = {first, second}
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        if task is second:
+                            self.hedge_wins += 1
+                        return task.result()
+            # 両方とも失敗した場合は最初のリクエストの例外を返す
+            raise first.exception()
+        finally:
+            for task in tasks:
+                if not task.done():
+                    task.cancel()
+
+    async def _failover(self, model: str, kwargs: dict, first: asyncio.Future, leased: list, tasks: list):
+        try:
+            return await first
+        except Exception as e:
+            if not is_backend_failure(e) or self.pick(model, exclude=leased, reserve=False) is None:
+                raise
+            logger.warning("LLM backend failed, retrying on another backend: %s", e)
+            self.failovers += 1
+            retry = asyncio.ensure_future(self._create_on(model, kwargs, [], exclude=leased))
+            tasks.append(retry)
+            return await retry
+
+    async def start(self):
+        if self._health_task is None and self.health_interval > 0:
+            self._health_task = asyncio.create_task(self._health_loop())
+        if self._keepalive_task is None and self.warmup_request is not None:
+            self._keepalive_task = asyncio.create_task(self._keepalive_loop())
+
+    async def stop(self):
+        for task in (self._health_task, self._keepalive_task):
+            if task is not None:
+                task.cancel()
+                await asyncio.gather(task, return_exceptions=True)
+        self._health_task = None
+        self._keepalive_task = None
+        # 接続を閉じる（次に使うときはクライアントを作り直す）
+        await asyncio.gather(*(b.close() for b in self.backends))
+
+    async def warm_up(self, backend: Backend) -> bool:
+        """warmup_request を送り、モデルを読み込ませる"""
+        try:
+            async with self.use(backend):
+                await backend.client.chat.completions.create(**self.warmup_request)
+        except Exception as e:
+            logger.warning("LLM backend warm-up failed (%s): %s", backend.name, e)
+            return False
+        self.warmups += 1
+        return True
+
+    async def check(self, backend: Backend) -> bool:
+        """/models を呼んで死活を確認する（提供しているモデルの一覧も更新する）"""
+        try:
+            result = await asyncio.wait_for(
+                backend.client.with_options(max_retries=0).models.list(),
+                self.health_timeout,
+            )
+        except Exception as e:
+            logger.warning("LLM backend health check failed (%s): %s", backend.name, e)
+            if backend.open_until == 0.0 or backend.opened_by_health_check:
+                backend.opened_by_health_check = True
+            backend.open_until = time.monotonic() + self.cooldown
+            backend.trial = False
+            return False
+
+        backend.discovered = {m.id for m in result.data} or None
+        if backend.opened_by_health_check:
+            backend.consecutive_failures = 0
+            backend.open_until = 0.0
+            backend.trial = False
+            backend.opened_by_health_check = False
+        return True
+
+    def stats(self) -> dict:
+        return {
+            "hedged": self.hedged,
+            "hedge_wins": self.hedge_wins,
+            "failovers": self.failovers,
+            "warmups": self.warmups,
+            "backends": [
+                {
+                    "name": b.name,
+                    "state": b.state(),
+                    "outstanding": b.outstanding,
+                    "requests": b.requests,
+                    "errors": b.errors,
+                    "p50": b.percentile(0.5, 1),
+                    "p95": b.percentile(0.95, 1),
+                    "cold_requests": len(b.cold_latencies),
+                    "cold_p50": b.percentile(0.5, 1, cold=True),
+                    "cold_max": max(b.cold_latencies, default=None),
+                    "models": sorted(b.models or b.discovered or []),
+                }
+                for b in self.backends
+            ],
+        }
+
+    async def _create_on(self, model: str, kwargs: dict, leased: list, exclude: Iterable[Backend] = ()):
+        async with self.lease(model, exclude) as backend:
+            leased.append(backend)
+            return await backend.client.chat.completions.create(**kwargs)
+
+    def _hedge_delay(self, model: str) -> Optional[float]:
+        # 候補のバックエンドの p95 のうち一番短いものを待ち時間にする（実績が少ないうちは hedge しない）
+        delays = [
+            b.percentile(0.95, self.hedge_min_samples)
+            for b in self.backends
+            if b.serves(model)
+        ]
+        delays = [d for d in delays if d is not None]
+        return min(delays) if delays and len(self.backends) > 1 else None
+
+    def _record_success(self, backend: Backend, latency: float, cold: bool = False):
+        (backend.cold_latencies if cold else backend.latencies).append(latency)
+        backend.consecutive_failures = 0
+        backend.open_until = 0.0
+        backend.trial = False
+        backend.opened_by_health_check = False
+
+    def _record_failure(self, backend: Backend):
+        backend.errors += 1
+        backend.consecutive_failures += 1
+        if backend.open_until != 0.0 or backend.consecutive_failures >= self.failure_threshold:
+            backend.open_until = time.monotonic() + self.cooldown
+            backend.opened_by_health_check = False
+            logger.warning("LLM backend circuit opened (%s)", backend.name)
+        backend.trial = False
+
+    async def _health_loop(self):
+        await asyncio.to_thread(load_sdk)
+        while True:
+            await asyncio.gather(*(self.check(b) for b in self.backends))
+            await asyncio.sleep(self.health_interval)
+
+    async def _keepalive_loop(self):
+        # 起動時にすべてのバックエンドを温め、その後はアイドルが keepalive_interval 秒続いたものだけ起こす
+        model = self.warmup_request["model"]
+        await asyncio.to_thread(load_sdk)
+        await asyncio.gather(*(self.warm_up(b) for b in self.backends if b.serves(model)))
+        if self.keepalive_interval <= 0:
+            return
+        while True:
+            await asyncio.sleep(self.keepalive_interval / 2)
+            now = time.monotonic()
+            idle = [
+                b for b in self.backends
+                if b.serves(model) and b.available(now) and b.outstanding == 0
+                and (b.last_used is None or now - b.last_used >= self.keepalive_interval)
+            ]
+            await asyncio.gather(*(self.warm_up(b) for b in idle))
@@ -0,0 +1,29 @@
+import atexit
+import logging
+import logging.handlers
+import os
+import queue
+
+# ログの出力をリクエストの処理から切り離す
+# ロガーはキューに積むだけで、書式化と標準出力への書き込みは専用のスレッド（QueueListener）が行う
+
+_listener = None
+
+
+def setup_logging():
+    global _listener
+    if _listener is not None:
+        return
+
+    handler = logging.StreamHandler()
+    handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(name)s: %(message)s"))
+
+    log_queue = queue.SimpleQueue()
+    root = logging.getLogger()
+    root.addHandler(logging.handlers.QueueHandler(log_queue))
+    root.setLevel(os.getenv("LOG_LEVEL", "INFO").upper())
+
+    _listener = logging.handlers.QueueListener(log_queue, handler, respect_handler_level=True)
+    _listener.start()
+    # 終了時にキューに残っているログを書き出す
+    atexit.register(_listener.stop)
@@ -1,24 +1,127 @@
-from pydantic import BaseModel
-from minio import Minio
+from pydantic import BaseModel, ValidationError
 import os
+import io
+import time
+import logging
 import uuid
+import asyncio
+import weakref
+import heapq
+import hmac
+import hashlib
+import threading
+from contextlib import asynccontextmanager
 from dotenv import load_dotenv
 import json
 from fastapi import FastAPI, UploadFile, File, HTTPException, Request
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import StreamingResponse, Response
 import uvicorn
-import tempfile
 import base64
-from openai import OpenAI
 from typing import List, Optional
-from linebot import LineBotApi, WebhookHandler
-from linebot.exceptions import InvalidSignatureError
-from linebot.models import MessageEvent, TextMessage, TextSendMessage, ImageMessage
+from anyio import from_thread
+from fastapi.concurrency import run_in_threadpool
+import llm
+import admission
+from image_cache import ImageResultCache, content_hash
+from singleflight import SingleFlight
+from inventory import InventoryStore
+from webhook_queue import WebhookWorkerPool, QueueFullError
+from expiry_index import expiration_key
+from document_cache import DocumentCache, parse_etags
+from json_patch import apply_json_patch, apply_merge_patch, JsonPatchError, JsonPatchTestFailed
+import json_codec
+import prompts
+from image_preprocess import preprocess_image, crop_image
+from menu_stream import MenuStreamParser
+from menu_cache import MenuCache, menu_cache_key
+from menu_precompute import MenuPrecomputer
+from recipe_index import RecipeIndex, GeneratedRecipeCache, generated_recipe_key, RECIPE_FIELDS, missing_fields
+from expiry_alerts import ExpiryAlertScheduler, batch_summary
+from lazy_client import LazyClient
+from logs import setup_logging
+import metrics
 
 # 環境変数の読み込み
 load_dotenv()
 
-app = FastAPI()
+# ログはキュー経由で別スレッドから出力する（リクエストの処理をログの書き込みで待たせない）
+setup_logging()
+logger = logging.getLogger(__name__)
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # 起動時：在庫のコンパクション用スレッドとLINEのワーカー、モデルのバックエンドの死活確認、期限の通知を起動
+    inventory.start()
+    if EXPIRY_ALERTS:
+        expiry_alerts.start()
+    await line_events.start()
+    await llm.router.start()
+    yield
+    # 終了時：キューに残っているLINEのイベントを処理し、在庫の変更をR2に書き出す
+    await line_events.stop()
+    await menu_precompute.stop()
+    await llm.router.stop()
+    await run_in_threadpool(expiry_alerts.stop)
+    await run_in_threadpool(inventory.stop)
+
+app = FastAPI(lifespan=lifespan)
+
+@app.middleware("http")
+async def record_request_latency(request: Request, call_next):
+    # ルートごとの処理時間（ストリーミングのレスポンスはヘッダーを返すまでの時間）
+    started = time.perf_counter()
+    status = 500
+    try:
+        response = await call_next(request)
+        status = response.status_code
+        return response
+    finally:
+        route = request.scope.get("route")
+        metrics.REQUEST_LATENCY.labels(
+            request.method, route.path if route is not None else "unmatched", str(status)
+        ).observe(time.perf_counter() - started)
+
+# X-User-Id ヘッダーの署名の鍵（Next.js のサーバーと共有する。X-User-Signature に X-User-Id の HMAC-SHA256 を16進数で付ける）
+# 設定しなければ X-User-Id は信用せず、署名の無いリクエストと同じ扱いにする
+USER_ID_SECRET = os.getenv("USER_ID_SECRET")
+
+# X-User-Id を確かめられないリクエストを、クライアントのIPごとに流量制限するか
+# Webからのリクエストはすべて Next.js のサーバーを経由して同じIPから届くので、デフォルトではまとめて1人として制限する
+LLM_RATE_LIMIT_BY_IP = os.getenv("LLM_RATE_LIMIT_BY_IP", "0") == "1"
+
+# X-User-Id を確かめられないリクエストをまとめて数えるときのユーザー
+ANONYMOUS_USER = "anonymous"
+
+def verified_user_id(request: Request) -> Optional[str]:
+    """Next.js のサーバーが署名した X-User-Id を返す（署名が無い・合わなければ None）"""
+    user = request.headers.get("X-User-Id")
+    signature = request.headers.get("X-User-Signature")
+    if not USER_ID_SECRET or not user or not signature:
+        return None
+    expected = hmac.new(USER_ID_SECRET.encode(), user.encode(), hashlib.sha256).hexdigest()
+    return user if hmac.compare_digest(signature, expected) else None
+
+@app.middleware("http")
+async def set_admission_caller(request: Request, call_next):
+    # Webからのリクエストのモデル呼び出しは対話的なクラスとして優先し、署名付きの X-User-Id ごとに流量を制限する
+    # （確かめられなければ、LLM_RATE_LIMIT_BY_IP のときはクライアントのIPごと、それ以外はまとめて1人として制限する）
+    user = verified_user_id(request)
+    if user is None:
+        if LLM_RATE_LIMIT_BY_IP and request.client:
+            user = f"ip:{request.client.host}"
+        else:
+            user = ANONYMOUS_USER
+    with admission.caller(admission.INTERACTIVE, user):
+        return await call_next(request)
+
+def admission_error(e: admission.AdmissionRejected) -> HTTPException:
+    # 流量制限は429、混雑は503で、いつ再送すればよいかを Retry-After で返す
+    if e.status == 429:
+        detail = "リクエストが多すぎます。しばらくしてから再度お試しください"
+    else:
+        detail = "混み合っています。しばらくしてから再度お試しください"
+    return HTTPException(status_code=e.status, detail=detail, headers={"Retry-After": e.retry_after_header()})
 
 # CORSの設定
 app.add_middleware(
@@ -29,17 +132,61 @@ app.add_middleware(
     allow_headers=["*"],  # すべてのヘッダーを許可
 )
 
-client = OpenAI(
-    base_url = 'https://ollama.yashikota.com/v1',
-    api_key='ollama', # required, but unused
+# LINE Botの設定（LINE_API_ENDPOINT でベンチマーク用のスタブサーバーに向けられる）
+# SDKの読み込みとクライアントの作成は、最初にLINEのイベントを受け取るまで行わない
+def create_line_bot_api():
+    from linebot import LineBotApi
+
+    return LineBotApi(
+        os.getenv("CHANNEL_ID"),
+        endpoint=os.getenv("LINE_API_ENDPOINT", "https://api.line.me"),
+        data_endpoint=os.getenv("LINE_API_ENDPOINT", "https://api-data.line.me"),
+    )
+
+def create_webhook_parser():
+    from linebot import WebhookParser
+
+    return WebhookParser(os.getenv("CHANNEL_SECRET"))
+
+line_bot_api = LazyClient(create_line_bot_api)
+parser = LazyClient(create_webhook_parser)
+
+
+# 同じ入力に対する実行中のモデル呼び出しをまとめる
+llm_flights = SingleFlight()
+
+# 画像解析結果のキャッシュ（同じ画像ならR2へのアップロードとモデル呼び出しを省略する）
+image_cache = ImageResultCache(
+    max_entries=int(os.getenv("IMAGE_CACHE_SIZE", "1024")),
+    ttl=float(os.getenv("IMAGE_CACHE_TTL", str(7 * 24 * 60 * 60))),
+    disk_dir=os.getenv("IMAGE_CACHE_DIR") or None,
+    use_phash=os.getenv("IMAGE_CACHE_PHASH", "0") == "1",
+    phash_distance=int(os.getenv("IMAGE_CACHE_PHASH_DISTANCE", "4")),
 )
 
-# LINE Botの設定
-line_bot_api = LineBotApi(os.getenv("CHANNEL_ID"))
-handler = WebhookHandler(os.getenv("CHANNEL_SECRET"))
+# 複数商品モード（/analyze-multi）の解析結果のキャッシュ
+multi_image_cache = ImageResultCache(
+    max_entries=int(os.getenv("IMAGE_CACHE_SIZE", "1024")),
+    ttl=float(os.getenv("IMAGE_CACHE_TTL", str(7 * 24 * 60 * 60))),
+    disk_dir=os.path.join(os.getenv("IMAGE_CACHE_DIR"), "multi") if os.getenv("IMAGE_CACHE_DIR") else None,
+    use_phash=os.getenv("IMAGE_CACHE_PHASH", "0") == "1",
+    phash_distance=int(os.getenv("IMAGE_CACHE_PHASH_DISTANCE", "4")),
+)
+
+# 複数商品モードで、確信度がこの値未満の商品は切り出して解析し直す（最大 MULTI_MAX_REFINE 件）
+MULTI_REFINE_THRESHOLD = float(os.getenv("MULTI_REFINE_THRESHOLD", "0.5"))
+MULTI_MAX_REFINE = int(os.getenv("MULTI_MAX_REFINE", "3"))
 
-# ユーザーIDとJSONデータを保存する辞書
-user_data = {}
+# 献立提案のキャッシュ（同じ食材の組み合わせに対して MENU_CACHE_VARIANTS 通りの献立を順番に返す）
+menu_cache = MenuCache(
+    max_entries=int(os.getenv("MENU_CACHE_SIZE", "1024")),
+    ttl=float(os.getenv("MENU_CACHE_TTL", str(24 * 60 * 60))),
+    variants=int(os.getenv("MENU_CACHE_VARIANTS", "3")),
+)
+
+# /analyze-batch の設定（1リクエストあたりの並列数と画像枚数の上限）
+BATCH_CONCURRENCY = int(os.getenv("BATCH_CONCURRENCY", "4"))
+BATCH_MAX_FILES = int(os.getenv("BATCH_MAX_FILES", "20"))
 
 class ProductInfo(BaseModel):
     name: str
@@ -50,8 +197,17 @@ class ProductInfo(BaseModel):
     unit: str
     category: str
 
+def validate_product(product: dict) -> Optional[dict]:
+    """モデルが返した商品を ProductInfo として検証し、その項目だけの辞書を返す（項目が足りない・型が違えばNone）"""
+    try:
+        return ProductInfo(**{key: product.get(key) for key in ProductInfo.model_fields}).model_dump()
+    except ValidationError:
+        return None
+
 class MenuRequest(BaseModel):
-    products: List[ProductInfo]
+    # products の代わりに user_id を渡すと、サーバー側の在庫から期限が近い食材を選ぶ
+    products: Optional[List[ProductInfo]] = None
+    user_id: Optional[str] = None
 
 class MenuResponse(BaseModel):
     title: str
@@ -59,8 +215,11 @@ class MenuResponse(BaseModel):
     indication: str
 
 class RecipeRequest(BaseModel):
-    menu_name: str
+    menu_name: Optional[str] = None
     category: Optional[str] = None
+    # 使いたい食材（user_id を渡すとサーバー側の在庫から期限が近い食材を使う）
+    ingredients: Optional[List[str]] = None
+    user_id: Optional[str] = None
 
 class RecipeResponse(BaseModel):
     title: str
@@ -75,296 +234,791 @@ class UploadJsonRequest(BaseModel):
     id: str
     data: dict
 
-# MinIOクライアントの設定
-minio_client = Minio(
-    "d0e701f84b51921572cb3d46b9ad038a.r2.cloudflarestorage.com",
-    access_key=os.getenv("ACCESS_KEY"),
-    secret_key=os.getenv("SECRET_KEY"),
-    secure=True
-)
+# 画像解析でモデルに要求するJSONスキーマ
+PRODUCT_INFO_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "name": {"type": "string"},
+        "expiration_date": {"type": "string"},
+        "expiration_type": {"type": "string", "enum": ["best_before", "use_by"]},
+        "image_url": {"type": "string"},
+        "amount": {"type": "number"},
+        "unit": {"type": "string"},
+        "category": {"type": "string"}
+    },
+    "required": ["name", "expiration_date", "expiration_type", "image_url", "amount", "unit", "category"]
+}
+
+# 献立提案でモデルに要求するJSONスキーマ
+MENU_RESPONSE_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "title": {"type": "string"},
+        "ingredients": {
+            "type": "array",
+            "items": {"type": "string"}
+        },
+        "indication": {"type": "string"}
+    },
+    "required": ["title", "ingredients", "indication"]
+}
+
+# レシピのJSONスキーマ（url はモデルに作らせない）
+RECIPE_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "title": {"type": "string"},
+        "ingredients": {
+            "type": "array",
+            "items": {"type": "string"}
+        },
+        "instructions": {
+            "type": "array",
+            "items": {"type": "string"}
+        },
+        "difficulty": {"type": "string"},
+        "cooking_time": {"type": "string"},
+        "servings": {"type": "integer"}
+    },
+    "required": RECIPE_FIELDS
+}
+
+# 複数商品モードのJSONスキーマ（商品ごとに確信度と位置を返させる）
+MULTI_PRODUCT_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "products": {
+            "type": "array",
+            "items": {
+                "type": "object",
+                "properties": {
+                    **PRODUCT_INFO_SCHEMA["properties"],
+                    "confidence": {"type": "number"},
+                    "bbox": {
+                        "type": "array",
+                        "items": {"type": "number"}
+                    }
+                },
+                "required": PRODUCT_INFO_SCHEMA["required"] + ["confidence", "bbox"]
+            }
+        }
+    },
+    "required": ["products"]
+}
+
+# R2への同時接続数（R2はスレッドプールから使うので、その上限の40に合わせる）
+R2_POOL_SIZE = int(os.getenv("R2_POOL_SIZE", "40"))
+
+# MinIOクライアントの設定（R2_ENDPOINT でベンチマーク用のスタブサーバーなどに向けられる）
+# SDKの読み込みとクライアントの作成は、最初にR2を使うときまで行わない
+def create_minio_client():
+    import certifi
+    import urllib3
+    from minio import Minio
+
+    # MinIOのデフォルトの接続プールは10本なので、同時に使うスレッドが多いと接続が捨てられて毎回TLSの接続からやり直しになる
+    http_client = urllib3.PoolManager(
+        maxsize=R2_POOL_SIZE,
+        timeout=300,
+        cert_reqs="CERT_REQUIRED",
+        ca_certs=os.getenv("SSL_CERT_FILE") or certifi.where(),
+        retries=urllib3.Retry(total=5, backoff_factor=0.2, status_forcelist=[500, 502, 503, 504]),
+    )
+    return Minio(
+        os.getenv("R2_ENDPOINT", "d0e701f84b51921572cb3d46b9ad038a.r2.cloudflarestorage.com"),
+        access_key=os.getenv("ACCESS_KEY"),
+        secret_key=os.getenv("SECRET_KEY"),
+        secure=os.getenv("R2_SECURE", "1") != "0",
+        http_client=http_client
+    )
+
+minio_client = LazyClient(create_minio_client)
 
-def upload_to_r2(file_path: str) -> str:
+def upload_to_r2(content: bytes, file_extension: str = ".jpg", content_type: str = "image/jpeg") -> str:
     # ファイル名を生成
-    file_extension = os.path.splitext(file_path)[1]
     object_name = f"{uuid.uuid4()}{file_extension}"
 
-    # R2にアップロード
-    minio_client.fput_object(
-        "ai-hackathon",
-        object_name,
-        file_path
-    )
+    # メモリ上のデータをそのままR2にアップロード
+    with metrics.stage("r2_upload"):
+        minio_client.put_object(
+            "ai-hackathon",
+            object_name,
+            io.BytesIO(content),
+            len(content),
+            content_type=content_type
+        )
 
     # URLを生成
     url = f"https://pub-7444760b0415482ba8f55298c08a442b.r2.dev/{object_name}"
     return url
 
+def upload_json_to_r2(object_name: str, data: dict) -> str:
+    # JSONをメモリ上でエンコード（JSON_COMPRESSION に応じて圧縮）してR2にアップロード
+    json_data, content_encoding = json_codec.encode(data, JSON_COMPRESSION)
+    with metrics.stage("r2_write"):
+        result = minio_client.put_object(
+            "ai-hackathon",
+            object_name,
+            io.BytesIO(json_data),
+            len(json_data),
+            content_type="application/json",
+            metadata={"Content-Encoding": content_encoding} if content_encoding else None
+        )
+
+    # /get-json のキャッシュも書き込んだ内容に更新する
+    document_cache.put(object_name, result.etag, data)
+    return result.etag
+
+def read_json_document(object_name: str, revalidate: bool = False) -> tuple:
+    # R2のJSONを (etag, data) で返す（ETagが変わっていなければキャッシュを使う）
+    cached = document_cache.get(object_name)
+    if cached is not None:
+        etag, data, fresh = cached
+        if fresh and not revalidate:
+            metrics.cache_result("document", True)
+            return etag, data
+
+        # 中身はダウンロードせず、ETagだけ確認する
+        try:
+            with metrics.stage("r2_stat"):
+                stat = minio_client.stat_object("ai-hackathon", object_name)
+        except Exception:
+            document_cache.invalidate(object_name)
+            raise
+        if stat.etag == etag:
+            metrics.cache_result("document", True)
+            document_cache.touch(object_name)
+            return etag, data
+
+    metrics.cache_result("document", False)
+    with metrics.stage("r2_read"):
+        response = minio_client.get_object("ai-hackathon", object_name)
+        try:
+            data = json_codec.decode(response.read())
+            etag = response.headers.get("ETag", "").strip('"')
+        finally:
+            response.close()
+            response.release_conn()
+
+    document_cache.put(object_name, etag, data)
+    return etag, data
+
+def load_json_from_r2(object_name: str) -> Optional[dict]:
+    # R2からJSONを読み込む（存在しなければNone）
+    try:
+        return read_json_document(object_name)[1]
+    except Exception as e:
+        if "NoSuchKey" in str(e):
+            return None
+        raise
+
+# R2に保存するJSONの圧縮方式（none / gzip / zstd）
+JSON_COMPRESSION = os.getenv("JSON_COMPRESSION", "none")
+
+# /get-json で返すJSONのキャッシュ（R2のETagで検証する）
+document_cache = DocumentCache(
+    max_entries=int(os.getenv("JSON_CACHE_SIZE", "1024")),
+    revalidate_after=float(os.getenv("JSON_CACHE_REVALIDATE", "2")),
+)
+
+def save_inventory_snapshot(object_name: str, snapshot: dict):
+    # /patch-json の読み込みから書き込みまでの間に割り込んで、どちらかの書き込みが消えないようにする
+    with document_write_lock(object_name):
+        upload_json_to_r2(object_name, snapshot)
+
+# LINEユーザーの在庫（追記専用ログ + R2の {user_id}.json へのスナップショット）
+inventory = InventoryStore(
+    log_dir=os.getenv("INVENTORY_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "inventory")),
+    load_snapshot=lambda user_id: load_json_from_r2(f"{user_id}.json"),
+    save_snapshot=lambda user_id, snapshot: save_inventory_snapshot(f"{user_id}.json", snapshot),
+    compact_every=int(os.getenv("INVENTORY_COMPACT_EVERY", "100")),
+    compact_interval=float(os.getenv("INVENTORY_COMPACT_INTERVAL", "60")),
+)
+
+async def request_vision_json(image: bytes, prompt: str, schema: dict) -> dict:
+    # モデル用に縮小・再エンコードした画像をbase64エンコード
+    with metrics.stage("preprocess"):
+        model_image = await run_in_threadpool(preprocess_image, image)
+    with metrics.stage("base64"):
+        base64_image = base64.b64encode(model_image).decode('utf-8')
+
+    with metrics.stage("llm_vision"):
+        return await llm.create_json_completion(
+            messages=prompts.vision_messages(prompt, f"data:image/jpeg;base64,{base64_image}"),
+            schema=schema
+        )
+
+async def upload_and_request_vision_json(content: bytes, prompt: str, schema: dict, content_type: str) -> tuple:
+    # R2には元の画像をアップロードし、モデル呼び出しと並行させる
+    return await asyncio.gather(
+        run_in_threadpool(upload_to_r2, content, ".jpg", content_type),
+        request_vision_json(content, prompt, schema)
+    )
+
+async def analyze_product_image(content: bytes, prompt: str, content_type: str = "image/jpeg") -> dict:
+    image_url, result = await upload_and_request_vision_json(content, prompt, PRODUCT_INFO_SCHEMA, content_type)
+
+    # 画像URLを設定
+    result["image_url"] = image_url
+    return result
+
+async def refine_product(content: bytes, product: dict) -> dict:
+    # 確信度が低い商品は、その部分を切り出して単品モードで解析し直す
+    crop = await run_in_threadpool(crop_image, content, product.get("bbox"))
+    if crop is None:
+        return product
+
+    try:
+        refined = await request_vision_json(crop, prompts.ANALYZE_PROMPT, PRODUCT_INFO_SCHEMA)
+    except Exception as e:
+        logger.warning("Refine error: %s", e)
+        return product
+
+    return {**product, **refined}
+
+def product_confidence(product: dict) -> float:
+    # 確信度が数値でなければ、確信度が低いものとして扱う
+    try:
+        return float(product.get("confidence", 1.0))
+    except (TypeError, ValueError):
+        return 0.0
+
+async def analyze_multi_product_image(content: bytes, content_type: str = "image/jpeg") -> List[dict]:
+    image_url, result = await upload_and_request_vision_json(content, prompts.MULTI_ANALYZE_PROMPT, MULTI_PRODUCT_SCHEMA, content_type)
+    products = [p for p in result.get("products", []) if isinstance(p, dict)]
+
+    # 項目が足りない商品と確信度が低い商品を、最大 MULTI_MAX_REFINE 件だけ解析し直す（項目が足りないものを先に）
+    def needs_refine(product: dict) -> bool:
+        return validate_product({**product, "image_url": image_url}) is None or product_confidence(product) < MULTI_REFINE_THRESHOLD
+
+    targets = sorted(
+        (i for i, p in enumerate(products) if p.get("bbox") and needs_refine(p)),
+        key=lambda i: (validate_product({**products[i], "image_url": image_url}) is not None, product_confidence(products[i]))
+    )[:MULTI_MAX_REFINE]
+    refined = await asyncio.gather(*(refine_product(content, products[i]) for i in targets))
+    for i, product in zip(targets, refined):
+        products[i] = product
+
+    # ProductInfo として正しい商品だけを返す（解析し直しても項目が足りないものは捨てる）
+    valid = [validate_product({**product, "image_url": image_url}) for product in products]
+    if None in valid:
+        logger.warning("Multi analyze: dropped %s invalid products", valid.count(None))
+    return [product for product in valid if product is not None]
+
+async def analyze_uploaded_image(content: bytes, content_type: str) -> dict:
+    # 同じ画像の解析結果があればそれを返す
+    with metrics.stage("image_cache"):
+        cached = await run_in_threadpool(image_cache.get, content)
+    metrics.cache_result("image", cached is not None)
+    if cached is not None:
+        return cached
+
+    async def analyze():
+        logger.debug("Sending request to OpenAI API...")
+        result = await analyze_product_image(content, prompts.ANALYZE_PROMPT, content_type)
+        logger.debug("Parsed result: %s", result)
+
+        await run_in_threadpool(image_cache.put, content, result)
+        return result
+
+    # 同じ画像の解析が実行中ならその結果を待つ
+    return await llm_flights.do(("analyze", content_hash(content)), analyze)
+
 @app.post("/analyze")
 async def analyze_image(file: UploadFile = File(...)):
     if not file.content_type.startswith('image/'):
         raise HTTPException(status_code=400, detail="画像ファイルをアップロードしてください")
 
-    # 一時ファイルを作成
-    with tempfile.NamedTemporaryFile(suffix='.jpg', delete=False) as temp_file:
-        try:
-            # アップロードされたファイルの内容を一時ファイルに書き込み
-            content = await file.read()
-            temp_file.write(content)
-            temp_file_path = temp_file.name
+    with metrics.stage("upload_read"):
+        content = await file.read()
 
-            # R2にアップロードしてURLを取得
-            image_url = upload_to_r2(temp_file_path)
+    try:
+        return await analyze_uploaded_image(content, file.content_type)
 
-            # 画像をbase64エンコード
-            with open(temp_file_path, 'rb') as image_file:
-                base64_image = base64.b64encode(image_file.read()).decode('utf-8')
+    except admission.AdmissionRejected as e:
+        raise admission_error(e)
+    except Exception as e:
+        logger.error("Error in image processing: %s", e)
+        raise HTTPException(status_code=500, detail=f"画像処理エラー: {str(e)}")
 
-            # OpenAIクライアントを使用してリクエストを送信
-            try:
-                print("Sending request to OpenAI API...")
-                response = client.chat.completions.create(
-                    model="gemma3:27b",
-                    messages=[
-                        {
-                            "role": "user",
-                            "content": [
-                                {
-                                    "type": "text",
-                                    "text": "この写真から以下の情報をJSON形式で出力してください：\n"
-                                    "1. 商品名 (日本語で)\n"
-                                    "2. 賞味期限または消費期限（ISO 8601形式で）\n"
-                                    "   - 日付の解釈に注意してください。例えば「25.4.28」は「2025年4月28日」と解釈してください\n"
-                                    "   - 年が2桁で表記されている場合は、2000年代として解釈してください\n"
-                                    "   - 時間が記載されている場合は、その時間も含めて出力してください（例：2025-04-28T14:30:00Z）\n"
-                                    "   - 時間が記載されていない場合は、00:00:00として出力してください\n"
-                                    "   - 賞味期限と消費期限を区別して認識してください\n"
-                                    "   - 賞味期限の場合は「best_before」、消費期限の場合は「use_by」として出力してください\n"
-                                    "   - 区別ができない場合は「best_before」として出力してください\n"
-                                    "3. 画像URL（空文字列で構いません）\n"
-                                    "4. 分量（数値のみ、単位は含めない。例：300、1.5、500など）\n"
-                                    "5. 単位（以下のいずれかから選択）：\n"
-                                    "   - g\n"
-                                    "   - kg\n"
-                                    "   - ml\n"
-                                    "   - L\n"
-                                    "   - 個\n"
-                                    "   - 枚\n"
-                                    "   - 本\n"
-                                    "6. 分類（以下のいずれかから選択）：\n"
-                                    "   - 肉\n"
-                                    "   - 野菜\n"
-                                    "   - 魚\n"
-                                    "   - 調味料\n"
-                                    "   - お菓子\n"
-                                    "   - 飲料\n"
-                                    "   - その他\n"
-                                    "JSONのキーは以下の通りです：\n"
-                                    "- name\n"
-                                    "- expiration_date\n"
-                                    "- expiration_type\n"
-                                    "- image_url\n"
-                                    "- amount\n"
-                                    "- unit\n"
-                                    "- category"
-                                },
-                                {
-                                    "type": "image_url",
-                                    "image_url": {
-                                        "url": f"data:image/jpeg;base64,{base64_image}"
-                                    }
-                                }
-                            ]
-                        }
-                    ],
-                    response_format={
-                        "type": "json_object",
-                        "schema": {
-                            "type": "object",
-                            "properties": {
-                                "name": {"type": "string"},
-                                "expiration_date": {"type": "string"},
-                                "expiration_type": {"type": "string", "enum": ["best_before", "use_by"]},
-                                "image_url": {"type": "string"},
-                                "amount": {"type": "number"},
-                                "unit": {"type": "string"},
-                                "category": {"type": "string"}
-                            },
-                            "required": ["name", "expiration_date", "expiration_type", "image_url", "amount", "unit", "category"]
-                        }
-                    }
-                )
-                print(f"OpenAI API response: {response}")
+@app.post("/analyze-multi", response_model=List[ProductInfo])
+async def analyze_multi_image(file: UploadFile = File(...)):
+    # 棚やレシートなど、1枚の写真に写っている複数の商品をまとめて解析する
+    if not file.content_type.startswith('image/'):
+        raise HTTPException(status_code=400, detail="画像ファイルをアップロードしてください")
 
-                # レスポンスをJSONとしてパース
-                result = json.loads(response.choices[0].message.content)
-                print(f"Parsed result: {result}")
-                # 画像URLを設定
-                result["image_url"] = image_url
+    with metrics.stage("upload_read"):
+        content = await file.read()
 
-                return result
+    cached = await run_in_threadpool(multi_image_cache.get, content)
+    if cached is not None:
+        return cached["products"]
 
-            except Exception as e:
-                print(f"OpenAI API error: {str(e)}")
-                print(f"Error type: {type(e)}")
-                print(f"Error args: {e.args}")
-                raise HTTPException(status_code=500, detail=f"OpenAI API error: {str(e)}")
+    async def analyze():
+        products = await analyze_multi_product_image(content, file.content_type)
+        await run_in_threadpool(multi_image_cache.put, content, {"products": products})
+        return products
 
-        except Exception as e:
-            print(f"Error in image processing: {str(e)}")
-            raise HTTPException(status_code=500, detail=f"画像処理エラー: {str(e)}")
+    try:
+        return await llm_flights.do(("analyze-multi", content_hash(content)), analyze)
 
-        finally:
-            # 一時ファイルを削除
-            if os.path.exists(temp_file_path):
-                os.unlink(temp_file_path)
+    except admission.AdmissionRejected as e:
+        raise admission_error(e)
+    except Exception as e:
+        logger.error("Error in image processing: %s", e)
+        raise HTTPException(status_code=500, detail=f"画像処理エラー: {str(e)}")
 
-@app.post("/suggest-menu")
-async def suggest_menu(request: MenuRequest):
-    try:
-        # 期限が近い順にソート
-        sorted_products = sorted(
-            request.products,
-            key=lambda x: x.expiration_date
-        )
+@app.post("/analyze-batch")
+async def analyze_batch(files: List[UploadFile] = File(...), concurrency: Optional[int] = None):
+    if len(files) > BATCH_MAX_FILES:
+        raise HTTPException(status_code=400, detail=f"一度にアップロードできる画像は{BATCH_MAX_FILES}枚までです")
+
+    # 並列数はリクエストで指定できるが、上限は BATCH_CONCURRENCY
+    parallelism = max(1, min(concurrency or BATCH_CONCURRENCY, BATCH_CONCURRENCY))
 
-        if not sorted_products:
-            raise HTTPException(status_code=400, detail="食材が登録されていません")
+    # レスポンスのストリーミング中にファイルが閉じられないよう先に読み込んでおく
+    with metrics.stage("upload_read"):
+        items = [(file.filename, file.content_type or "", await file.read()) for file in files]
 
-        # 期限が近い3つの商品を選択
-        ingredients = sorted_products[:3]
+    semaphore = asyncio.Semaphore(parallelism)
 
-        # OpenAI APIにリクエストを送信（最大3回までリトライ）
-        max_retries = 5
-        retry_count = 0
-        last_error = None
+    async def analyze_item(index: int, filename: str, content_type: str, content: bytes) -> dict:
+        if not content_type.startswith('image/'):
+            return {"index": index, "filename": filename, "error": "画像ファイルをアップロードしてください"}
 
-        while retry_count < max_retries:
+        async with semaphore:
             try:
-                response = client.chat.completions.create(
-                    model="gemma3:27b",
-                    messages=[
-                        {
-                            "role": "user",
-                            "content": f"以下の食材を使って、簡単に作れる料理を提案してください：\n"
-                            f"{', '.join([f'{p.name} ({p.amount}{p.unit})' for p in ingredients])}\n\n"
-                            f"以下の形式でJSONで出力してください：\n"
-                            f"- title: 料理名\n"
-                            f"- ingredients: 必要な材料のリスト\n"
-                            f"- indication: 調理時間（例：約10分）"
-                        }
-                    ],
-                    response_format={
-                        "type": "json_object",
-                        "schema": {
-                            "type": "object",
-                            "properties": {
-                                "title": {"type": "string"},
-                                "ingredients": {
-                                    "type": "array",
-                                    "items": {"type": "string"}
-                                },
-                                "indication": {"type": "string"}
-                            },
-                            "required": ["title", "ingredients", "indication"]
-                        }
-                    }
+                result = await analyze_uploaded_image(content, content_type)
+                return {"index": index, "filename": filename, "result": result}
+            except admission.AdmissionRejected as e:
+                error = admission_error(e)
+                return {"index": index, "filename": filename, "error": error.detail, "status": e.status, "retry_after": e.retry_after_header()}
+            except Exception as e:
+                logger.error("Error in image processing (%s): %s", filename, e)
+                return {"index": index, "filename": filename, "error": f"画像処理エラー: {str(e)}"}
+
+    async def generate():
+        tasks = [asyncio.ensure_future(analyze_item(index, *item)) for index, item in enumerate(items)]
+        try:
+            # 終わった画像から順に1行ずつ返す
+            for task in asyncio.as_completed(tasks):
+                yield json.dumps(await task, ensure_ascii=False) + "\n"
+        finally:
+            # クライアントが切断した場合は残りを打ち切る
+            for task in tasks:
+                task.cancel()
+
+    return StreamingResponse(generate(), media_type="application/x-ndjson")
+
+# 献立に使う期限が近い食材の数
+MENU_INGREDIENTS = 3
+
+def nearest_expiring(products: List[ProductInfo]) -> List[ProductInfo]:
+    return heapq.nsmallest(MENU_INGREDIENTS, products, key=lambda x: expiration_key(x.expiration_date))
+
+def is_valid_product(product: dict) -> bool:
+    return validate_product(product) is not None
+
+async def inventory_ingredients(user_id: str) -> Optional[List[ProductInfo]]:
+    # サーバー側の在庫の期限順の索引から取り出す（以前に検証せずに登録した、項目が足りない商品は飛ばす）
+    products = await run_in_threadpool(inventory.expiring, user_id, MENU_INGREDIENTS, is_valid_product)
+    if products is None:
+        return None
+    return [ProductInfo(**validate_product(p)) for p in products]
+
+async def select_menu_ingredients(request: MenuRequest) -> List[ProductInfo]:
+    if request.user_id is not None:
+        selected = await inventory_ingredients(request.user_id)
+        if selected is None:
+            raise HTTPException(status_code=404, detail="ユーザーが登録されていません")
+    else:
+        # 期限を日時として解釈し、期限が近い3つの商品を選択（全件のソートはしない）
+        selected = nearest_expiring(request.products or [])
+
+    if not selected:
+        raise HTTPException(status_code=400, detail="食材が登録されていません")
+
+    return selected
+
+@app.post("/suggest-menu")
+async def suggest_menu(request: MenuRequest):
+    ingredients = await select_menu_ingredients(request)
+    try:
+        # 同じ食材の組み合わせの献立があればそれを返す
+        cache_key = menu_cache_key(ingredients)
+        cached = menu_cache.get(cache_key)
+        metrics.cache_result("menu", cached is not None)
+        if cached is not None:
+            schedule_menu_variant(cache_key, ingredients)
+            return cached
+
+        async def suggest():
+            # OpenAI APIにリクエストを送信（最大5回まで指数バックオフでリトライ）
+            with metrics.stage("llm_menu"):
+                result = await llm.create_json_completion(
+                    messages=prompts.menu_messages(ingredients),
+                    schema=MENU_RESPONSE_SCHEMA,
+                    max_retries=5
                 )
+            menu_cache.add(cache_key, result)
+            return result
 
-                result = json.loads(response.choices[0].message.content)
-                return result
+        # 同じ食材の組み合わせの提案が実行中ならその結果を待つ
+        try:
+            return await llm_flights.do(("suggest-menu", cache_key), suggest)
 
-            except Exception as e:
-                last_error = e
-                retry_count += 1
-                print(f"OpenAI API error (attempt {retry_count}/{max_retries}): {str(e)}")
-                if retry_count < max_retries:
-                    # 1秒待ってからリトライ
-                    import time
-                    time.sleep(1)
-                    continue
-
-        # すべてのリトライが失敗した場合
-        print(f"All retries failed. Last error: {str(last_error)}")
-        raise HTTPException(status_code=500, detail=f"献立提案エラー: {str(last_error)}")
+        except admission.AdmissionRejected as e:
+            raise admission_error(e)
+        except Exception as e:
+            # すべてのリトライが失敗した場合
+            logger.error("All retries failed. Last error: %s", e)
+            raise HTTPException(status_code=500, detail=f"献立提案エラー: {str(e)}")
 
+    except HTTPException:
+        raise
     except Exception as e:
-        print(f"Menu suggestion error: {str(e)}")
+        logger.error("Menu suggestion error: %s", e)
         raise HTTPException(status_code=500, detail=f"献立提案エラー: {str(e)}")
 
-@app.post("/upload-json")
-async def upload_json(request: UploadJsonRequest):
+# バックグラウンドで生成中の献立のバリエーション（キー -> タスク）
+menu_variant_tasks = {}
+
+async def generate_menu_variant(cache_key: str, ingredients: List[ProductInfo]):
     try:
-        # 一時ファイルを作成してJSONを書き込む
-        with tempfile.NamedTemporaryFile(suffix='.json', delete=False, mode='wb') as temp_file:
-            json_data = json.dumps(request.data, ensure_ascii=False)
-            temp_file.write(json_data.encode('utf-8'))
-            temp_file.flush()  # バッファをフラッシュ
-            temp_file_path = temp_file.name
+        # 裏での生成は対話的なリクエストより後回しにする
+        with admission.caller(admission.BACKGROUND), metrics.stage("llm_menu_background"):
+            result = await llm.create_json_completion(
+                messages=prompts.menu_messages(ingredients, menu_cache.titles(cache_key)),
+                schema=MENU_RESPONSE_SCHEMA,
+                max_retries=2
+            )
+        menu_cache.add(cache_key, result)
+    except Exception as e:
+        logger.warning("Menu variant error: %s", e)
+    finally:
+        menu_variant_tasks.pop(cache_key, None)
+
+def schedule_menu_variant(cache_key: str, ingredients: List[ProductInfo]):
+    # キャッシュを返しつつ、バリエーションが揃うまで別の献立を裏で生成しておく
+    if menu_cache.needs_variant(cache_key) and cache_key not in menu_variant_tasks:
+        menu_variant_tasks[cache_key] = asyncio.create_task(generate_menu_variant(cache_key, ingredients))
+
+async def precompute_menus(ingredients: List[ProductInfo]):
+    # 期限が近い食材の組み合わせに対して、バリエーションが揃うまで献立を生成してキャッシュに入れる
+    cache_key = menu_cache_key(ingredients)
+    for _ in range(menu_cache.variants):
+        if not menu_cache.needs_variant(cache_key):
+            break
+        with admission.caller(admission.BACKGROUND), metrics.stage("llm_menu_background"):
+            result = await llm.create_json_completion(
+                messages=prompts.menu_messages(ingredients, menu_cache.titles(cache_key)),
+                schema=MENU_RESPONSE_SCHEMA,
+                max_retries=2
+            )
+        menu_cache.add(cache_key, result)
 
+# 在庫が変わったら献立を先に生成しておく（続けて変更があった場合はまとめて1回だけ）
+menu_precompute = MenuPrecomputer(
+    precompute_menus,
+    delay=float(os.getenv("MENU_PRECOMPUTE_DELAY", "2")),
+    max_delay=float(os.getenv("MENU_PRECOMPUTE_MAX_DELAY", "10")),
+)
+metrics.QUEUE_DEPTH.labels("menu_precompute").set_function(lambda: menu_precompute.stats()["pending"])
+MENU_PRECOMPUTE = os.getenv("MENU_PRECOMPUTE", "1") != "0"
+
+def schedule_inventory_precompute(user_id: str):
+    # LINEで登録した在庫の期限が近い食材の献立を用意する
+    async def load():
+        return await inventory_ingredients(user_id) or []
+
+    if MENU_PRECOMPUTE:
+        menu_precompute.schedule(("inventory", user_id), load)
+
+def schedule_document_precompute(id: str, data: dict):
+    # アップロードされたJSONに商品のリストがあれば、その期限が近い食材の献立を用意する
+    async def load():
+        products = [validate_product(p) for p in data.get("products") or [] if isinstance(p, dict)]
+        return nearest_expiring([ProductInfo(**p) for p in products if p is not None])
+
+    if MENU_PRECOMPUTE and isinstance(data.get("products"), list):
+        menu_precompute.schedule(("document", id), load)
+
+@app.get("/menu-cache/stats")
+async def menu_cache_stats():
+    return {**menu_cache.stats(), "precompute": menu_precompute.stats()}
+
+def sse_event(event: str, data) -> str:
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+@app.post("/suggest-menu/stream")
+async def suggest_menu_stream(request: MenuRequest):
+    ingredients = await select_menu_ingredients(request)
+
+    cache_key = menu_cache_key(ingredients)
+    cached = menu_cache.get(cache_key)
+    metrics.cache_result("menu", cached is not None)
+
+    async def generate_cached():
+        # キャッシュがあれば各フィールドをまとめて送る
+        schedule_menu_variant(cache_key, ingredients)
+        yield sse_event("title", {"value": cached["title"]})
+        for ingredient in cached["ingredients"]:
+            yield sse_event("ingredient", {"value": ingredient})
+        yield sse_event("indication", {"value": cached["indication"]})
+        yield sse_event("done", cached)
+
+    async def generate():
+        parser = MenuStreamParser()
         try:
-            # R2にアップロード
-            object_name = f"{request.id}.json"
-            minio_client.fput_object(
-                "ai-hackathon",
-                object_name,
-                temp_file_path
-            )
+            # モデルにリクエストを送ってから最後のトークンを送り出すまでを、モデルの呼び出しとして記録する
+            with metrics.stage("llm_menu_stream"):
+                async for text in llm.stream_json_completion(
+                    messages=prompts.menu_messages(ingredients),
+                    schema=MENU_RESPONSE_SCHEMA,
+                    max_retries=5
+                ):
+                    # 届いたトークンをそのまま流し、読み取れたフィールドがあればそれも送る
+                    yield sse_event("token", {"text": text})
+                    for field, value in parser.feed(text):
+                        yield sse_event(field, {"value": value})
+
+            # 最後に全体を検証した結果を送る
+            menu = MenuResponse(**json.loads(parser.buffer))
+            menu_cache.add(cache_key, menu.model_dump())
+            yield sse_event("done", menu.model_dump())
+
+        except admission.AdmissionRejected as e:
+            error = admission_error(e)
+            yield sse_event("error", {"detail": error.detail, "status": e.status, "retry_after": e.retry_after_header()})
+        except Exception as e:
+            logger.error("Menu suggestion error: %s", e)
+            yield sse_event("error", {"detail": f"献立提案エラー: {str(e)}"})
 
-            # URLを生成
-            url = f"https://pub-7444760b0415482ba8f55298c08a442b.r2.dev/{object_name}"
-            return {"url": url}
+    return StreamingResponse(
+        generate_cached() if cached is not None else generate(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
 
-        except Exception as e:
-            raise HTTPException(status_code=500, detail=f"アップロードエラー: {str(e)}")
+# ローカルのレシピ集（材料・料理名・分類の索引を持つ）
+recipe_index = RecipeIndex.load(os.getenv("RECIPE_CORPUS", os.path.join(os.path.dirname(__file__), "data", "recipes.json")))
+# レシピ集に無い料理をモデルに生成させたレシピ（レシピ集とは別に、問い合わせごとに保存する）
+generated_recipes = GeneratedRecipeCache(max_entries=int(os.getenv("RECIPE_CACHE_SIZE", "256")))
+
+async def recipe_ingredients(request: RecipeRequest) -> List[str]:
+    if request.user_id is not None:
+        products = await inventory_ingredients(request.user_id)
+        if products is None:
+            raise HTTPException(status_code=404, detail="ユーザーが登録されていません")
+        return [p.name for p in products]
+    return request.ingredients or []
+
+@app.post("/recipe", response_model=RecipeResponse)
+async def get_recipe(request: RecipeRequest):
+    ingredients = await recipe_ingredients(request)
+    if not request.menu_name and not ingredients:
+        raise HTTPException(status_code=400, detail="料理名か食材を指定してください")
+
+    # まずはレシピ集から探し、項目が揃っていればモデルは呼ばない
+    with metrics.stage("recipe_index"):
+        recipe_id = recipe_index.find(request.menu_name, ingredients, request.category)
+    generated_key = generated_recipe_key(request.menu_name, ingredients, request.category)
+    if recipe_id is not None:
+        metrics.cache_result("recipe", True)
+        recipe = recipe_index.get(recipe_id)
+        if not missing_fields(recipe):
+            return {**recipe, "url": recipe.get("url") or ""}
+    else:
+        # 前に同じ問い合わせで生成したレシピがあればそれを返す
+        generated = generated_recipes.get(generated_key)
+        metrics.cache_result("recipe", generated is not None)
+        if generated is not None:
+            return generated
+
+    async def generate():
+        known = None
+        if recipe_id is not None:
+            known = {field: recipe.get(field) for field in RECIPE_FIELDS}
+        with metrics.stage("llm_recipe"):
+            result = await llm.create_json_completion(
+                messages=prompts.recipe_messages(request.menu_name, request.category, ingredients, known),
+                schema=RECIPE_SCHEMA,
+                max_retries=3
+            )
+        if recipe_id is not None:
+            # 足りなかった項目だけを採用してレシピ集に反映する（次からはモデルを呼ばない）
+            filled = {field: result[field] for field in missing_fields(recipe) if field in result}
+            recipe_index.update(recipe_id, filled)
+            return {**recipe, **filled, "url": recipe.get("url") or ""}
+        # レシピ集に無い料理は、生成したレシピを問い合わせごとに保存しておく（レシピ集には入れない）
+        generated = {**result, "category": request.category or "", "url": ""}
+        generated_recipes.put(generated_key, generated)
+        return generated
+
+    key = ("recipe", recipe_id) if recipe_id is not None else ("recipe", generated_key)
+    try:
+        return await llm_flights.do(key, generate)
+    except admission.AdmissionRejected as e:
+        raise admission_error(e)
+    except Exception as e:
+        logger.error("Recipe error: %s", e)
+        raise HTTPException(status_code=500, detail=f"レシピ取得エラー: {str(e)}")
+
+@app.post("/recipe/search")
+async def search_recipes(request: RecipeRequest, limit: int = 5):
+    # レシピ集だけから、料理名・期限が近い食材との重なりが大きい順に返す（モデルは呼ばない）
+    ingredients = await recipe_ingredients(request)
+    results = recipe_index.search(request.menu_name, ingredients, request.category, max(1, min(limit, 50)))
+    return {
+        "recipes": [
+            {**recipe_index.get(recipe_id), "matched_ingredients": overlap}
+            for recipe_id, _, overlap in results
+        ]
+    }
 
-        finally:
-            # 一時ファイルを削除
-            if os.path.exists(temp_file_path):
-                os.unlink(temp_file_path)
+@app.post("/upload-json")
+async def upload_json(request: UploadJsonRequest):
+    try:
+        # R2にアップロード
+        object_name = f"{request.id}.json"
+        await run_in_threadpool(upload_json_to_r2, object_name, request.data)
+        schedule_document_precompute(request.id, request.data)
+
+        # URLを生成
+        url = f"https://pub-7444760b0415482ba8f55298c08a442b.r2.dev/{object_name}"
+        return {"url": url}
 
     except Exception as e:
-        raise HTTPException(status_code=500, detail=f"サーバーエラー: {str(e)}")
+        raise HTTPException(status_code=500, detail=f"アップロードエラー: {str(e)}")
 
 
 @app.get("/get-json/{id}")
-async def get_json(id: str):
+async def get_json(id: str, request: Request):
     try:
-        # 一時ファイルを作成
-        with tempfile.NamedTemporaryFile(suffix='.json', delete=False, mode='wb') as temp_file:
-            temp_file_path = temp_file.name
+        etag, data = await run_in_threadpool(read_json_document, f"{id}.json")
 
-            try:
-                # R2からファイルをダウンロード
-                object_name = f"{id}.json"
-                minio_client.fget_object(
-                    "ai-hackathon",
-                    object_name,
-                    temp_file_path
-                )
+    except Exception as e:
+        if "NoSuchKey" in str(e):
+            raise HTTPException(status_code=404, detail="指定されたIDのファイルが見つかりません")
+        raise HTTPException(status_code=500, detail=f"ダウンロードエラー: {str(e)}")
 
-                # JSONファイルを読み込む
-                with open(temp_file_path, 'r', encoding='utf-8') as f:
-                    data = json.load(f)
+    # クライアントが同じETagを持っていれば本文は返さない
+    headers = {"ETag": f'"{etag}"', "Cache-Control": "no-cache"}
+    if_none_match = parse_etags(request.headers.get("If-None-Match"))
+    if etag in if_none_match or "*" in if_none_match:
+        return Response(status_code=304, headers=headers)
 
-                return data
+    return Response(content=json_codec.dumps(data), media_type="application/json", headers=headers)
 
-            except Exception as e:
-                if "NoSuchKey" in str(e):
-                    raise HTTPException(status_code=404, detail="指定されたIDのファイルが見つかりません")
-                raise HTTPException(status_code=500, detail=f"ダウンロードエラー: {str(e)}")
+# /patch-json で同じドキュメントへの書き込みを直列化するためのロック
+document_locks = weakref.WeakValueDictionary()
 
-            finally:
-                # 一時ファイルを削除
-                if os.path.exists(temp_file_path):
-                    os.unlink(temp_file_path)
+# R2のJSONドキュメントの読み込みから書き込みまでを、/patch-json と在庫のスナップショットの書き込み（スレッド）の間で直列化するロック
+# ドキュメント名のハッシュで DOCUMENT_WRITE_LOCK_STRIPES 個のロックを共有する
+DOCUMENT_WRITE_LOCK_STRIPES = 64
+document_write_locks = [threading.Lock() for _ in range(DOCUMENT_WRITE_LOCK_STRIPES)]
 
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"サーバーエラー: {str(e)}")
+def document_write_lock(object_name: str) -> threading.Lock:
+    return document_write_locks[hash(object_name) % DOCUMENT_WRITE_LOCK_STRIPES]
+
+def patch_document(object_name: str, patch, use_json_patch: bool, if_match: set) -> tuple:
+    # R2のJSONを読み込んでパッチを当て、書き戻す（スレッドプールから呼ぶ）。(パッチ後のデータ, 新しいETag) を返す
+    with document_write_lock(object_name):
+        try:
+            etag, data = read_json_document(object_name, True)
+        except Exception as e:
+            if "NoSuchKey" in str(e):
+                raise HTTPException(status_code=404, detail="指定されたIDのファイルが見つかりません")
+            raise HTTPException(status_code=500, detail=f"ダウンロードエラー: {str(e)}")
+
+        # 楽観的排他制御：クライアントが見ていた版から変わっていれば更新しない
+        if if_match and etag not in if_match and "*" not in if_match:
+            raise HTTPException(status_code=412, detail="ファイルが他の更新で変更されています。取得し直してください")
+
+        try:
+            if use_json_patch:
+                patched = apply_json_patch(data, patch)
+            else:
+                patched = apply_merge_patch(data, patch)
+        except JsonPatchTestFailed as e:
+            raise HTTPException(status_code=409, detail=str(e))
+        except JsonPatchError as e:
+            raise HTTPException(status_code=422, detail=str(e))
+
+        if not isinstance(patched, dict):
+            raise HTTPException(status_code=422, detail="パッチ適用後のデータはJSONオブジェクトである必要があります")
+
+        try:
+            return patched, upload_json_to_r2(object_name, patched)
+        except Exception as e:
+            raise HTTPException(status_code=500, detail=f"アップロードエラー: {str(e)}")
+
+@app.patch("/patch-json/{id}")
+async def patch_json(id: str, request: Request):
+    try:
+        patch = json_codec.loads(await request.body())
+    except Exception:
+        raise HTTPException(status_code=400, detail="パッチがJSONとして読み込めません")
+
+    # Content-Type が application/json-patch+json か配列なら JSON Patch、それ以外は JSON Merge Patch
+    content_type = request.headers.get("Content-Type", "")
+    use_json_patch = "json-patch" in content_type or isinstance(patch, list)
+    if_match = parse_etags(request.headers.get("If-Match"))
+
+    # 同じドキュメントへのパッチはイベントループ側で待たせ、スレッドを塞がないようにする
+    object_name = f"{id}.json"
+    async with document_locks.setdefault(object_name, asyncio.Lock()):
+        patched, new_etag = await run_in_threadpool(patch_document, object_name, patch, use_json_patch, if_match)
+
+    schedule_document_precompute(id, patched)
+    return Response(content=json_codec.dumps(patched), media_type="application/json", headers={"ETag": f'"{new_etag}"'})
+
+@app.get("/inventory/{user_id}/expiring")
+async def get_expiring(user_id: str, k: int = 3):
+    # 期限が近い順に k 件
+    products = await run_in_threadpool(inventory.expiring, user_id, max(1, min(k, 100)))
+    if products is None:
+        raise HTTPException(status_code=404, detail="ユーザーが登録されていません")
+    return {"products": products}
+
+@app.get("/inventory/{user_id}/expiring-within")
+async def get_expiring_within(user_id: str, days: float):
+    # days 日以内に期限が来る商品（期限切れのものも含む）を期限順に
+    products = await run_in_threadpool(inventory.expiring_within, user_id, max(days, 0) * 24 * 60 * 60)
+    if products is None:
+        raise HTTPException(status_code=404, detail="ユーザーが登録されていません")
+    return {"products": products}
+
+@app.get("/llm/backends")
+async def llm_backends():
+    # モデルのバックエンドごとの状態（サーキットブレーカー・処理中の数・レイテンシ）
+    return llm.router.stats()
+
+@app.get("/llm/admission")
+async def llm_admission():
+    # 受付制御の状態（処理中・クラスごとの待ち・断った数）
+    return llm.admission_controller.stats()
+
+@app.get("/metrics")
+async def get_metrics():
+    # Prometheus のテキスト形式
+    content, content_type = metrics.render()
+    return Response(content=content, media_type=content_type)
 
 @app.get("/health")
 async def health():
     return {"status": "ok"}
 
+def parse_line_events(body: str, signature: str) -> Optional[list]:
+    # 署名の検証とイベントの解析（最初の1回はSDKの読み込みも）はイベントループを止めないようスレッドプールで行う
+    # 署名が合わなければ None
+    from linebot.exceptions import InvalidSignatureError
+
+    try:
+        return parser.parse(body, signature)
+    except InvalidSignatureError:
+        return None
+
 @app.post("/callback")
 async def callback(request: Request):
     # get X-Line-Signature header value
@@ -376,145 +1030,160 @@ async def callback(request: Request):
     body = await request.body()
     body = body.decode("utf-8")
 
-    # handle webhook body
-    try:
-        handler.handle(body, signature)
-    except InvalidSignatureError:
+    # verify signature and parse events
+    events = await run_in_threadpool(parse_line_events, body, signature)
+    if events is None:
         raise HTTPException(
             status_code=400,
             detail="Invalid signature. Please check your channel access token/channel secret.",
         )
 
+    # イベントの処理はワーカーに任せてすぐに返す（再送されたイベントは webhookEventId で除く）
+    try:
+        line_events.submit(events)
+    except QueueFullError:
+        # 処理しきれないときはLINEに再送してもらう
+        raise HTTPException(status_code=503, detail="Too many pending events")
+
     return "OK"
 
-@handler.add(MessageEvent, message=TextMessage)
+def handle_line_event(event):
+    # ワーカーから呼ばれ、イベントの種類に応じたハンドラーを実行する
+    from linebot.models import ImageMessage, MessageEvent, TextMessage
+
+    if not isinstance(event, MessageEvent):
+        return
+    if isinstance(event.message, TextMessage):
+        with metrics.stage("line_text_event"):
+            handle_message(event)
+    elif isinstance(event.message, ImageMessage):
+        with metrics.stage("line_image_event"):
+            handle_image(event)
+
+# LINE webhookのイベントを処理するワーカープール
+line_events = WebhookWorkerPool(
+    handle_line_event,
+    workers=int(os.getenv("LINE_WORKERS", "8")),
+    max_queue=int(os.getenv("LINE_QUEUE_SIZE", "1000")),
+)
+metrics.QUEUE_DEPTH.labels("line_events").set_function(line_events.qsize)
+
+def push_text(event, text: str):
+    # 処理結果は reply token の有効期限を気にせず push で送る
+    from linebot.models import TextSendMessage
+
+    with metrics.stage("line_push"):
+        line_bot_api.push_message(event.source.user_id, TextSendMessage(text=text))
+
+def send_expiry_alert(user_ids: list, text: str):
+    from linebot.models import TextSendMessage
+
+    with metrics.stage("line_multicast"):
+        line_bot_api.multicast(user_ids, TextSendMessage(text=text))
+
+def load_inventory_users():
+    # 起動時に、このサーバーで登録したユーザーの在庫を読み込む（R2のスナップショットから復元される）
+    for user_id in inventory.user_ids():
+        state = inventory.get(user_id)
+        if state is not None:
+            yield user_id, state["products"]
+
+# 期限が近い商品をLINEで知らせるスケジューラー（同じ文面のユーザーは multicast でまとめて送る）
+EXPIRY_ALERTS = os.getenv("EXPIRY_ALERTS", "1") != "0"
+expiry_alerts = ExpiryAlertScheduler(
+    send_expiry_alert,
+    load_users=load_inventory_users,
+    lead=float(os.getenv("EXPIRY_ALERT_BEFORE_HOURS", "24")) * 60 * 60,
+    interval=float(os.getenv("EXPIRY_ALERT_INTERVAL", "60")),
+    rate=float(os.getenv("EXPIRY_ALERT_RATE", "10")),
+    dry_run=os.getenv("EXPIRY_ALERT_DRY_RUN", "0") == "1",
+    # 通知を処理し終えた時刻は在庫のログと同じディレクトリに保存する
+    state_path=os.path.join(inventory.log_dir, "expiry_alerts.watermark"),
+)
+if EXPIRY_ALERTS:
+    inventory.subscribe(expiry_alerts.on_inventory_change)
+
+# 管理用のAPIのトークン（Authorization: Bearer <ADMIN_TOKEN>。設定しなければ管理用のAPIは使えない）
+ADMIN_TOKEN = os.getenv("ADMIN_TOKEN")
+
+def is_admin(request: Request) -> bool:
+    if not ADMIN_TOKEN:
+        return False
+    return hmac.compare_digest(request.headers.get("Authorization", ""), f"Bearer {ADMIN_TOKEN}")
+
+@app.get("/expiry-alerts/stats")
+async def expiry_alert_stats(request: Request):
+    # 通知待ちの商品の数・送った multicast の数・直近に送った（dry run なら送るはずだった）内容（宛先は人数だけ）
+    # 直近の内容には商品名と期限が含まれるので、/expiry-alerts/run の dry run と同じく EXPIRY_ALERT_DRY_RUN=1 のとき以外は管理者だけ
+    if not is_admin(request) and not expiry_alerts.dry_run:
+        raise HTTPException(status_code=403, detail="管理者のトークンが必要です")
+    return expiry_alerts.stats()
+
+@app.post("/expiry-alerts/run")
+async def run_expiry_alerts(request: Request, dry_run: bool = True):
+    # 時刻が来た通知を今すぐ処理する（動作確認用）
+    # dry_run では通知を取り出さずに送るはずの内容だけ返す。EXPIRY_ALERT_DRY_RUN=1 のときは管理者でなくても使える
+    # 実際に送るのは管理者だけ
+    if not is_admin(request) and not (dry_run and expiry_alerts.dry_run):
+        raise HTTPException(status_code=403, detail="管理者のトークンが必要です")
+    if dry_run:
+        return {"batches": await run_in_threadpool(expiry_alerts.preview)}
+    sent = await run_in_threadpool(expiry_alerts.run_once, None, False)
+    return {"batches": [batch_summary(batch) for batch in sent]}
+
 def handle_message(event):
     user_id = event.source.user_id
     text = event.message.text
 
     if text == "開始":
-        user_data[user_id] = {"products": []}
-        line_bot_api.reply_message(
-            event.reply_token,
-            TextSendMessage(text="ユーザーIDを登録しました。画像を送信してください。")
-        )
+        inventory.reset(user_id)
+        push_text(event, "ユーザーIDを登録しました。画像を送信してください。")
     else:
-        line_bot_api.reply_message(
-            event.reply_token,
-            TextSendMessage(text="「開始」と送信して、ユーザーIDを登録してください。")
-        )
+        push_text(event, "「開始」と送信して、ユーザーIDを登録してください。")
 
-@handler.add(MessageEvent, message=ImageMessage)
 def handle_image(event):
     user_id = event.source.user_id
 
-    if user_id not in user_data:
-        line_bot_api.reply_message(
-            event.reply_token,
-            TextSendMessage(text="まず「開始」と送信して、ユーザーIDを登録してください。")
-        )
+    if not inventory.is_registered(user_id):
+        push_text(event, "まず「開始」と送信して、ユーザーIDを登録してください。")
         return
 
     try:
-        # 画像を一時ファイルとして保存
-        message_content = line_bot_api.get_message_content(event.message.id)
-        with tempfile.NamedTemporaryFile(suffix='.jpg', delete=False) as temp_file:
-            for chunk in message_content.iter_content():
-                temp_file.write(chunk)
-            temp_file_path = temp_file.name
-
-        # 画像をR2にアップロード
-        image_url = upload_to_r2(temp_file_path)
-
-        # 画像をbase64エンコード
-        with open(temp_file_path, 'rb') as image_file:
-            base64_image = base64.b64encode(image_file.read()).decode('utf-8')
-
-        # OpenAI APIを使用して画像分析
-        response = client.chat.completions.create(
-            model="gemma3:27b",
-            messages=[
-                {
-                    "role": "user",
-                    "content": [
-                        {
-                            "type": "text",
-                            "text": "この写真から以下の情報をJSON形式で出力してください：\n"
-                            "1. 商品名 (日本語で)\n"
-                            "2. 賞味期限または消費期限（ISO 8601形式で）\n"
-                            "3. 画像URL（空文字列で構いません）\n"
-                            "4. 分量（数値のみ、単位は含めない）\n"
-                            "5. 単位（g, kg, ml, L, 個, 枚, 本）\n"
-                            "6. 分類（肉, 野菜, 魚, 調味料, お菓子, 飲料, その他）"
-                        },
-                        {
-                            "type": "image_url",
-                            "image_url": {
-                                "url": f"data:image/jpeg;base64,{base64_image}"
-                            }
-                        }
-                    ]
-                }
-            ],
-            response_format={
-                "type": "json_object",
-                "schema": {
-                    "type": "object",
-                    "properties": {
-                        "name": {"type": "string"},
-                        "expiration_date": {"type": "string"},
-                        "expiration_type": {"type": "string", "enum": ["best_before", "use_by"]},
-                        "image_url": {"type": "string"},
-                        "amount": {"type": "number"},
-                        "unit": {"type": "string"},
-                        "category": {"type": "string"}
-                    },
-                    "required": ["name", "expiration_date", "expiration_type", "image_url", "amount", "unit", "category"]
-                }
-            }
-        )
-
-        result = json.loads(response.choices[0].message.content)
-        result["image_url"] = image_url
-
-        # ユーザーのデータに商品を追加
-        user_data[user_id]["products"].append(result)
-
-        # JSONを保存
-        with tempfile.NamedTemporaryFile(suffix='.json', delete=False, mode='w') as temp_file:
-            json.dump(user_data[user_id], temp_file, ensure_ascii=False)
-            temp_file_path = temp_file.name
-
-        # R2にアップロード
-        object_name = f"{user_id}.json"
-        minio_client.fput_object(
-            "ai-hackathon",
-            object_name,
-            temp_file_path
-        )
+        # 画像をメモリ上に読み込む
+        with metrics.stage("line_download"):
+            message_content = line_bot_api.get_message_content(event.message.id)
+            content = message_content.content
+
+        # 画像をR2にアップロードしつつ分析（プロンプト・キャッシュ・実行中の同じ画像の解析は /analyze と共有）
+        # （ハンドラーはスレッドプールで動くので、イベントループ上の非同期処理を呼び出す）
+        async def analyze():
+            # LINEからの解析はWebの対話的なリクエストより後、裏での生成より先に通し、ユーザーごとに流量を制限する
+            with admission.caller(admission.LINE, user_id):
+                return await analyze_uploaded_image(content, "image/jpeg")
+
+        result = validate_product(from_thread.run(analyze))
+        if result is None:
+            push_text(event, "商品の情報を読み取れませんでした。商品名と期限が写るように撮影して、もう一度送信してください。")
+            return
+
+        # ユーザーの在庫に商品を追加（R2への書き出しはまとめてバックグラウンドで行う）
+        inventory.add_product(user_id, result)
+        # 期限が近い食材が変わったかもしれないので、献立の候補を裏で用意しておく
+        from_thread.run_sync(schedule_inventory_precompute, user_id)
 
         # レスポンスメッセージを作成
         message = f"商品を登録しました：\n"
         message += f"商品名：{result['name']}\n"
         message += f"期限：{result['expiration_date']}\n"
-        message += f"分量：{result['amount']}{result['unit']}\n"
+        message += f"分量：{result['amount']:g}{result['unit']}\n"
         message += f"分類：{result['category']}"
 
-        line_bot_api.reply_message(
-            event.reply_token,
-            TextSendMessage(text=message)
-        )
+        push_text(event, message)
 
+    except admission.AdmissionRejected:
+        push_text(event, "混み合っているため登録できませんでした。しばらくしてからもう一度画像を送信してください。")
     except Exception as e:
-        line_bot_api.reply_message(
-            event.reply_token,
-            TextSendMessage(text=f"エラーが発生しました：{str(e)}")
-        )
-
-    finally:
-        # 一時ファイルを削除
-        if os.path.exists(temp_file_path):
-            os.unlink(temp_file_path)
+        push_text(event, f"エラーが発生しました：{str(e)}")
 
 if __name__ == "__main__":
     uvicorn.run(app, host="0.0.0.0", port=8000)
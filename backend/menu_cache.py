@@ -0,0 +1,93 @@
+import json
+import time
+import unicodedata
+from collections import OrderedDict
+from typing import Optional
+
+# 献立提案のキャッシュ
+# 期限が近い食材の組み合わせ（名前・丸めた分量・単位）をキーに、複数の提案（バリエーション）を保存して順番に返す
+
+
+def normalize_text(text: str) -> str:
+    return unicodedata.normalize("NFKC", text).strip().casefold()
+
+
+def round_amount(amount: float) -> float:
+    """分量を有効数字2桁に丸める（267.84 と 270 を同じ食材とみなす）"""
+    return float(f"{amount:.2g}")
+
+
+def menu_cache_key(products: list) -> str:
+    """食材の組み合わせを正規化したキー（順番には依存しない）"""
+    items = sorted(
+        (normalize_text(p.name), round_amount(p.amount), normalize_text(p.unit))
+        for p in products
+    )
+    return json.dumps(items, ensure_ascii=False)
+
+
+class MenuCache:
+    def __init__(self, max_entries: int = 1024, ttl: float = 24 * 60 * 60, variants: int = 3):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.variants = variants
+        # key -> {"menus": [(保存時刻, 献立)], "next": 次に返す番号}
+        self._entries: OrderedDict = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key: str) -> Optional[dict]:
+        """キャッシュ済みの献立を順番に1つ返す（無ければNone）"""
+        entry = self._entries.get(key)
+        if entry is not None:
+            self._drop_expired(key, entry)
+            entry = self._entries.get(key)
+
+        if entry is None:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        self._entries.move_to_end(key)
+        index = entry["next"] % len(entry["menus"])
+        entry["next"] = index + 1
+        return dict(entry["menus"][index][1])
+
+    def add(self, key: str, menu: dict):
+        """献立を追加する（バリエーションが上限に達していたら一番古いものと入れ替える）"""
+        entry = self._entries.setdefault(key, {"menus": [], "next": 0})
+        entry["menus"].append((time.time(), dict(menu)))
+        if len(entry["menus"]) > self.variants:
+            entry["menus"].pop(0)
+        self._entries.move_to_end(key)
+
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def needs_variant(self, key: str) -> bool:
+        """バリエーションがまだ揃っていないか"""
+        entry = self._entries.get(key)
+        return entry is None or len(entry["menus"]) < self.variants
+
+    def titles(self, key: str) -> list:
+        entry = self._entries.get(key)
+        return [menu["title"] for _, menu in entry["menus"]] if entry else []
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+            "evictions": self.evictions,
+        }
+
+    def _drop_expired(self, key: str, entry: dict):
+        now = time.time()
+        entry["menus"] = [(created_at, menu) for created_at, menu in entry["menus"] if now - created_at <= self.ttl]
+        if not entry["menus"]:
+            del self._entries[key]
+            self.evictions += 1
@@ -0,0 +1,90 @@
+import asyncio
+import logging
+from typing import Awaitable, Callable, Hashable, Optional
+
+# 在庫が変わったときに献立の候補を裏で生成しておく（/suggest-menu はキャッシュから返せるようになる）
+# 短時間に続けて変更があった場合は、最後の変更から delay 秒待って1回だけ生成する（デバウンス）
+# 変更が続いても最初の変更から max_delay 秒たてば生成する。生成中の変更は生成後にもう1回だけ反映する
+# イベントループ上で使う（LINEのハンドラーからは from_thread.run_sync 経由で呼び出す）
+
+logger = logging.getLogger(__name__)
+
+
+class MenuPrecomputer:
+    def __init__(
+        self,
+        generate: Callable[[list], Awaitable],
+        delay: float = 2.0,
+        max_delay: float = 10.0,
+    ):
+        # generate は食材のリストを受け取り、献立を生成してキャッシュに保存する
+        self.generate = generate
+        self.delay = delay
+        self.max_delay = max_delay
+        # key -> {"load": 食材を読み込む関数, "first": 最初の変更の時刻, "deadline": 生成を始める時刻, "running": 生成中か}
+        self._pending = {}
+        self._tasks = set()
+        self.scheduled = 0
+        self.coalesced = 0
+        self.runs = 0
+        self.failures = 0
+
+    def schedule(self, key: Hashable, load: Callable[[], Awaitable[Optional[list]]]):
+        """key（ユーザーなど）の在庫が変わったことを知らせる。load は最新の食材を返す非同期関数"""
+        now = asyncio.get_running_loop().time()
+        self.scheduled += 1
+        entry = self._pending.get(key)
+        if entry is None:
+            entry = {"load": load, "first": now, "deadline": now + self.delay, "running": False}
+            self._pending[key] = entry
+            task = asyncio.create_task(self._run(key, entry))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+            return
+
+        self.coalesced += 1
+        if entry["running"]:
+            # 生成中の変更は、生成が終わってから改めて待つ
+            entry["first"] = now
+        entry["load"] = load
+        entry["deadline"] = min(now + self.delay, entry["first"] + self.max_delay)
+
+    async def stop(self):
+        for task in list(self._tasks):
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._pending.clear()
+
+    def stats(self) -> dict:
+        return {
+            "pending": len(self._pending),
+            "scheduled": self.scheduled,
+            "coalesced": self.coalesced,
+            "runs": self.runs,
+            "failures": self.failures,
+        }
+
+    async def _run(self, key: Hashable, entry: dict):
+        loop = asyncio.get_running_loop()
+        try:
+            while entry["load"] is not None:
+                wait = entry["deadline"] - loop.time()
+                if wait > 0:
+                    await asyncio.sleep(wait)
+                    continue
+
+                load, entry["load"] = entry["load"], None
+                entry["running"] = True
+                try:
+                    ingredients = await load()
+                    if ingredients:
+                        self.runs += 1
+                        await self.generate(ingredients)
+                except Exception as e:
+                    self.failures += 1
+                    logger.warning("Menu precompute error (%s): %s", key, e)
+                finally:
+                    entry["running"] = False
+        finally:
+            if self._pending.get(key) is entry:
+                del self._pending[key]
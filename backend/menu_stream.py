@@ -0,0 +1,64 @@
+import json
+import re
+
+# /suggest-menu/stream 用の逐次JSONパーサー
+# モデルから届いた途中までのJSONから、title・ingredientsの各要素・indication を読み取れた順に取り出す
+
+_KEY_PATTERN = re.compile(r'"(title|ingredients|indication)"\s*:\s*')
+_decoder = json.JSONDecoder()
+
+
+class MenuStreamParser:
+    def __init__(self):
+        self.buffer = ""
+        self._emitted = set()
+        self._ingredient_count = 0
+
+    def feed(self, text: str) -> list:
+        """テキストを追加し、新たに読み取れた (フィールド名, 値) のリストを返す"""
+        self.buffer += text
+        events = []
+
+        for match in _KEY_PATTERN.finditer(self.buffer):
+            key = match.group(1)
+            if key == "ingredients":
+                events.extend(self._parse_ingredients(match.end()))
+            elif key not in self._emitted:
+                try:
+                    value, _ = _decoder.raw_decode(self.buffer, match.end())
+                except ValueError:
+                    # 値がまだ最後まで届いていない
+                    continue
+                self._emitted.add(key)
+                events.append((key, value))
+
+        return events
+
+    def _parse_ingredients(self, pos: int) -> list:
+        if "ingredients" in self._emitted or pos >= len(self.buffer) or self.buffer[pos] != "[":
+            return []
+
+        events = []
+        index = 0
+        pos += 1
+        while True:
+            # 要素の間の空白とカンマを読み飛ばす
+            while pos < len(self.buffer) and self.buffer[pos] in " \t\r\n,":
+                pos += 1
+            if pos >= len(self.buffer):
+                break
+            if self.buffer[pos] == "]":
+                self._emitted.add("ingredients")
+                break
+
+            try:
+                value, pos = _decoder.raw_decode(self.buffer, pos)
+            except ValueError:
+                break
+
+            if index >= self._ingredient_count:
+                events.append(("ingredient", value))
+                self._ingredient_count += 1
+            index += 1
+
+        return events
@@ -0,0 +1,97 @@
+import time
+from contextlib import contextmanager
+
+from prometheus_client import CONTENT_TYPE_LATEST, Counter, Gauge, Histogram, generate_latest
+
+# Prometheusのメトリクス（GET /metrics で公開する）
+# リクエスト全体のレイテンシに加えて、前処理・R2・モデル呼び出しなどの段階ごとのレイテンシを記録する
+# uvicorn のワーカーを複数にした場合はワーカーごとの値になる
+
+# モデルの呼び出しは数十秒かかることがあるので、長めのバケットにする
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120)
+
+REQUEST_LATENCY = Histogram(
+    "http_request_duration_seconds",
+    "HTTPリクエストの処理時間",
+    ["method", "route", "status"],
+    buckets=LATENCY_BUCKETS,
+)
+
+STAGE_LATENCY = Histogram(
+    "stage_duration_seconds",
+    "処理の段階ごとの時間",
+    ["stage"],
+    buckets=LATENCY_BUCKETS,
+)
+
+STAGE_ERRORS = Counter(
+    "stage_errors_total",
+    "処理の段階ごとの失敗の数",
+    ["stage"],
+)
+
+LLM_REQUEST_LATENCY = Histogram(
+    "llm_request_duration_seconds",
+    "モデルのバックエンドへのリクエストの時間（cold はしばらく使われていなかったバックエンドへのリクエスト）",
+    ["backend", "cold"],
+    buckets=LATENCY_BUCKETS,
+)
+
+LLM_REQUESTS = Counter(
+    "llm_requests_total",
+    "モデルのバックエンドへのリクエストの数",
+    ["backend", "outcome"],
+)
+
+LLM_RETRIES = Counter(
+    "llm_retries_total",
+    "モデルの呼び出しの失敗でやり直した数（completion / stream）",
+    ["call"],
+)
+
+CACHE_REQUESTS = Counter(
+    "cache_requests_total",
+    "キャッシュの参照の数",
+    ["cache", "result"],
+)
+
+ADMISSION_WAIT = Histogram(
+    "admission_wait_seconds",
+    "モデルの呼び出しの順番を待った時間",
+    ["priority"],
+    buckets=LATENCY_BUCKETS,
+)
+
+ADMISSION_REJECTIONS = Counter(
+    "admission_rejections_total",
+    "受付制御で断ったモデルの呼び出しの数（rate_limited / deadline / queue_full / shed）",
+    ["priority", "reason"],
+)
+
+QUEUE_DEPTH = Gauge(
+    "queue_depth",
+    "処理待ちの数",
+    ["queue"],
+)
+
+
+@contextmanager
+def stage(name: str):
+    """with の中の処理時間を name の段階として記録する（スレッドプールの中でも使える）"""
+    started = time.perf_counter()
+    try:
+        yield
+    except BaseException:
+        STAGE_ERRORS.labels(name).inc()
+        raise
+    finally:
+        STAGE_LATENCY.labels(name).observe(time.perf_counter() - started)
+
+
+def cache_result(cache: str, hit: bool):
+    CACHE_REQUESTS.labels(cache, "hit" if hit else "miss").inc()
+
+
+def render() -> tuple:
+    """(本文, Content-Type)"""
+    return generate_latest(), CONTENT_TYPE_LATEST
@@ -0,0 +1,146 @@
+import json
+
+# モデルに送るプロンプトの置き場所
+# /analyze・/analyze-multi・LINEの画像ハンドラー・献立・レシピのプロンプトをここにまとめる
+# Ollamaは直前のリクエストと先頭が一致する部分の計算（KVキャッシュ）を再利用するので、
+# 変わらない指示を system メッセージとして先に置き、画像や食材など毎回変わる内容は後ろの user メッセージに入れる
+# （画像の解析はどの経路でも商品の項目の説明から始まるようにして、先頭をできるだけ長く共有する）
+
+# 商品の項目の説明（単品・複数商品の解析で共通の先頭部分）
+PRODUCT_FIELDS_PROMPT = (
+    "写真に写っている食品の商品について、以下の情報を読み取ってください：\n"
+    "1. 商品名 (日本語で)\n"
+    "2. 賞味期限または消費期限（ISO 8601形式で）\n"
+    "   - 日付の解釈に注意してください。例えば「25.4.28」は「2025年4月28日」と解釈してください\n"
+    "   - 年が2桁で表記されている場合は、2000年代として解釈してください\n"
+    "   - 時間が記載されている場合は、その時間も含めて出力してください（例：2025-04-28T14:30:00Z）\n"
+    "   - 時間が記載されていない場合は、00:00:00として出力してください\n"
+    "   - 賞味期限と消費期限を区別して認識してください\n"
+    "   - 賞味期限の場合は「best_before」、消費期限の場合は「use_by」として出力してください\n"
+    "   - 区別ができない場合は「best_before」として出力してください\n"
+    "3. 画像URL（空文字列で構いません）\n"
+    "4. 分量（数値のみ、単位は含めない。例：300、1.5、500など）\n"
+    "5. 単位（以下のいずれかから選択）：\n"
+    "   - g\n"
+    "   - kg\n"
+    "   - ml\n"
+    "   - L\n"
+    "   - 個\n"
+    "   - 枚\n"
+    "   - 本\n"
+    "6. 分類（以下のいずれかから選択）：\n"
+    "   - 肉\n"
+    "   - 野菜\n"
+    "   - 魚\n"
+    "   - 調味料\n"
+    "   - お菓子\n"
+    "   - 飲料\n"
+    "   - その他\n"
+)
+
+# /analyze とLINEの画像ハンドラーで共有する単品の解析
+ANALYZE_PROMPT = (
+    PRODUCT_FIELDS_PROMPT
+    + "写真の中心にある1つの商品について、JSON形式で出力してください。\n"
+    "JSONのキーは以下の通りです：\n"
+    "- name\n"
+    "- expiration_date\n"
+    "- expiration_type\n"
+    "- image_url\n"
+    "- amount\n"
+    "- unit\n"
+    "- category"
+)
+
+# /analyze-multi の複数商品の解析（冷蔵庫の棚やレシートなど）
+MULTI_ANALYZE_PROMPT = (
+    PRODUCT_FIELDS_PROMPT
+    + "7. 読み取り結果の確信度（0から1の数値）\n"
+    "8. 写真内での商品の位置（左上のx, 左上のy, 右下のx, 右下のy を画像の幅・高さに対する0から1の割合で）\n"
+    "写真（冷蔵庫の棚やレシートなど）に写っているすべての商品について、JSON形式で出力してください。\n"
+    "期限が読み取れない場合は空文字列にしてください。\n"
+    "JSONは products キーに商品の配列を入れ、各商品のキーは以下の通りです：\n"
+    "- name\n"
+    "- expiration_date\n"
+    "- expiration_type\n"
+    "- image_url\n"
+    "- amount\n"
+    "- unit\n"
+    "- category\n"
+    "- confidence\n"
+    "- bbox"
+)
+
+MENU_PROMPT = (
+    "与えられた食材を使って、簡単に作れる料理を1つ提案してください。\n"
+    "以下の形式でJSONで出力してください：\n"
+    "- title: 料理名\n"
+    "- ingredients: 必要な材料のリスト\n"
+    "- indication: 調理時間（例：約10分）"
+)
+
+RECIPE_PROMPT = (
+    "料理のレシピを答えてください。\n"
+    "以下の形式でJSONで出力してください：\n"
+    "- title: 料理名\n"
+    "- ingredients: 分量付きの材料のリスト\n"
+    "- instructions: 手順のリスト\n"
+    "- difficulty: 難易度（簡単・普通・難しい）\n"
+    "- cooking_time: 調理時間（例：約10分）\n"
+    "- servings: 何人分か（整数）"
+)
+
+
+def vision_messages(prompt: str, image_url: str) -> list:
+    return [
+        {"role": "system", "content": prompt},
+        {
+            "role": "user",
+            "content": [
+                {
+                    "type": "image_url",
+                    "image_url": {
+                        "url": image_url
+                    }
+                }
+            ]
+        }
+    ]
+
+
+def menu_messages(ingredients: list, exclude_titles: list = None) -> list:
+    # バリエーションを作るときは、既に提案した料理以外を求める
+    exclude = f"\n次の料理以外にしてください：{', '.join(exclude_titles)}" if exclude_titles else ""
+    return [
+        {"role": "system", "content": MENU_PROMPT},
+        {
+            "role": "user",
+            "content": f"食材：{', '.join([f'{p.name} ({p.amount}{p.unit})' for p in ingredients])}{exclude}"
+        }
+    ]
+
+
+def recipe_messages(menu_name: str = None, category: str = None, ingredients: list = (), known: dict = None) -> list:
+    if known is not None:
+        # レシピ集にあるレシピの足りない項目だけを埋めさせる
+        missing = [key for key, value in known.items() if value in (None, "", [], 0)]
+        content = (
+            f"次のレシピの足りない項目（{', '.join(missing)}）を補い、すべての項目を出力してください：\n"
+            f"{json.dumps(known, ensure_ascii=False)}"
+        )
+    else:
+        dish = f"料理名：{menu_name}\n" if menu_name else "使いたい食材で作れる料理を考えてください\n"
+        uses = f"使いたい食材：{', '.join(ingredients)}\n" if ingredients else ""
+        category = f"分類：{category}\n" if category else ""
+        content = f"{dish}{uses}{category}".rstrip("\n")
+    return [
+        {"role": "system", "content": RECIPE_PROMPT},
+        {"role": "user", "content": content}
+    ]
+
+
+# 起動時・アイドル時にモデルを読み込んでおくためのリクエスト（画像の解析と同じ先頭を計算させておく）
+WARMUP_MESSAGES = [
+    {"role": "system", "content": ANALYZE_PROMPT},
+    {"role": "user", "content": "準備ができたら OK とだけ答えてください"}
+]
@@ -0,0 +1,34 @@
+import threading
+import time
+from typing import Callable, Optional
+
+# トークンバケットによる流量制限
+# rate 個/秒でトークンがたまり（最大 capacity 個）、1回の処理でトークンを使う
+# 待ち方は呼び出し側に任せる（スレッドなら sleep、イベントループなら asyncio.sleep）
+
+
+class TokenBucket:
+    def __init__(self, rate: float, capacity: Optional[float] = None, clock: Callable[[], float] = time.monotonic):
+        # rate が0以下なら制限しない
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else max(rate, 1.0)
+        self._clock = clock
+        self._tokens = self.capacity
+        self._updated = clock()
+        self._lock = threading.Lock()
+
+    def take(self, tokens: float = 1.0) -> float:
+        """トークンを使えたら0を、足りなければ使わずに、たまるまでの秒数を返す"""
+        if self.rate <= 0:
+            return 0.0
+        with self._lock:
+            self._refill()
+            if self._tokens >= tokens:
+                self._tokens -= tokens
+                return 0.0
+            return (tokens - self._tokens) / self.rate
+
+    def _refill(self):
+        now = self._clock()
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
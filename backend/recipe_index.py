@@ -0,0 +1,191 @@
+import json
+import logging
+import re
+from collections import OrderedDict, defaultdict
+from typing import Iterable, Optional
+
+from menu_cache import normalize_text
+
+# ローカルのレシピ集の索引
+# 材料名 -> レシピ の転置索引と、料理名の部分文字列 -> レシピ の索引、分類 -> レシピ の索引を持つ
+# 問い合わせ側の語の部分文字列を索引から引くので、レシピ集全体を走査しない
+# （「明治おいしい牛乳」で「牛乳」を使うレシピが、「鶏の照り焼き丼」で「鶏の照り焼き」が見つかる）
+# レシピ集に無い料理をモデルに生成させたレシピは、レシピ集とは別の GeneratedRecipeCache に問い合わせごとに保存する
+# （確認していないレシピが、食材だけの問い合わせでレシピ集のレシピとして返らないように）
+
+logger = logging.getLogger(__name__)
+
+# RecipeResponse のうちモデルに埋めさせるフィールド（url は作らせない）
+RECIPE_FIELDS = ["title", "ingredients", "instructions", "difficulty", "cooking_time", "servings"]
+
+# 料理名がこの割合以上一致したレシピを、求められた料理のレシピとみなす
+TITLE_MATCH = 0.6
+
+# 問い合わせの語はこの文字数までを見る
+MAX_TERM_LENGTH = 32
+
+_NAME_SPLIT = re.compile(r"[\s　(（:：]")
+
+
+def ingredient_name(text: str) -> str:
+    """「鶏もも肉 200g」のような材料の表記から名前だけを取り出す"""
+    return normalize_text(_NAME_SPLIT.split(text.strip(), maxsplit=1)[0])
+
+
+def substrings(text: str, min_length: int = 1):
+    text = text[:MAX_TERM_LENGTH]
+    for start in range(len(text)):
+        for end in range(start + min_length, len(text) + 1):
+            yield text[start:end]
+
+
+def missing_fields(recipe: dict) -> list:
+    return [field for field in RECIPE_FIELDS if recipe.get(field) in (None, "", [], 0)]
+
+
+class RecipeIndex:
+    def __init__(self, recipes: Iterable[dict] = ()):
+        self._recipes = []
+        # 材料名 -> レシピ番号の集合
+        self._by_ingredient = defaultdict(set)
+        # 料理名の部分文字列（2文字以上） -> レシピ番号の集合
+        self._by_title = defaultdict(set)
+        # 分類 -> レシピ番号の集合
+        self._by_category = defaultdict(set)
+        for recipe in recipes:
+            self.add(recipe)
+
+    @classmethod
+    def load(cls, path: str) -> "RecipeIndex":
+        try:
+            with open(path, encoding="utf-8") as f:
+                return cls(json.load(f))
+        except FileNotFoundError:
+            logger.warning("Recipe corpus not found: %s", path)
+            return cls()
+
+    def __len__(self) -> int:
+        return len(self._recipes)
+
+    def add(self, recipe: dict) -> int:
+        recipe_id = len(self._recipes)
+        self._recipes.append(dict(recipe))
+        self._index(recipe_id)
+        return recipe_id
+
+    def update(self, recipe_id: int, fields: dict):
+        """モデルに埋めさせたフィールドを反映する（材料が変わった場合は索引も追加する）"""
+        self._recipes[recipe_id].update(fields)
+        self._index(recipe_id)
+
+    def get(self, recipe_id: int) -> dict:
+        return dict(self._recipes[recipe_id])
+
+    def search(
+        self,
+        menu_name: Optional[str] = None,
+        ingredients: Iterable[str] = (),
+        category: Optional[str] = None,
+        limit: int = 5,
+    ) -> list:
+        """(レシピ番号, 料理名の一致度, 一致した材料の数) を良い順に返す"""
+        title_scores = self._match_title(menu_name) if menu_name else {}
+
+        # 一致した材料の数と、材料名がどれだけ長く一致したか（「生ハム」には「ハム」より「生ハム」を優先する）
+        overlaps = defaultdict(int)
+        closeness = defaultdict(float)
+        for term in {normalize_text(i) for i in ingredients if i and i.strip()}:
+            matched = {}
+            for part in substrings(term):
+                for recipe_id in self._by_ingredient.get(part, ()):
+                    matched[recipe_id] = max(matched.get(recipe_id, 0), len(part))
+            for recipe_id, length in matched.items():
+                overlaps[recipe_id] += 1
+                closeness[recipe_id] += length / min(len(term), MAX_TERM_LENGTH)
+
+        candidates = set(title_scores) | set(overlaps)
+        if category:
+            candidates &= self._by_category.get(normalize_text(category), set())
+
+        ranked = sorted(
+            candidates,
+            key=lambda r: (
+                -title_scores.get(r, 0.0),
+                -overlaps.get(r, 0),
+                -closeness.get(r, 0.0),
+                len(self._recipes[r].get("ingredients") or []),
+                r,
+            ),
+        )
+        return [(r, title_scores.get(r, 0.0), overlaps.get(r, 0)) for r in ranked[:limit]]
+
+    def find(
+        self,
+        menu_name: Optional[str] = None,
+        ingredients: Iterable[str] = (),
+        category: Optional[str] = None,
+    ) -> Optional[int]:
+        """求められた料理（料理名が無ければ材料が一番重なる料理）のレシピ番号を返す（無ければNone）"""
+        for recipe_id, title_score, overlap in self.search(menu_name, ingredients, category, limit=1):
+            if menu_name and title_score >= TITLE_MATCH:
+                return recipe_id
+            if not menu_name and overlap > 0:
+                return recipe_id
+        return None
+
+    def _index(self, recipe_id: int):
+        recipe = self._recipes[recipe_id]
+        for text in recipe.get("ingredients") or []:
+            name = ingredient_name(text)
+            if name:
+                self._by_ingredient[name].add(recipe_id)
+        title = normalize_text(recipe.get("title") or "")
+        for part in substrings(title, min_length=2):
+            self._by_title[part].add(recipe_id)
+        if recipe.get("category"):
+            self._by_category[normalize_text(recipe["category"])].add(recipe_id)
+
+    def _match_title(self, menu_name: str) -> dict:
+        # 料理名どうしで一致する最長の部分文字列の長さを、長い方の料理名の長さで割った値
+        menu = normalize_text(menu_name)
+        longest = {}
+        for part in substrings(menu, min_length=2):
+            for recipe_id in self._by_title.get(part, ()):
+                longest[recipe_id] = max(longest.get(recipe_id, 0), len(part))
+        scores = {}
+        for recipe_id, length in longest.items():
+            title = normalize_text(self._recipes[recipe_id].get("title") or "")
+            scores[recipe_id] = length / max(len(title), len(menu[:MAX_TERM_LENGTH]))
+        return scores
+
+
+def generated_recipe_key(menu_name: Optional[str], ingredients: list, category: Optional[str]) -> str:
+    """問い合わせ（料理名・食材・分類）を正規化したキー（食材の順番には依存しない）"""
+    return json.dumps(
+        [normalize_text(menu_name or ""), sorted(normalize_text(i) for i in ingredients), normalize_text(category or "")],
+        ensure_ascii=False,
+    )
+
+
+class GeneratedRecipeCache:
+    """モデルに生成させたレシピを問い合わせごとに max_entries 件まで保存する（古いものから捨てる）"""
+
+    def __init__(self, max_entries: int = 256):
+        self.max_entries = max_entries
+        self._entries: OrderedDict = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, key: str) -> Optional[dict]:
+        recipe = self._entries.get(key)
+        if recipe is None:
+            return None
+        self._entries.move_to_end(key)
+        return dict(recipe)
+
+    def put(self, key: str, recipe: dict):
+        self._entries[key] = dict(recipe)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
@@ -0,0 +1,37 @@
+import asyncio
+import copy
+from typing import Awaitable, Callable, Hashable
+
+# 同じ入力に対する実行中の処理を1つにまとめる（single-flight）
+# 二度押しやリトライで同じリクエストが同時に届いた場合、モデル呼び出しは1回だけ行い、全員に同じ結果を返す
+# イベントループ上で使う（LINEのハンドラーからは from_thread.run 経由で呼び出す）
+
+
+class SingleFlight:
+    def __init__(self):
+        self._calls = {}
+        self.shared = 0
+
+    async def do(self, key: Hashable, func: Callable[[], Awaitable]):
+        """keyの処理が実行中ならその結果を待ち、無ければfuncを実行する"""
+        future = self._calls.get(key)
+        if future is None:
+            future = asyncio.ensure_future(func())
+            self._calls[key] = future
+            future.add_done_callback(lambda _: self._forget(key, future))
+        else:
+            self.shared += 1
+
+        # 待っている1人が切断しても、他の待ち手のために処理は続ける
+        result = await asyncio.shield(future)
+        return copy.deepcopy(result)
+
+    def in_flight(self) -> int:
+        return len(self._calls)
+
+    def _forget(self, key: Hashable, future: asyncio.Future):
+        if self._calls.get(key) is future:
+            del self._calls[key]
+        # 待ち手が全員いなくなっていても例外を取り出し済みにしておく
+        if not future.cancelled():
+            future.exception()
@@ -0,0 +1,88 @@
+import argparse
+import asyncio
+import hashlib
+import io
+
+import uvicorn
+from fastapi import FastAPI, Request, Response
+from PIL import Image, ImageDraw
+
+# ベンチマーク・動作確認用のLINE Messaging APIのスタブサーバー
+# プッシュメッセージ・multicast を受け取って数え、画像メッセージのコンテンツとしてメッセージIDごとに異なるJPEGを返す
+# 例: python stub_line_server.py --port 9020
+#     LINE_API_ENDPOINT=http://localhost:9020 uv run main.py
+
+
+def sample_image(seed: str, size: tuple = (640, 480)) -> bytes:
+    """seed ごとに中身の異なるJPEG（画像解析のキャッシュに当たらないようにする）"""
+    digest = hashlib.sha256(seed.encode()).digest()
+    image = Image.new("RGB", size, tuple(digest[:3]))
+    draw = ImageDraw.Draw(image)
+    for i in range(3, 30, 3):
+        x, y = digest[i] * size[0] // 256, digest[i + 1] * size[1] // 256
+        draw.rectangle((x, y, x + size[0] // 4, y + size[1] // 4), fill=tuple(digest[i:i + 3]))
+    buffer = io.BytesIO()
+    image.save(buffer, format="JPEG", quality=85)
+    return buffer.getvalue()
+
+
+def create_app(latency: float = 0.0) -> FastAPI:
+    app = FastAPI()
+    app.state.pushes = 0
+    app.state.contents = 0
+    app.state.multicasts = 0
+    app.state.recipients = 0
+    app.state.recent = []
+
+    async def wait():
+        if latency > 0:
+            await asyncio.sleep(latency)
+
+    @app.post("/v2/bot/message/push")
+    async def push(request: Request):
+        await request.body()
+        await wait()
+        app.state.pushes += 1
+        return {"sentMessages": [{"id": str(app.state.pushes), "quoteToken": "stub"}]}
+
+    @app.post("/v2/bot/message/multicast")
+    async def multicast(request: Request):
+        body = await request.json()
+        await wait()
+        app.state.multicasts += 1
+        app.state.recipients += len(body.get("to", []))
+        app.state.recent = (app.state.recent + [body])[-10:]
+        return {}
+
+    @app.get("/v2/bot/message/{message_id}/content")
+    async def content(message_id: str):
+        await wait()
+        app.state.contents += 1
+        return Response(sample_image(message_id), media_type="image/jpeg")
+
+    @app.get("/stub/stats")
+    async def stats():
+        # ベンチマークがイベントの処理が終わったかを確認するのに使う
+        return {
+            "pushes": app.state.pushes,
+            "contents": app.state.contents,
+            "multicasts": app.state.multicasts,
+            "recipients": app.state.recipients,
+            "recent": app.state.recent,
+        }
+
+    return app
+
+
+def main():
+    parser = argparse.ArgumentParser(description="LINE Messaging APIのスタブサーバー")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=9020)
+    parser.add_argument("--latency", type=float, default=0.0, help="1回のAPI呼び出しにかかる秒数")
+    args = parser.parse_args()
+
+    uvicorn.run(create_app(args.latency), host=args.host, port=args.port, log_level="warning")
+
+
+if __name__ == "__main__":
+    main()
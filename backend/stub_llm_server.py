@@ -0,0 +1,112 @@
+import argparse
+import asyncio
+import json
+import random
+import time
+import uuid
+
+import uvicorn
+from fastapi import FastAPI, HTTPException, Request
+from fastapi.responses import StreamingResponse
+
+# 動作確認・ベンチマーク用のOpenAI互換のスタブサーバー
+# 本物のモデルの代わりに、JSONスキーマを満たすダミーのレスポンスを指定した遅延で返す
+# 遅延と失敗の割合は app.state で実行中に変えられる（テストでバックエンドを落としたり直したりする）
+# 例: python stub_llm_server.py --port 9001 --latency 0.5 --jitter 0.2 --fail-rate 0.1
+#     LLM_BACKENDS='[{"url": "http://localhost:9001/v1"}, {"url": "http://localhost:9002/v1"}]' uv run main.py
+
+
+def sample_from_schema(schema: dict):
+    """JSONスキーマを満たすダミーの値を作る"""
+    kind = schema.get("type")
+    if kind == "object":
+        return {key: sample_from_schema(value) for key, value in schema.get("properties", {}).items()}
+    if kind == "array":
+        return [sample_from_schema(schema.get("items", {"type": "string"}))]
+    if kind == "integer":
+        return 1
+    if kind == "number":
+        return 1.0
+    if kind == "boolean":
+        return True
+    return "テスト"
+
+
+def create_app(model: str = "gemma3:27b", latency: float = 0.0, jitter: float = 0.0, fail_rate: float = 0.0) -> FastAPI:
+    app = FastAPI()
+    app.state.requests = 0
+    app.state.latency = latency
+    app.state.jitter = jitter
+    app.state.fail_rate = fail_rate
+    # False にすると /v1/models（死活確認）も503を返す
+    app.state.healthy = True
+
+    async def wait():
+        await asyncio.sleep(max(0.0, app.state.latency + random.uniform(-app.state.jitter, app.state.jitter)))
+
+    @app.get("/v1/models")
+    async def models():
+        if not app.state.healthy:
+            raise HTTPException(status_code=503, detail="stub unhealthy")
+        return {"object": "list", "data": [{"id": model, "object": "model", "created": 0, "owned_by": "stub"}]}
+
+    @app.post("/v1/chat/completions")
+    async def chat_completions(request: Request):
+        body = await request.json()
+        app.state.requests += 1
+        await wait()
+        if random.random() < app.state.fail_rate:
+            raise HTTPException(status_code=503, detail="stub failure")
+
+        schema = (body.get("response_format") or {}).get("schema") or {"type": "object"}
+        content = json.dumps(sample_from_schema(schema), ensure_ascii=False)
+        completion_id = f"chatcmpl-{uuid.uuid4().hex}"
+        created = int(time.time())
+
+        if not body.get("stream"):
+            return {
+                "id": completion_id,
+                "object": "chat.completion",
+                "created": created,
+                "model": body.get("model", model),
+                "choices": [{"index": 0, "message": {"role": "assistant", "content": content}, "finish_reason": "stop"}],
+            }
+
+        async def generate():
+            # 数文字ずつ区切って流す
+            for start in range(0, len(content), 8):
+                chunk = {
+                    "id": completion_id,
+                    "object": "chat.completion.chunk",
+                    "created": created,
+                    "model": body.get("model", model),
+                    "choices": [{"index": 0, "delta": {"content": content[start:start + 8]}, "finish_reason": None}],
+                }
+                yield f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n"
+            yield "data: [DONE]\n\n"
+
+        return StreamingResponse(generate(), media_type="text/event-stream")
+
+    return app
+
+
+def main():
+    parser = argparse.ArgumentParser(description="OpenAI互換のスタブサーバー")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=9001)
+    parser.add_argument("--model", default="gemma3:27b", help="/v1/models で返すモデル名")
+    parser.add_argument("--latency", type=float, default=0.0, help="レスポンスまでの秒数")
+    parser.add_argument("--jitter", type=float, default=0.0, help="遅延のばらつき（±秒）")
+    parser.add_argument("--fail-rate", type=float, default=0.0, help="503を返す割合")
+    args = parser.parse_args()
+
+    uvicorn.run(
+        create_app(args.model, args.latency, args.jitter, args.fail_rate),
+        host=args.host,
+        port=args.port,
+        log_level="warning",
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,99 @@
+import argparse
+import asyncio
+import hashlib
+from email.utils import formatdate
+
+import uvicorn
+from fastapi import FastAPI, Request, Response
+
+# ベンチマーク・動作確認用のS3互換のスタブサーバー（R2の代わり）
+# MinIOクライアントが使う PUT / GET / HEAD のオブジェクト操作だけに対応し、メモリ上に保存する（署名は検証しない）
+# 例: python stub_s3_server.py --port 9010
+#     R2_ENDPOINT=localhost:9010 R2_SECURE=0 ACCESS_KEY=x SECRET_KEY=x uv run main.py
+
+LOCATION = '<?xml version="1.0" encoding="UTF-8"?>\n<LocationConstraint xmlns="http://s3.amazonaws.com/doc/2006-03-01/">us-east-1</LocationConstraint>'
+
+
+def error_xml(code: str, message: str, bucket: str, key: str = "") -> str:
+    return (
+        '<?xml version="1.0" encoding="UTF-8"?>\n'
+        f"<Error><Code>{code}</Code><Message>{message}</Message>"
+        f"<BucketName>{bucket}</BucketName><Key>{key}</Key><Resource>/{bucket}/{key}</Resource>"
+        "<RequestId>stub</RequestId><HostId>stub</HostId></Error>"
+    )
+
+
+def create_app(latency: float = 0.0) -> FastAPI:
+    app = FastAPI()
+    # (bucket, key) -> {"body", "etag", "headers"}
+    app.state.objects = {}
+    app.state.requests = 0
+
+    async def wait():
+        if latency > 0:
+            await asyncio.sleep(latency)
+
+    def object_headers(entry: dict) -> dict:
+        return {
+            "ETag": f'"{entry["etag"]}"',
+            "Content-Length": str(len(entry["body"])),
+            "Last-Modified": entry["last_modified"],
+            **entry["headers"],
+        }
+
+    @app.get("/{bucket}")
+    async def bucket_location(bucket: str):
+        # MinIOクライアントは最初にバケットのリージョンを問い合わせる
+        return Response(LOCATION, media_type="application/xml")
+
+    @app.put("/{bucket}/{key:path}")
+    async def put_object(bucket: str, key: str, request: Request):
+        app.state.requests += 1
+        await wait()
+        body = await request.body()
+        headers = {
+            name: value for name, value in request.headers.items()
+            if name.startswith("x-amz-meta-") or name in ("content-type", "content-encoding")
+        }
+        etag = hashlib.md5(body).hexdigest()
+        app.state.objects[(bucket, key)] = {
+            "body": body,
+            "etag": etag,
+            "headers": headers,
+            "last_modified": formatdate(usegmt=True),
+        }
+        return Response(headers={"ETag": f'"{etag}"'})
+
+    @app.get("/{bucket}/{key:path}")
+    async def get_object(bucket: str, key: str):
+        app.state.requests += 1
+        await wait()
+        entry = app.state.objects.get((bucket, key))
+        if entry is None:
+            return Response(error_xml("NoSuchKey", "The specified key does not exist.", bucket, key), status_code=404, media_type="application/xml")
+        return Response(entry["body"], headers=object_headers(entry))
+
+    @app.head("/{bucket}/{key:path}")
+    async def stat_object(bucket: str, key: str):
+        app.state.requests += 1
+        await wait()
+        entry = app.state.objects.get((bucket, key))
+        if entry is None:
+            return Response(status_code=404)
+        return Response(headers=object_headers(entry))
+
+    return app
+
+
+def main():
+    parser = argparse.ArgumentParser(description="S3互換のスタブサーバー")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=9010)
+    parser.add_argument("--latency", type=float, default=0.0, help="1回の操作にかかる秒数")
+    args = parser.parse_args()
+
+    uvicorn.run(create_app(args.latency), host=args.host, port=args.port, log_level="warning")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,195 @@
+import asyncio
+import threading
+import time
+from contextlib import contextmanager
+
+import uvicorn
+
+import stub_llm_server
+from bench_load import free_port
+from llm_router import Backend, BackendRouter
+
+# 複数のバックエンドへの振り分け（llm_router）のテスト
+# stub_llm_server を2台このプロセスの中で起動し、失敗・遅延を切り替えながら
+# 別のバックエンドへの送り直し・サーキットブレーカー（open → half_open → closed）・hedge を確かめる
+# 例: python test_llm_router.py（pytest でも実行できる）
+
+MODEL = "gemma3:27b"
+REQUEST = {
+    "model": MODEL,
+    "messages": [{"role": "user", "content": "テスト"}],
+    "response_format": {"type": "json_object", "schema": {"type": "object", "properties": {"name": {"type": "string"}}}},
+}
+
+# 振り分けはランダムなので、確かめたい経路を通るまで送り直す回数の上限
+MAX_ATTEMPTS = 50
+
+
+@contextmanager
+def stub_backend(name: str, latency: float = 0.0, fail_rate: float = 0.0):
+    """スタブサーバーを別のスレッドで起動し、(Backend, スタブの app) を返す"""
+    app = stub_llm_server.create_app(MODEL, latency=latency, fail_rate=fail_rate)
+    port = free_port()
+    server = uvicorn.Server(uvicorn.Config(app, host="127.0.0.1", port=port, log_level="warning"))
+    thread = threading.Thread(target=server.run, daemon=True)
+    thread.start()
+    try:
+        while not server.started:
+            if not thread.is_alive():
+                raise RuntimeError(f"スタブサーバーが起動できませんでした ({name})")
+            time.sleep(0.01)
+        # 送り直しはルーターに任せるので、SDKの中ではやり直さない
+        yield Backend(f"http://127.0.0.1:{port}/v1", name=name, max_retries=0), app
+    finally:
+        server.should_exit = True
+        thread.join()
+
+
+def create_router(backends: list, **kwargs) -> BackendRouter:
+    # ウォームアップは行わない。死活確認も health_interval を指定しなければ行わず、リクエストの成否だけで状態を変える
+    kwargs.setdefault("health_interval", 0)
+    return BackendRouter(backends, warmup_request=None, **kwargs)
+
+
+async def send(router: BackendRouter):
+    return await router.create(**REQUEST)
+
+
+def run(router: BackendRouter, scenario):
+    """scenario() をイベントループで実行し、最後にバックエンドへの接続を閉じる"""
+    async def main():
+        try:
+            return await scenario()
+        finally:
+            await router.stop()
+
+    return asyncio.run(main())
+
+
+def test_failover_to_another_backend():
+    with stub_backend("broken", fail_rate=1.0) as (broken, _), stub_backend("healthy") as (healthy, _):
+        router = create_router([broken, healthy], failure_threshold=1000)
+
+        async def scenario():
+            for _ in range(MAX_ATTEMPTS):
+                await send(router)
+                if router.failovers:
+                    return
+
+        run(router, scenario)
+        # 落ちているバックエンドに送ったリクエストも、もう1台に送り直して成功する
+        assert router.failovers >= 1
+        assert broken.errors == router.failovers
+        assert healthy.errors == 0
+        assert broken.state() == "closed"
+
+
+def test_circuit_opens_and_recovers_after_half_open_trial():
+    with stub_backend("flaky", fail_rate=1.0) as (flaky, flaky_app), stub_backend("healthy") as (healthy, _):
+        router = create_router([flaky, healthy], failure_threshold=2, cooldown=0.3)
+
+        async def scenario():
+            # 続けて failure_threshold 回失敗すると遮断する
+            for _ in range(MAX_ATTEMPTS):
+                await send(router)
+                if flaky.state() == "open":
+                    break
+            assert flaky.state() == "open"
+            assert flaky.consecutive_failures == 2
+
+            # 遮断中は送らない
+            requests = flaky.requests
+            for _ in range(10):
+                await send(router)
+            assert flaky.requests == requests
+
+            # cooldown を過ぎると1件だけ試しに送り、失敗したらすぐにまた遮断する
+            await asyncio.sleep(0.35)
+            assert flaky.state() == "half_open"
+            for _ in range(MAX_ATTEMPTS):
+                await send(router)
+                if flaky.requests > requests:
+                    break
+            assert flaky.requests == requests + 1
+            assert flaky.state() == "open"
+
+            # 直ってから試しに送ったリクエストが成功すると閉じる
+            flaky_app.state.fail_rate = 0.0
+            await asyncio.sleep(0.35)
+            requests = flaky.requests
+            for _ in range(MAX_ATTEMPTS):
+                await send(router)
+                if flaky.requests > requests:
+                    break
+            assert flaky.state() == "closed"
+            assert flaky.consecutive_failures == 0
+
+        run(router, scenario)
+        assert healthy.errors == 0
+
+
+def test_health_check_only_closes_circuit_it_opened():
+    with stub_backend("flaky", fail_rate=1.0) as (flaky, _), stub_backend("healthy") as (healthy, healthy_app):
+        router = create_router([flaky, healthy], failure_threshold=2, cooldown=30, health_interval=0.1)
+
+        async def scenario():
+            await router.start()
+
+            # /models には応答するがリクエストは失敗し続けるバックエンドは、死活確認が成功しても遮断したまま
+            for _ in range(MAX_ATTEMPTS):
+                await send(router)
+                if flaky.state() == "open":
+                    break
+            assert flaky.state() == "open"
+            await asyncio.sleep(0.5)
+            assert flaky.state() == "open"
+            requests = flaky.requests
+            for _ in range(10):
+                await send(router)
+            assert flaky.requests == requests
+
+            # 死活確認の失敗で遮断したバックエンドは、死活確認が成功すれば戻す
+            healthy_app.state.healthy = False
+            await asyncio.sleep(0.5)
+            assert healthy.state() == "open"
+            healthy_app.state.healthy = True
+            await asyncio.sleep(0.5)
+            assert healthy.state() == "closed"
+
+        run(router, scenario)
+
+
+def test_hedge_wins_when_first_backend_is_slow():
+    with stub_backend("slow", latency=0.01) as (slow, slow_app), stub_backend("fast", latency=0.01) as (fast, _):
+        router = create_router([slow, fast], hedge=True, hedge_min_samples=3)
+
+        async def scenario():
+            # hedge の待ち時間（p95）を決める実績をためる
+            for _ in range(MAX_ATTEMPTS):
+                if min(len(slow.latencies), len(fast.latencies)) >= 3:
+                    break
+                await send(router)
+            wins = router.hedge_wins
+
+            # 片方が遅くなると、p95 を過ぎても返ってこないリクエストをもう1台にも送り、早い方を使う
+            slow_app.state.latency = 2.0
+            for _ in range(MAX_ATTEMPTS):
+                started = time.monotonic()
+                await send(router)
+                elapsed = time.monotonic() - started
+                if router.hedge_wins > wins:
+                    return elapsed
+            return None
+
+        elapsed = run(router, scenario)
+        assert elapsed is not None and elapsed < 1.0
+        # hedge で負けたリクエストは取り消しなので、失敗には数えない
+        assert slow.errors == 0
+        assert slow.state() == "closed"
+
+
+if __name__ == "__main__":
+    tests = [value for name, value in list(globals().items()) if name.startswith("test_")]
+    for test in tests:
+        test()
+        print(f"ok: {test.__name__}")
@@ -0,0 +1,95 @@
+import asyncio
+import logging
+from collections import OrderedDict
+from typing import Callable
+
+from fastapi.concurrency import run_in_threadpool
+
+# LINE webhookのイベントをバックグラウンドで処理するワーカープール
+# /callback は署名を検証してイベントをキューに入れたらすぐに返し、処理はワーカーが行う
+# 再送されたイベントは webhookEventId で重複を除く
+# 同じユーザーのイベントは同じワーカーに割り当て、届いた順に処理する（「開始」の前に画像を処理しない）
+
+logger = logging.getLogger(__name__)
+
+
+class QueueFullError(Exception):
+    pass
+
+
+class WebhookWorkerPool:
+    def __init__(self, handle: Callable, workers: int = 8, max_queue: int = 1000, dedupe_size: int = 10000):
+        # handle はイベント1件を処理する同期関数（スレッドプールで実行する）
+        self.handle = handle
+        self.workers = workers
+        self.max_queue = max_queue
+        self.dedupe_size = dedupe_size
+        self._queues = []
+        self._tasks = []
+        self._seen: OrderedDict = OrderedDict()
+        self.processed = 0
+        self.duplicates = 0
+        self.failures = 0
+
+    async def start(self):
+        self._queues = [asyncio.Queue() for _ in range(self.workers)]
+        self._tasks = [asyncio.create_task(self._worker(queue)) for queue in self._queues]
+
+    async def stop(self, timeout: float = 10.0):
+        """キューに残っているイベントを最大 timeout 秒待ってからワーカーを止める"""
+        if self._queues:
+            try:
+                await asyncio.wait_for(asyncio.gather(*(queue.join() for queue in self._queues)), timeout)
+            except asyncio.TimeoutError:
+                logger.warning("LINE webhook queue: %s events dropped on shutdown", self.qsize())
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    def submit(self, events: list) -> int:
+        """イベントをキューに入れ、受け付けた件数を返す（キューが溢れる場合は1件も入れずに QueueFullError）"""
+        new_events = []
+        new_ids = set()
+        for event in events:
+            event_id = getattr(event, "webhook_event_id", None)
+            if event_id is not None and (event_id in self._seen or event_id in new_ids):
+                self.duplicates += 1
+                continue
+            new_events.append(event)
+            new_ids.add(event_id)
+
+        if self.qsize() + len(new_events) > self.max_queue:
+            raise QueueFullError()
+
+        for event in new_events:
+            event_id = getattr(event, "webhook_event_id", None)
+            if event_id is not None:
+                self._remember(event_id)
+            self._queue_for(event).put_nowait(event)
+        return len(new_events)
+
+    def qsize(self) -> int:
+        return sum(queue.qsize() for queue in self._queues)
+
+    def _queue_for(self, event) -> asyncio.Queue:
+        source = getattr(event, "source", None)
+        user_id = getattr(source, "user_id", None) or ""
+        return self._queues[hash(user_id) % len(self._queues)]
+
+    def _remember(self, event_id: str):
+        self._seen[event_id] = True
+        while len(self._seen) > self.dedupe_size:
+            self._seen.popitem(last=False)
+
+    async def _worker(self, queue: asyncio.Queue):
+        while True:
+            event = await queue.get()
+            try:
+                await run_in_threadpool(self.handle, event)
+                self.processed += 1
+            except Exception as e:
+                self.failures += 1
+                logger.error("LINE event error: %s", e)
+            finally:
+                queue.task_done()
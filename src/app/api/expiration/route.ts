@@ -1,3 +1,4 @@
+import { backendUserHeaders } from "@/lib/backend";
 import type { ResponseTypes } from "@/types/response";
 import { NextRequest, NextResponse } from "next/server";
 
@@ -16,6 +17,7 @@ export const POST = async (req: NextRequest) => {
     console.log("Sending request to backend...");
     const backendRes = await fetch("https://backend.yashikota.com/analyze", {
       method: "POST",
+      headers: backendUserHeaders(req),
       body: backendFormData,
     });
 
@@ -1,3 +1,4 @@
+import { backendUserHeaders } from "@/lib/backend";
 import type { ResponseTypes } from "@/types/response";
 import { NextRequest, NextResponse } from "next/server";
 
@@ -9,6 +10,7 @@ export const POST = async (req: NextRequest) => {
       method: "POST",
       headers: {
         "Content-Type": "application/json",
+        ...backendUserHeaders(req),
       },
       body: JSON.stringify({ products: formData }),
     });
@@ -0,0 +1,17 @@
+import { createHmac } from "node:crypto";
+
+// バックエンドの流量制限をユーザーごとにかけるため、ブラウザのIPを X-User-Id として渡す
+// （Next.js のサーバーを経由するので、バックエンドからはすべて同じIPに見える）
+// x-forwarded-for の先頭はブラウザが自由に付けられるので、手前のプロキシが付けた末尾（または x-real-ip）を使う
+// ブラウザが X-User-Id を偽れないように、バックエンドと共有する USER_ID_SECRET で署名する。
+// 署名できなければ送らず、バックエンドでは確かめられないリクエストとしてまとめて制限される
+export function backendUserHeaders(req: Request): Record<string, string> {
+  const secret = process.env.USER_ID_SECRET;
+  const userId =
+    req.headers.get("x-real-ip") || req.headers.get("x-forwarded-for")?.split(",").pop()?.trim() || "";
+  if (!secret || !userId) {
+    return {};
+  }
+  const signature = createHmac("sha256", secret).update(userId).digest("hex");
+  return { "X-User-Id": userId, "X-User-Signature": signature };
+}